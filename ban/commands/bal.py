@@ -1,6 +1,12 @@
+import os
+from datetime import timedelta
+from itertools import islice
+from pathlib import Path
+
 import peewee
 
 from ban.commands import command, reporter
+from ban.core import context
 from ban.core.models import HouseNumber, Group, Position
 from ban.utils import compute_cia
 
@@ -11,15 +17,49 @@ __namespace__ = 'import'
 
 @command
 @helpers.nodiff
-def bal(path, limit=0, **kwargs):
+def bal(path, limit=0, group_commit=0, resume=False, **kwargs):
     """Import from BAL files (AITF 1.1 format)
     cf https://github.com/etalab/ban/issues/75
+
+    group_commit    Commit rows by groups of this size (default: one by one).
+    resume  Save a checkpoint, and resume from the one of a previous run.
     """
-    # We need to support BOM.
-    rows = list(helpers.load_csv(path, encoding='utf-8-sig'))
+    checkpoint = None
+    position = 0
+    source = path
+    if isinstance(path, (str, Path)):  # Not for file objects.
+        checkpoint = helpers.Checkpoint(path, durable=resume)
+        state = checkpoint.load() if resume else None
+        if state:
+            context.get('reporter').restore(state['reports'])
+            if state['done']:
+                print('Already processed', path)
+                return
+            # Position is a row index.
+            position = state['position']
+        # We need to support BOM.
+        source = helpers.open_csv(path, encoding='utf-8-sig')
+    rows = helpers.Rows(helpers.load_csv(source), position=position)
+    if checkpoint:
+        rows = checkpoint.track(rows)
+    # Jobs pass their own progress callable.
+    progress = kwargs.get('progress', True)
     if limit:
-        rows = rows[:limit]
-    helpers.batch(process_row, rows, total=len(rows))
+        rows = islice(rows, limit)
+        if progress is True:
+            progress = helpers.Bar(total=limit,
+                                   throttle=timedelta(seconds=1))
+    elif progress is True and isinstance(path, (str, Path)):
+        # Bytes read, so the file does not need to be read once more to
+        # count its rows.
+        size = os.fstat(source.fileno()).st_size
+        progress = helpers.FileBar(
+            size, lambda: size if source.closed else source.buffer.tell(),
+            throttle=timedelta(seconds=1))
+    helpers.batch(process_row, rows, group_commit=group_commit,
+                  checkpoint=checkpoint, progress=progress)
+    if checkpoint:
+        checkpoint.save(context.get('reporter'), done=True)
 
 
 @helpers.session
@@ -0,0 +1,466 @@
+"""
+Bulk loader used by `import:init --bulk`.
+
+Rows are streamed into an UNLOGGED staging table with COPY, then each level
+(municipality, postcode, group, housenumber, position) is resolved and
+inserted set-based, with its Version rows, in a single statement.
+
+Only rows that can be safely created are handled this way: rows matching an
+existing resource, duplicates, invalid or unresolvable rows are replayed
+through the regular `process_row` path, which deals with updates and reports
+errors through the Reporter as usual.
+"""
+import os
+from itertools import islice
+
+import peewee
+
+from ban import db
+from ban.db import table
+from ban.commands import reporter
+from ban.core import context
+from ban.core.encoder import dumps
+from ban.core.models import (Group, HouseNumber, Municipality, Position,
+                             PostCode)
+from ban.core.versioning import Version
+from ban.utils import utcnow
+
+from . import cache, helpers
+
+
+def choices(field):
+    return ', '.join("'{}'".format(value) for value, label in field.choices)
+
+
+class LineReader:
+    """Minimal file-like wrapper to feed COPY with an iterable of lines."""
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                break
+            if not line.endswith('\n'):
+                line += '\n'
+            self.buffer += line
+            self.count += 1
+        if size < 0:
+            size = len(self.buffer)
+        chunk, self.buffer = self.buffer[:size], self.buffer[size:]
+        return chunk
+
+
+# Each level builds a work table with one row per staged row, the columns
+# to insert and a `ready` flag telling if the row can be created set-based.
+MUNICIPALITY = """
+SELECT x.*, coalesce(
+    length(x.insee) = 5 AND coalesce(x.name, '') <> ''
+    AND length(x.name) <= 200 AND x.siren IS NULL
+    AND NOT EXISTS (SELECT 1 FROM {municipality} m WHERE m.insee = x.insee)
+    AND row_number() OVER (PARTITION BY x.insee ORDER BY x.line) = 1,
+    false) AS ready
+FROM (
+    SELECT s.line, s.data, s.data->>'insee' AS insee,
+           s.data->>'name' AS name, nullif(s.data->>'siren', '') AS siren,
+           hstore('source', s.data->>'source') AS attributes
+    FROM {staging} s WHERE s.data->>'type' = 'municipality') x
+"""
+
+POSTCODE = """
+SELECT x.*, coalesce(
+    length(x.code) = 5 AND x.code ~ '^[0-9]+$'
+    AND coalesce(x.name, '') <> '' AND length(x.name) <= 200
+    AND x.municipality_id IS NOT NULL
+    AND NOT EXISTS (SELECT 1 FROM {postcode} p WHERE p.code = x.code
+                    AND p.municipality_id = x.municipality_id)
+    AND row_number() OVER (PARTITION BY x.code, x.municipality_id
+                           ORDER BY x.line) = 1,
+    false) AS ready
+FROM (
+    SELECT s.line, s.data, s.data->>'postcode' AS code,
+           s.data->>'name' AS name, m.pk AS municipality_id,
+           hstore('source', s.data->>'source') AS attributes
+    FROM {staging} s
+    LEFT JOIN {municipality} m ON m.insee = s.data->>'municipality:insee'
+    WHERE s.data->>'type' = 'postcode') x
+"""
+
+GROUP = """
+SELECT x.*, coalesce(
+    coalesce(x.name, '') <> '' AND length(x.name) <= 200
+    AND x.kind IN ({kinds}) AND x.municipality_id IS NOT NULL
+    AND coalesce(x.fantoir, x.ign, x.laposte) IS NOT NULL
+    AND coalesce(length(x.fantoir), 9) = 9
+    AND coalesce(length(x.ign), 0) <= 24
+    AND coalesce(length(x.laposte), 0) <= 10
+    AND NOT EXISTS (SELECT 1 FROM {group} g WHERE g.fantoir = x.fantoir)
+    AND NOT EXISTS (SELECT 1 FROM {group} g WHERE g.ign = x.ign)
+    AND NOT EXISTS (SELECT 1 FROM {group} g WHERE g.laposte = x.laposte)
+    AND (x.fantoir IS NULL OR row_number() OVER (
+        PARTITION BY x.fantoir ORDER BY x.line) = 1)
+    AND (x.ign IS NULL OR row_number() OVER (
+        PARTITION BY x.ign ORDER BY x.line) = 1)
+    AND (x.laposte IS NULL OR row_number() OVER (
+        PARTITION BY x.laposte ORDER BY x.line) = 1),
+    false) AS ready
+FROM (
+    SELECT s.line, s.data, s.data->>'name' AS name,
+           s.data->>'group' AS kind,
+           CASE WHEN length(s.data->>'fantoir') = 10
+                THEN left(s.data->>'fantoir', 9)
+                ELSE nullif(s.data->>'fantoir', '') END AS fantoir,
+           nullif(s.data->>'ign', '') AS ign,
+           nullif(s.data->>'laposte', '') AS laposte,
+           CASE WHEN s.data->>'addressing' IN ({addressing})
+                THEN s.data->>'addressing' END AS addressing,
+           m.pk AS municipality_id,
+           (SELECT hstore(array_agg(key), array_agg(value))
+            FROM jsonb_each_text(coalesce(s.data->'attributes', '{{}}')
+                 || jsonb_build_object('source', s.data->'source'))
+           ) AS attributes
+    FROM {staging} s
+    LEFT JOIN {municipality} m ON m.insee = s.data->>'municipality:insee'
+    WHERE s.data->>'type' = 'group') x
+"""
+
+HOUSENUMBER = """
+SELECT x.*, coalesce(
+    x.parent_id IS NOT NULL AND x.fantoir IS NOT NULL
+    AND (NOT x.has_postcode OR x.postcode_id IS NOT NULL)
+    AND coalesce(length(x.number), 0) <= 16
+    AND coalesce(length(x.ordinal), 0) <= 16
+    AND coalesce(length(x.ign), 0) <= 24
+    AND coalesce(length(x.laposte), 0) <= 10
+    AND NOT EXISTS (SELECT 1 FROM {housenumber} h WHERE h.cia = x.cia)
+    AND NOT EXISTS (SELECT 1 FROM {housenumber} h
+                    WHERE h.cia = x.given_cia)
+    AND NOT EXISTS (SELECT 1 FROM {housenumber} h WHERE h.ign = x.ign)
+    AND NOT EXISTS (SELECT 1 FROM {housenumber} h
+                    WHERE h.laposte = x.laposte)
+    AND NOT EXISTS (SELECT 1 FROM {housenumber} h
+                    WHERE h.parent_id = x.parent_id
+                    AND h.number IS NOT DISTINCT FROM x.number
+                    AND h.ordinal IS NOT DISTINCT FROM x.ordinal)
+    AND row_number() OVER (PARTITION BY x.cia ORDER BY x.line) = 1
+    AND row_number() OVER (PARTITION BY x.parent_id, x.number, x.ordinal
+                           ORDER BY x.line) = 1
+    AND (x.ign IS NULL OR row_number() OVER (
+        PARTITION BY x.ign ORDER BY x.line) = 1)
+    AND (x.laposte IS NULL OR row_number() OVER (
+        PARTITION BY x.laposte ORDER BY x.line) = 1),
+    false) AS ready
+FROM (
+    SELECT y.*, g.fantoir,
+           -- Same as ban.utils.compute_cia, from the parent values.
+           gm.insee || '_' || substr(g.fantoir, 6) || '_'
+           || upper(coalesce(y.number, '')) || '_'
+           || upper(coalesce(y.ordinal, '')) AS cia,
+           (SELECT p.pk FROM {postcode} p
+            JOIN {municipality} pm ON pm.pk = p.municipality_id
+            WHERE p.code = y.data->>'postcode:code'
+            AND pm.insee = coalesce(y.data->>'municipality:insee',
+                                    left(y.data->>'group:fantoir', 5))
+           ) AS postcode_id
+    FROM (
+        SELECT s.line, s.data,
+               nullif(s.data->>'numero', '') AS number,
+               nullif(s.data->>'ordinal', '') AS ordinal,
+               nullif(s.data->>'ign', '') AS ign,
+               nullif(s.data->>'laposte', '') AS laposte,
+               nullif(s.data->>'cia', '') AS given_cia,
+               s.data ? 'postcode:code' AS has_postcode,
+               hstore('source', s.data->>'source') AS attributes,
+               CASE
+                WHEN s.data->>'group:fantoir' IS NOT NULL THEN (
+                    SELECT g.pk FROM {group} g
+                    WHERE g.fantoir = s.data->>'group:fantoir'
+                    AND g.deleted_at IS NULL)
+                WHEN s.data->>'group:ign' IS NOT NULL THEN (
+                    SELECT g.pk FROM {group} g
+                    WHERE g.ign = s.data->>'group:ign'
+                    AND g.deleted_at IS NULL)
+                WHEN s.data->>'group:laposte' IS NOT NULL THEN (
+                    SELECT g.pk FROM {group} g
+                    WHERE g.laposte = s.data->>'group:laposte'
+                    AND g.deleted_at IS NULL)
+               END AS parent_id
+        FROM {staging} s WHERE s.data->>'type' = 'housenumber') y
+    LEFT JOIN {group} g ON g.pk = y.parent_id
+    LEFT JOIN {municipality} gm ON gm.pk = g.municipality_id) x
+"""
+
+POSITION = """
+SELECT x.*, coalesce(
+    x.housenumber_id IS NOT NULL
+    AND (x.center IS NOT NULL OR coalesce(x.name, '') <> '')
+    AND coalesce(length(x.name), 0) <= 200
+    AND coalesce(length(x.source), 0) <= 64
+    AND coalesce(length(x.ign), 0) <= 24
+    AND NOT EXISTS (SELECT 1 FROM {position} p WHERE p.ign = x.ign)
+    AND NOT EXISTS (SELECT 1 FROM {position} p
+                    WHERE p.housenumber_id = x.housenumber_id
+                    AND p.source IS NOT DISTINCT FROM x.source)
+    AND row_number() OVER (PARTITION BY x.housenumber_id, x.source
+                           ORDER BY x.line) = 1
+    AND (x.ign IS NULL OR row_number() OVER (
+        PARTITION BY x.ign ORDER BY x.line) = 1),
+    false) AS ready
+FROM (
+    SELECT s.line, s.data, s.data->>'source' AS source,
+           nullif(s.data->>'name', '') AS name,
+           nullif(s.data->>'ign', '') AS ign,
+           CASE WHEN s.data->>'kind' IN ({kinds})
+                THEN s.data->>'kind' ELSE '{unknown}' END AS kind,
+           CASE WHEN s.data->>'positionning' IN ({positionings})
+                THEN s.data->>'positionning' ELSE '{other}'
+           END AS positioning,
+           ST_SetSRID(CASE
+            WHEN jsonb_typeof(s.data->'geometry') = 'array'
+            THEN ST_MakePoint((s.data->'geometry'->>0)::float8,
+                              (s.data->'geometry'->>1)::float8)
+            WHEN s.data->'geometry'->>'type' = 'Point'
+            THEN ST_MakePoint(
+                (s.data->'geometry'->'coordinates'->>0)::float8,
+                (s.data->'geometry'->'coordinates'->>1)::float8)
+           END, {srid}) AS center,
+           CASE
+            WHEN s.data->>'housenumber:cia' IS NOT NULL THEN (
+                SELECT h.pk FROM {housenumber} h
+                WHERE h.cia = upper(s.data->>'housenumber:cia')
+                AND h.deleted_at IS NULL)
+            WHEN s.data->>'housenumber:ign' IS NOT NULL THEN (
+                SELECT h.pk FROM {housenumber} h
+                WHERE h.ign = s.data->>'housenumber:ign'
+                AND h.deleted_at IS NULL)
+           END AS housenumber_id
+    FROM {staging} s WHERE s.data->>'type' = 'position') x
+"""
+
+
+class Level:
+
+    def __init__(self, model, sql, columns, key, message, **extra):
+        self.model = model
+        self.sql = sql
+        self.columns = columns
+        self.key = key
+        self.message = message
+        self.extra = extra
+
+    @property
+    def name(self):
+        return self.model.__name__.lower()
+
+
+LEVELS = [
+    Level(Municipality, MUNICIPALITY, ['insee', 'name', 'attributes'],
+          'insee', 'Imported Municipality'),
+    Level(PostCode, POSTCODE, ['code', 'name', 'municipality_id',
+                               'attributes'],
+          'code', 'Imported PostCode'),
+    Level(Group, GROUP, ['name', 'kind', 'fantoir', 'ign', 'laposte',
+                         'addressing', 'municipality_id', 'attributes'],
+          'fantoir', 'Group created', kinds=choices(Group.kind),
+          addressing=choices(Group.addressing)),
+    Level(HouseNumber, HOUSENUMBER, ['number', 'ordinal', 'parent_id', 'cia',
+                                     'ign', 'laposte', 'postcode_id',
+                                     'attributes'],
+          'cia', 'HouseNumber created'),
+    Level(Position, POSITION, ['source', 'name', 'ign', 'kind',
+                               'positioning', 'center', 'housenumber_id'],
+          'id', 'Position created', kinds=choices(Position.kind),
+          positionings=choices(Position.positioning),
+          unknown=Position.UNKNOWN, other=Position.OTHER,
+          srid=Position.center.srid),
+]
+
+
+class Loader:
+
+    def __init__(self):
+        self.database = Version._meta.database
+        self.staging = 'import_staging_{}'.format(os.getpid())
+        self.now = utcnow()
+        self.session = context.get('session')
+        self.tables = {
+            'staging': self.staging,
+            'municipality': table(Municipality),
+            'postcode': table(PostCode),
+            'group': table(Group),
+            'housenumber': table(HouseNumber),
+            'position': table(Position),
+        }
+
+    def __enter__(self):
+        self.database.execute_sql(
+            'CREATE UNLOGGED TABLE {} (line bigserial, data jsonb)'.format(
+                self.staging))
+        return self
+
+    def __exit__(self, *args):
+        self.database.execute_sql('DROP TABLE IF EXISTS {}'.format(
+            self.staging))
+
+    def copy(self, path, limit=0):
+        lines = (l for l in helpers.iter_file(path) if l.strip())
+        if limit:
+            lines = islice(lines, limit)
+        # Use control chars as quote and delimiter, so the JSON is passed
+        # as is to PostgreSQL, without any escaping.
+        sql = ("COPY {} (data) FROM STDIN WITH (FORMAT csv, "
+               "QUOTE e'\\x01', DELIMITER e'\\x02')".format(self.staging))
+        reader = LineReader(lines)
+        with self.database.atomic():
+            self.database.get_cursor().copy_expert(sql, reader)
+        return reader.count
+
+    def prepare(self):
+        self.database.execute_sql(
+            "CREATE INDEX ON {} ((data->>'type'))".format(self.staging))
+        self.database.execute_sql('ANALYZE {}'.format(self.staging))
+
+    def version_data(self, model, alias):
+        """SQL expression matching `model.as_version` for a freshly created
+        row of `alias`."""
+        items = []
+        params = []
+        for name in model.versioned_fields:
+            field = getattr(model, name)
+            if name == 'status':
+                expr = "'\"active\"'::jsonb"
+            elif name in ('created_by', 'modified_by'):
+                expr = '%s::jsonb'
+                params.append(dumps(self.session.serialize()))
+            elif name in ('created_at', 'modified_at'):
+                expr = '%s::jsonb'
+                params.append(dumps(self.now))
+            elif isinstance(field, (db.ManyToManyField,
+                                    peewee.ReverseRelationDescriptor)):
+                # Nothing can be linked to a resource that is being created.
+                expr = "'[]'::jsonb"
+            elif isinstance(field, db.ForeignKeyField):
+                expr = '(SELECT to_jsonb(r.id) FROM {} r WHERE r.pk = {}.{})'
+                expr = expr.format(table(field.rel_model), alias,
+                                   field.db_column)
+            elif isinstance(field, db.PointField):
+                expr = 'ST_AsGeoJSON({}.{})::jsonb'.format(alias,
+                                                           field.db_column)
+            elif isinstance(field, db.HStoreField):
+                expr = 'hstore_to_jsonb({}.{})'.format(alias, field.db_column)
+            else:
+                expr = 'to_jsonb({}.{})'.format(alias, field.db_column)
+            items.append("'{}', {}".format(name, expr))
+        return 'jsonb_build_object({})'.format(', '.join(items)), params
+
+    def work_table(self, level):
+        return 'import_{}_{}'.format(level.name, os.getpid())
+
+    def load(self, level):
+        work = self.work_table(level)
+        model = level.model
+        sql = level.sql.format(**dict(self.tables, **level.extra))
+        self.database.execute_sql('DROP TABLE IF EXISTS {}'.format(work))
+        self.database.execute_sql('CREATE UNLOGGED TABLE {} AS {}'.format(
+            work, sql))
+        ids = self.stage_ids(level)
+        data, params = self.version_data(model, 'i')
+        verbose = context.get('reporter').verbosity >= reporter.NOTICE
+        returning = 'i.{}'.format(level.key) if verbose else 'count(*)'
+        columns = ', '.join(level.columns)
+        sql = """
+        WITH inserted AS (
+            INSERT INTO {table} ({columns}, id, version, created_at,
+                                 created_by_id, modified_at, modified_by_id)
+            SELECT {columns}, ids.resource_id, 1, %s, %s, %s, %s
+            FROM (SELECT *, row_number() OVER (ORDER BY line) AS rank
+                  FROM {work} WHERE ready) w
+            JOIN {ids} ids ON ids.rank = w.rank
+            ORDER BY w.line
+            RETURNING *
+        ), versions AS (
+            INSERT INTO {version} (model_name, model_pk, sequential, data,
+                                   period)
+            SELECT '{name}', i.pk, 1, {data}, tstzrange(%s, NULL, '[)')
+            FROM inserted i
+        )
+        SELECT {returning} FROM inserted i
+        """.format(table=table(model), columns=columns, name=level.name,
+                   work=work, ids=ids, version=table(Version), data=data,
+                   returning=returning)
+        params = ([self.now, self.session.pk, self.now, self.session.pk]
+                  + params + [self.now])
+        with self.database.atomic():
+            cursor = self.database.execute_sql(sql, params)
+            if verbose:
+                for key, in cursor:
+                    reporter.notice(level.message, key)
+            else:
+                total = cursor.fetchone()[0]
+                if total:
+                    context.get('reporter').merge({
+                        reporter.NOTICE: {level.message: total}})
+
+    def stage_ids(self, level):
+        """COPY one id per ready row of the work table, made by the model
+        `make_id`, numbered by rank of the row in file order."""
+        work = self.work_table(level)
+        ids = '{}_ids'.format(work)
+        count = self.database.execute_sql(
+            'SELECT count(*) FROM {} WHERE ready'.format(work)).fetchone()[0]
+        self.database.execute_sql('DROP TABLE IF EXISTS {}'.format(ids))
+        self.database.execute_sql(
+            'CREATE UNLOGGED TABLE {} (rank bigint PRIMARY KEY, '
+            'resource_id text)'.format(ids))
+        lines = ('{}\t{}'.format(rank, level.model.make_id())
+                 for rank in range(1, count + 1))
+        with self.database.atomic():
+            self.database.get_cursor().copy_from(
+                LineReader(lines), ids, columns=('rank', 'resource_id'))
+        return ids
+
+    def rejected(self, level):
+        """Rows that could not be inserted set-based, in file order."""
+        work = self.work_table(level)
+        sql = 'SELECT data FROM {} WHERE NOT ready ORDER BY line'.format(work)
+        with self.database.transaction():
+            cursor = self.database.execute_sql(sql, named_cursor=True)
+            for data, in cursor:
+                yield data
+
+    def count_rejected(self, level):
+        sql = 'SELECT count(*) FROM {} WHERE NOT ready'.format(
+            self.work_table(level))
+        return self.database.execute_sql(sql).fetchone()[0]
+
+    def drop(self, level):
+        work = self.work_table(level)
+        self.database.execute_sql('DROP TABLE IF EXISTS {}, {}_ids'.format(
+            work, work))
+
+
+@helpers.session
+def load(paths, process_row, limit=0):
+    with Loader() as loader:
+        for path in paths:
+            print('Staging', path)
+            total = loader.copy(path, limit=limit)
+            print('Staged {} rows'.format(total))
+        loader.prepare()
+        for level in LEVELS:
+            print('Loading', level.name)
+            try:
+                loader.load(level)
+                total = loader.count_rejected(level)
+                if total:
+                    print('Replaying {} rows'.format(total))
+                    with cache.shared():
+                        helpers.batch(process_row, loader.rejected(level),
+                                      chunksize=100, total=total)
+            finally:
+                loader.drop(level)
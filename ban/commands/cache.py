@@ -0,0 +1,171 @@
+"""
+Import scoped lookup tables.
+
+Resolving a row reference (municipality insee, postcode, group or
+housenumber identifier) costs a database round trip, while it's needed for
+almost every imported row. The cache preloads those identifiers, and is kept
+up to date as rows are created, so resolving a reference becomes a lookup in
+memory. Identifiers maps are IdentifierMap instances, as there are tens of
+millions of them (CIA, IGN…). References given to `coerce` by the import
+threads resolve through the cache too (see `attach`).
+
+In process mode, the tables are built once by the parent process, dumped to
+files and memory-mapped (read-only) by every worker: memory does not grow
+with the number of workers. Rows created by a worker are only known by this
+worker, so in this mode a miss is checked against the database.
+"""
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from ban.core import config, context
+from ban.core.models import Group, HouseNumber, Municipality, PostCode
+from ban.db import IdentifierMap
+
+_lock = threading.Lock()
+_cache = None
+
+
+def postcode_key(code, insee):
+    return '{}:{}'.format(code, insee)
+
+
+class ReferenceCache:
+
+    models = {
+        Municipality: ['insee'],
+        Group: Group.identifiers,
+        HouseNumber: HouseNumber.identifiers,
+    }
+
+    def __init__(self, complete=True):
+        self.maps = {(model, identifier): IdentifierMap()
+                     for model, identifiers in self.models.items()
+                     for identifier in identifiers}
+        self.postcodes = IdentifierMap()
+        # Does this cache see every row created during the import?
+        self.complete = complete
+
+    @staticmethod
+    def filename(model, identifier):
+        return '{}-{}.idmap'.format(model.__name__.lower(), identifier)
+
+    def preload(self):
+        for model, identifier in self.maps:
+            field = getattr(model, identifier)
+            self.maps[(model, identifier)] = IdentifierMap.from_field(
+                field, model.deleted_at.is_null())
+        qs = (PostCode.select(PostCode.pk, PostCode.code, Municipality.insee)
+                      .join(Municipality).tuples())
+        postcodes = ((postcode_key(code, insee), pk)
+                     for pk, code, insee in qs.iterator())
+        self.postcodes = IdentifierMap.build(sorted(postcodes))
+        return self
+
+    def dump(self, path):
+        path = Path(path)
+        for (model, identifier), idmap in self.maps.items():
+            idmap.dump(path / self.filename(model, identifier))
+        self.postcodes.dump(path / 'postcode.idmap')
+
+    @classmethod
+    def load(cls, path):
+        """Attach to tables dumped by another process."""
+        path = Path(path)
+        cache = cls(complete=False)
+        for model, identifier in cache.maps:
+            idmap = IdentifierMap.load(path / cls.filename(model, identifier))
+            cache.maps[(model, identifier)] = idmap
+        cache.postcodes = IdentifierMap.load(path / 'postcode.idmap')
+        return cache
+
+    def get(self, model, identifier, value):
+        """Return the pk of the `model` instance matching `identifier`, or
+        None."""
+        idmap = self.maps.get((model, identifier))
+        if not value or idmap is None:
+            return None
+        pk = idmap.get(value)
+        if pk is None and not self.complete:
+            # May have been created by another worker.
+            pk = (model.select(model.pk)
+                       .where(getattr(model, identifier) == value).scalar())
+            if pk:
+                idmap[value] = pk
+        return pk
+
+    def postcode(self, code, insee):
+        key = postcode_key(code, insee)
+        pk = self.postcodes.get(key)
+        if pk is None and not self.complete:
+            pk = (PostCode.select(PostCode.pk).join(Municipality)
+                          .where(PostCode.code == code,
+                                 Municipality.insee == insee).scalar())
+            if pk:
+                self.postcodes[key] = pk
+        return pk
+
+    def add(self, instance):
+        model = instance.__class__
+        if model is PostCode:
+            key = postcode_key(instance.code, instance.municipality.insee)
+            self.postcodes[key] = instance.pk
+            return
+        for identifier in self.models.get(model, []):
+            value = getattr(instance, identifier)
+            if value:
+                self.maps[(model, identifier)][value] = instance.pk
+
+
+def get():
+    """Return the current process cache, loading it on first call."""
+    global _cache
+    if _cache is None:
+        with _lock:
+            if _cache is None:
+                path = config.get('REFERENCES_PATH')
+                if path:
+                    _cache = ReferenceCache.load(path)
+                else:
+                    # A process not forked from the one running the import
+                    # (eg. spawned) does not see the rows of its siblings.
+                    complete = config.get('BATCH_EXECUTOR') != 'process'
+                    _cache = ReferenceCache(complete=complete).preload()
+    return _cache
+
+
+def attach():
+    """Let `coerce` resolve identifiers through the cache, in the current
+    thread only: out of an import, identifiers are always checked against
+    the database."""
+    context.set('references', get())
+
+
+def reset():
+    global _cache
+    context.set('references', None)
+    _cache = None
+
+
+@contextmanager
+def shared():
+    """Build the tables from the current database state, once for all the
+    workers of the batch to come."""
+    reset()
+    if config.get('BATCH_EXECUTOR') != 'process':
+        # Threads share the process cache.
+        try:
+            yield get()
+        finally:
+            reset()
+        return
+    with tempfile.TemporaryDirectory(prefix='ban-references-') as path:
+        ReferenceCache().preload().dump(path)
+        config.set('REFERENCES_PATH', path)
+        try:
+            # Forked workers inherit the parent mapping, others load it.
+            yield get()
+        finally:
+            reset()
+            config.pop('REFERENCES_PATH', None)
@@ -1,7 +1,15 @@
+import gzip
+import re
+from datetime import date
+from pathlib import Path
+
 from ban.auth import models as amodels
 from ban.commands import command, reporter
+from ban.core import config
 from ban.core import models as cmodels
-from ban.core.versioning import Diff, Version, Redirect, Flag
+from ban.core.jobs import Job
+from ban.core.versioning import BaseVersioned, Diff, Version, Redirect, Flag
+from ban.utils import apply_delta, make_delta, utcnow
 
 from . import helpers
 
@@ -9,7 +17,7 @@ models = [Version, Diff, Redirect, amodels.User, amodels.Client,
           amodels.Grant, amodels.Session, amodels.Token, cmodels.Municipality,
           cmodels.PostCode, cmodels.Group, cmodels.HouseNumber,
           cmodels.HouseNumber.ancestors.get_through_model(),
-          cmodels.Position, Flag]
+          cmodels.Position, Flag, Job]
 
 
 @command
@@ -45,3 +53,259 @@ def truncate(*names, force=False, **kwargs):
             continue
         model.delete().execute()
         reporter.notice('Truncated', name)
+
+
+# Schema changes for databases created before them, in order, as (sql,
+# missing): when given, the `missing` query tells whether the change is still
+# to be done (IF NOT EXISTS clauses need PostgreSQL 9.5 or 9.6).
+MIGRATIONS = [
+    # Versions stored as deltas (see `Version.is_keyframe`).
+    ('ALTER TABLE "{version}" ADD COLUMN delta jsonb',
+     "SELECT NOT EXISTS (SELECT 1 FROM information_schema.columns "
+     "WHERE table_schema = current_schema() AND table_name = '{version}' "
+     "AND column_name = 'delta')"),
+    ('ALTER TABLE "{version}" ALTER COLUMN data DROP NOT NULL', None),
+    # Time travel queries (see `Version.at`).
+    ('CREATE INDEX "{version}_period" ON "{version}" USING GiST (period)',
+     "SELECT to_regclass('\"{version}_period\"') IS NULL"),
+]
+
+
+@command
+def migrate(**kwargs):
+    """Update the schema of an existing database. Can be run many times."""
+    database = Version._meta.database
+    version = Version._meta.db_table
+    with database.atomic():
+        for model in models:
+            if not model.table_exists():
+                model.create_table()
+                reporter.notice('Created', model.__name__)
+        for sql, missing in MIGRATIONS:
+            if missing and not database.execute_sql(
+                    missing.format(version=version)).fetchone()[0]:
+                continue
+            database.execute_sql(sql.format(version=version))
+    reporter.notice('Migrated', database.database)
+
+
+@command
+def compact(keyframe=0, **kwargs):
+    """Store versions history as deltas, with a full document only every
+    VERSION_KEYFRAME versions. Needs `db:migrate` on databases created
+    before deltas.
+
+    keyframe    Keep a full document every `keyframe` versions.
+    """
+    if keyframe:
+        config.set('VERSION_KEYFRAME', keyframe)
+    qs = (Version.select(Version.model_name, Version.model_pk)
+                 .distinct().tuples())
+    helpers.batch(compact_resource, qs.iterator(), total=qs.count())
+
+
+def compact_resource(key):
+    model_name, model_pk = key
+    versions = Version.select().where(Version.model_name == model_name,
+                                      Version.model_pk == model_pk)
+    previous = None
+    with Version._meta.database.atomic():
+        for version in versions.order_by(Version.sequential):
+            if version.snapshot is not None:
+                document = version.snapshot
+            else:
+                document = apply_delta(previous, version.delta)
+            if previous is None or Version.is_keyframe(version.sequential):
+                stored = (document, None)
+            else:
+                stored = (None, make_delta(previous, document))
+            if stored != (version.snapshot, version.delta):
+                version.snapshot, version.delta = stored
+                version.save(only=[Version.snapshot, Version.delta])
+                reporter.notice('Compacted version', version)
+            previous = document
+
+
+def add_months(day, months):
+    month = day.month - 1 + months
+    return date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def is_partitioned(database, name):
+    sql = "SELECT relkind = 'p' FROM pg_class WHERE oid = %s::regclass"
+    return database.execute_sql(sql, ['"{}"'.format(name)]).fetchone()[0]
+
+
+def partitions(database, name):
+    sql = ('SELECT c.relname FROM pg_inherits i '
+           'JOIN pg_class c ON c.oid = i.inhrelid '
+           'WHERE i.inhparent = %s::regclass ORDER BY c.relname')
+    cursor = database.execute_sql(sql, ['"{}"'.format(name)])
+    return [row[0] for row in cursor.fetchall()]
+
+
+def unpartition(database, name, key, method):
+    """Replace the table `name` by an empty partitioned table, and return the
+    name of the original one, to be copied and dropped once partitions
+    exist."""
+    old = '{}_unpartitioned'.format(name)
+    sql = [
+        'ALTER TABLE "{name}" RENAME TO "{old}"',
+        'CREATE TABLE "{name}" (LIKE "{old}" INCLUDING DEFAULTS) '
+        'PARTITION BY {method} ({key})',
+        # Unique constraints must include the partition key.
+        'ALTER TABLE "{name}" ADD PRIMARY KEY (pk, {key})',
+        # Keep the pk sequence when dropping the old table.
+        'ALTER SEQUENCE "{name}_pk_seq" OWNED BY "{name}".pk',
+    ]
+    for statement in sql:
+        database.execute_sql(statement.format(name=name, old=old, key=key,
+                                              method=method))
+    return old
+
+
+def fill(database, name, old):
+    database.execute_sql('INSERT INTO "{}" SELECT * FROM "{}"'.format(name,
+                                                                     old))
+    database.execute_sql('DROP TABLE "{}"'.format(old))
+
+
+def add_month_partition(database, name, month):
+    """Create the partition of the diff table `name` for `month`, moving
+    there the rows of this month the default partition already holds."""
+    partition = '{}_{:%Y_%m}'.format(name, month)
+    sql = 'SELECT to_regclass(%s)'
+    if database.execute_sql(sql, ['"{}"'.format(partition)]).fetchone()[0]:
+        return
+    bounds = [month, add_months(month, 1)]
+    database.execute_sql('CREATE TABLE "{}" (LIKE "{}" INCLUDING DEFAULTS)'
+                         .format(partition, name))
+    # Attaching fails while the default partition has rows in the range.
+    database.execute_sql(
+        'WITH moved AS (DELETE FROM "{0}_default" WHERE created_at >= %s '
+        'AND created_at < %s RETURNING *) '
+        'INSERT INTO "{1}" SELECT * FROM moved'.format(name, partition),
+        bounds)
+    database.execute_sql('ALTER TABLE "{}" ATTACH PARTITION "{}" FOR VALUES '
+                         'FROM (%s) TO (%s)'.format(name, partition), bounds)
+
+
+@command
+def partition(ahead=3, drop_constraints=False, **kwargs):
+    """Convert diff and version tables to partitioned tables (diff by month
+    of creation, version by model), or add the partitions of the coming
+    months if already done. Needs PostgreSQL 11+.
+
+    ahead               Number of months of diff partitions to create ahead.
+    drop_constraints    Drop the foreign keys to version (needed to convert).
+    """
+    database = Diff._meta.database
+    today = utcnow().date()
+    with database.atomic():
+        old_version = None
+        version = Version._meta.db_table
+        if not is_partitioned(database, version):
+            # Foreign keys can't target a partitioned table without its
+            # partition key.
+            sql = ('SELECT conrelid::regclass, conname FROM pg_constraint '
+                   'WHERE confrelid = %s::regclass')
+            cursor = database.execute_sql(sql, ['"{}"'.format(version)])
+            constraints = cursor.fetchall()
+            if constraints and not drop_constraints:
+                helpers.abort('Foreign keys to {} would be dropped: {}. Use '
+                              '--drop-constraints to proceed.'.format(
+                                version, ', '.join(c for _, c in constraints)))
+            for table, constraint in constraints:
+                database.execute_sql('ALTER TABLE {} DROP CONSTRAINT "{}"'
+                                     .format(table, constraint))
+                reporter.warning('Dropped constraint',
+                                 '{}.{}'.format(table, constraint))
+            old_version = unpartition(database, version, 'model_name', 'LIST')
+            database.execute_sql(
+                'CREATE UNIQUE INDEX ON "{0}" (model_name, model_pk, '
+                'sequential)'.format(version))
+            database.execute_sql('CREATE INDEX ON "{}" USING GiST '
+                                 '(period)'.format(version))
+        for name, model in sorted(BaseVersioned.registry.items()):
+            if model.__subclasses__():  # Abstract model.
+                continue
+            database.execute_sql(
+                'CREATE TABLE IF NOT EXISTS "{0}_{1}" PARTITION OF "{0}" '
+                'FOR VALUES IN (%s)'.format(version, name), [name])
+        database.execute_sql('CREATE TABLE IF NOT EXISTS "{0}_default" '
+                             'PARTITION OF "{0}" DEFAULT'.format(version))
+        if old_version:
+            fill(database, version, old_version)
+            reporter.notice('Partitioned', version)
+
+        old_diff = None
+        diff = Diff._meta.db_table
+        start = today
+        if not is_partitioned(database, diff):
+            old_diff = unpartition(database, diff, 'created_at', 'RANGE')
+            for column in ('old_id', 'new_id'):
+                database.execute_sql('CREATE INDEX ON "{}" ({})'.format(
+                    diff, column))
+        # Diffs created after the last monthly partition still have a place
+        # to go, until the command is run again.
+        database.execute_sql('CREATE TABLE IF NOT EXISTS "{0}_default" '
+                             'PARTITION OF "{0}" DEFAULT'.format(diff))
+        # Start from the oldest diff without a monthly partition.
+        sql = 'SELECT min(created_at) FROM "{}"'.format(
+            old_diff or '{}_default'.format(diff))
+        first = database.execute_sql(sql).fetchone()[0]
+        if first and first.date() < start:
+            start = first.date()
+        month = date(start.year, start.month, 1)
+        while month <= add_months(today, ahead):
+            add_month_partition(database, diff, month)
+            month = add_months(month, 1)
+        if old_diff:
+            fill(database, diff, old_diff)
+            reporter.notice('Partitioned', diff)
+        sql = 'SELECT count(*) FROM "{}_default"'.format(diff)
+        count = database.execute_sql(sql).fetchone()[0]
+        if count:
+            reporter.warning('Diffs in default partition', count)
+
+
+@command
+def archive(*names, before='', path='.', drop=False, **kwargs):
+    """Export partitions to compressed NDJSON files, then detach them.
+
+    names   Names of the partitions to archive (eg. diff_2016_01).
+    before  Also archive the diff partitions of the months before (YYYY-MM).
+    path    Directory where to write the archives.
+    drop    Drop the partitions once archived, instead of detaching them.
+    """
+    database = Diff._meta.database
+    names = list(names)
+    if before:
+        diff = Diff._meta.db_table
+        pattern = re.compile(r'^{}_(\d{{4}})_(\d{{2}})$'.format(diff))
+        for name in partitions(database, diff):
+            match = pattern.match(name)
+            if match and '{}-{}'.format(*match.groups()) < before:
+                names.append(name)
+    for name in names:
+        target = Path(path) / '{}.ndjson.gz'.format(name)
+        sql = ('SELECT inhparent::regclass FROM pg_inherits '
+               'WHERE inhrelid = %s::regclass')
+        parent = database.execute_sql(sql, ['"{}"'.format(name)]).fetchone()
+        if not parent:
+            helpers.abort('Not a partition: {}'.format(name))
+        with database.atomic():
+            # Server side cursor, not to load the whole partition in memory.
+            cursor = database.get_conn().cursor(name='archive')
+            cursor.itersize = 10000
+            cursor.execute('SELECT row_to_json(t)::text FROM "{}" t'.format(
+                name))
+            with gzip.open(str(target), 'wt', encoding='utf-8') as f:
+                for row, in cursor:
+                    f.write(row + '\n')
+            cursor.close()
+            database.execute_sql('ALTER TABLE {} DETACH PARTITION "{}"'
+                                 .format(parent[0], name))
+            if drop:
+                database.execute_sql('DROP TABLE "{}"'.format(name))
+        reporter.notice('Archived', str(target))
@@ -4,18 +4,32 @@ from ban.commands import command, reporter
 
 from ban.core import models
 from ban.core.encoder import dumps
+from ban.core.versioning import History
+from ban.utils import parse_datetime
+
+from . import helpers
 
 
 @command
-def resources(path, **kwargs):
+def resources(path, at='', **kwargs):
     """Export database as resources in json stream format.
 
     path    path of file where to write resources
+    at      export resources as they were at this datetime
     """
+    if at:
+        try:
+            at = parse_datetime(at)
+        except ValueError:
+            helpers.abort('Invalid datetime: {}'.format(at))
     resources = [models.PostCode, models.Municipality, models.Group,
                  models.HouseNumber]
     with Path(path).open(mode='w', encoding='utf-8') as f:
         for resource in resources:
-            for data in resource.select().serialize({'*': {}}):
+            if at:
+                rows = History(resource, at)
+            else:
+                rows = resource.select().serialize({'*': {}})
+            for data in rows:
                 f.write(dumps(data) + '\n')
                 reporter.notice(resource.__name__, data)
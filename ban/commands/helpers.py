@@ -1,21 +1,30 @@
 import csv
 from datetime import timedelta
 import getpass
-from itertools import repeat
+import heapq
+import io
+import json
+from itertools import groupby, islice
 import os
 import pkgutil
 import sys
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
 from importlib import import_module
 from pathlib import Path
 
 import decorator
+import peewee
 from progressist import ProgressBar
 
 from ban.auth.models import Session, User
+from ban.commands import reporter as report
 from ban.commands.reporter import Reporter
 from ban.core import context, config
-from ban.core.versioning import Diff
+from ban.core.versioning import Diff, Version
 
 
 def load_commands():
@@ -29,20 +38,43 @@ def load_commands():
 
 
 def load_csv(path_or_file, encoding='utf-8'):
+    """Iterate over the rows of a CSV file, as dicts.
+
+    The dialect is sniffed from the first block, then rows are read lazily,
+    so `path_or_file` may be a stream (eg. an upload)."""
     if isinstance(path_or_file, (str, Path)):
-        path = Path(path_or_file)
-        if not path.exists():
-            abort('Path does not exist: {}'.format(path))
-        path_or_file = path.open(encoding=encoding)
+        path_or_file = open_csv(path_or_file, encoding)
     extract = path_or_file.read(4096)
     try:
         dialect = csv.Sniffer().sniff(extract)
     except csv.Error:
         dialect = csv.unix_dialect()
-    path_or_file.seek(0)
-    content = path_or_file.read()
-    path_or_file.close()
-    return csv.DictReader(content.splitlines(), dialect=dialect)
+    return csv.DictReader(iter_lines(extract, path_or_file), dialect=dialect)
+
+
+def open_csv(path, encoding='utf-8'):
+    path = Path(path)
+    if not path.exists():
+        abort('Path does not exist: {}'.format(path))
+    return path.open(encoding=encoding, newline='')
+
+
+def iter_lines(head, f):
+    """Iterate over the lines of `f`, whose `head` has already been read."""
+    last = ''
+    with f:
+        for line in io.StringIO(head, newline=''):
+            if line.endswith(('\n', '\r')):
+                yield line
+            else:
+                last = line
+        for line in f:
+            if last:
+                line = last + line
+                last = ''
+            yield line
+    if last:
+        yield last
 
 
 def iter_file(path, formatter=lambda x: x):
@@ -54,6 +86,153 @@ def iter_file(path, formatter=lambda x: x):
             yield formatter(l)
 
 
+class Source:
+    """Iterate over the lines of a file, tracking the position (in bytes)
+    of the next line to be read."""
+
+    def __init__(self, path, formatter=lambda x: x, position=0):
+        self.path = Path(path)
+        if not self.path.exists():
+            abort('Path does not exist: {}'.format(self.path))
+        self.formatter = formatter
+        self.position = position
+
+    @property
+    def size(self):
+        return self.path.stat().st_size
+
+    def __iter__(self):
+        with self.path.open('rb') as f:
+            f.seek(self.position)
+            for line in f:
+                self.position += len(line)
+                yield self.formatter(line.decode())
+
+
+class Rows:
+    """Iterate over `rows`, tracking the index of the next row to be read."""
+
+    def __init__(self, rows, position=0):
+        self.rows = islice(rows, position, None)
+        self.position = position
+
+    def __iter__(self):
+        for row in self.rows:
+            self.position += 1
+            yield row
+
+
+class Checkpoint:
+    """Progress of the import of `path`.
+
+    The saved position is the one of the first row not committed yet: rows
+    are committed out of order, so some rows after it may be replayed on
+    resume.
+    The progress is only saved when `durable` or when the CHECKPOINT_DIR
+    setting is set, in that directory if any, else next to `path`. The size
+    and modification time of `path` are saved too, so a changed file is not
+    skipped nor resumed.
+    Only the reports of this file are saved: the reporter is shared by all
+    the files of a run."""
+
+    def __init__(self, path, durable=False):
+        path = Path(path)
+        directory = config.get('CHECKPOINT_DIR')
+        if directory:
+            # Files with the same name may come from different directories.
+            key = zlib.crc32(str(path.resolve()).encode())
+            name = '{}-{:x}.checkpoint'.format(path.name, key)
+            self.path = Path(directory) / name
+        else:
+            self.path = Path('{}.checkpoint'.format(path))
+        self.durable = durable or bool(directory)
+        self.source_path = str(path)
+        self.source = None
+        self.rows = 0
+        self.done = False
+        self.reading = []  # Heap of positions of rows not committed yet.
+        self.committed = set()
+        # Reports of the previous files, not to be saved with this one.
+        reporter = context.get('reporter')
+        self.baseline = reporter.counters() if reporter else {}
+
+    @property
+    def stat(self):
+        stat = os.stat(self.source_path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def load(self):
+        """Return saved state, if any and if the file has not changed since.
+        """
+        if not self.path.exists():
+            return None
+        with self.path.open() as f:
+            state = json.load(f)
+        stat = self.stat
+        if any(state.get(key) != value for key, value in stat.items()):
+            report.warning('File changed since checkpoint, ignoring it',
+                           self.source_path)
+            return None
+        self.rows = state['rows']
+        self.done = state['done']
+        return state
+
+    def track(self, source):
+        """Iterate over `source` rows, as (position, row)."""
+        self.source = source
+        position = source.position
+        for row in source:
+            if row:
+                heapq.heappush(self.reading, position)
+                yield position, row
+            position = source.position
+
+    @property
+    def position(self):
+        while self.reading and self.reading[0] in self.committed:
+            self.committed.remove(heapq.heappop(self.reading))
+        if self.reading:
+            return self.reading[0]
+        return self.source.position if self.source else 0
+
+    def commit(self, positions, reporter):
+        self.committed.update(positions)
+        self.rows += len(positions)
+        self.save(reporter)
+
+    def reports(self, reporter):
+        """Counters added to `reporter` since this checkpoint creation."""
+        reports = {}
+        for level, msgs in reporter.counters().items():
+            before = self.baseline.get(level, {})
+            counts = {msg: count - before.get(msg, 0)
+                      for msg, count in msgs.items()
+                      if count > before.get(msg, 0)}
+            if counts:
+                reports[level] = counts
+        return reports
+
+    def save(self, reporter, done=False):
+        self.done = done
+        if not self.durable:
+            return
+        state = {
+            'path': self.source_path,
+            'position': self.position,
+            'rows': self.rows,
+            'done': done,
+            'reports': self.reports(reporter),
+        }
+        state.update(self.stat)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with tmp.open('w') as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(tmp), str(self.path))
+
+
 def abort(msg):
     sys.stderr.write("\n" + msg)
     sys.exit(1)
@@ -64,47 +243,204 @@ class Bar(ProgressBar):
                 '| ETA: {eta} | {elapsed}')
 
 
-def collect_report(func, *args, **kwargs):
+class FileBar(Bar):
+    """Progress in bytes of a file, as given by the `position` callable, so
+    the file does not need to be read once more to count its lines."""
+    template = ('Progress: |{animation}| {percent} ({done:B}/{total:B}) '
+                '| {rows} rows ({rate}/s) | ETA: {eta} | {elapsed}')
+    rows = 0
+
+    def __init__(self, size, position, **kwargs):
+        super().__init__(total=size, **kwargs)
+        self.position = position
+
+    @property
+    def rate(self):
+        elapsed = time.time() - self.start if self.start else 0
+        return int(self.rows / elapsed) if elapsed else 0
+
+    def __call__(self, step=1):
+        self.rows += step
+        self.update(step=0, done=self.position())
+
+
+def collect_report(func, chunk, group_commit=0, session=None):
     # This is a process reporter instance.
     reporter = context.get('reporter')
     if not reporter:
         # In thread mode, reporter is not shared with subthreads.
         reporter = Reporter(config.get('VERBOSE'))
         context.set('reporter', reporter)
-    func(*args, **kwargs)
+    if session:
+        # Nor is the session: rows are created on behalf of the caller's
+        # one (eg. a job's), not of a new admin session.
+        context.set('session', session)
+    if group_commit:
+        for group in chunks(chunk, group_commit):
+            commit(func, group)
+    else:
+        for item in chunk:
+            func(item)
     reports = reporter._reports.copy()
     reporter.clear()
     return reports
 
 
-def batch(func, iterable, chunksize=1000, total=None, progress=True):
+def commit(func, items):
+    """Run `func` on every item in one transaction, each item in its own
+    savepoint, so an error only rolls back the failing item.
+
+    Versions of the saved instances are stored at once, at the end. If this
+    fails, the whole group is rolled back, and its items are committed one
+    by one, so only the culprit is lost."""
+    database = Diff._meta.database
+    reporter = context.get('reporter')
+    mark = reporter.mark() if reporter else None
+    try:
+        with database.atomic(), Version.deferred() as pending:
+            for item in items:
+                before = dict(pending)
+                try:
+                    with database.atomic():
+                        func(item)
+                except Exception as e:
+                    # Without a savepoint, the item would have been committed
+                    # (or failed) on its own: do not lose the group for it.
+                    pending.clear()
+                    pending.update(before)
+                    report_error(e, item)
+    except Exception as e:
+        # Reports of the rolled back items would be counted twice.
+        if reporter:
+            reporter.rewind(mark)
+        if len(items) == 1:
+            report_error(e, items[0])
+        else:
+            for item in items:
+                commit(func, [item])
+
+
+def report_error(error, item):
+    if isinstance(error, peewee.IntegrityError):
+        name = 'Integrity Error'
+    elif isinstance(error, peewee.DatabaseError):
+        name = 'Database Error'
+    else:
+        name = 'Error'
+    report.error(name, (str(error), item))
+
+
+def chunks(iterable, size):
+    iterable = (item for item in iterable if item)
+    return iter(lambda: list(islice(iterable, size)), [])
+
+
+def batch(func, iterable, chunksize=1000, total=None, progress=True,
+          group_commit=0, partition=None, checkpoint=None, barrier=None):
+    """Run `func` on each item of `iterable`, by chunks, in a pool of
+    workers.
+
+    The number of pending chunks is bounded, so the reader keeps a bit ahead
+    of the workers without loading the whole iterable in memory.
+    With `group_commit`, workers commit by groups of `group_commit` items
+    instead of one transaction per item.
+    With `partition`, a function returning the partition key of an item,
+    items are split in one partition per worker, and each partition has at
+    most one pending chunk: items with the same key are never processed
+    concurrently.
+    With `barrier`, a function returning the barrier key of an item, items
+    are only processed once all the items before the last change of key
+    are: eg. rows depending on rows of a previous level.
+    With `checkpoint`, `iterable` must come from `checkpoint.track`, and the
+    checkpoint is saved after each processed chunk.
+    `progress` may be a callable, eg. a FileBar, called with the size of
+    each processed chunk.
+    Workers run with the session of the caller, if any."""
     # This is the main reporter instance.
     reporter = context.get('reporter')
+    session = context.get('session')
     pool = (ProcessPoolExecutor if config.get('BATCH_EXECUTOR') == 'process'
             else ThreadPoolExecutor)
-    bar = Bar(total=total, throttle=timedelta(seconds=1))
+    if callable(progress):
+        bar = progress
+    else:
+        bar = Bar(total=total or 0, throttle=timedelta(seconds=1))
     workers = int(config.get('WORKERS', os.cpu_count()))
-    chunk = []
-    count = 0
+    chunksize = max(chunksize, group_commit)
+    pending = {}
+    if not checkpoint:
+        iterable = ((None, item) for item in iterable if item)
+
+    def submit(chunk, key=None):
+        positions, items = zip(*chunk)
+        future = executor.submit(collect_report, func, list(items),
+                                 group_commit, session)
+        pending[future] = (key, positions)
 
-    def loop():
-        for reports in executor.map(collect_report, repeat(func), chunk):
-            reporter.merge(reports)
+    def collect(futures):
+        for future in futures:
+            reporter.merge(future.result())
+            key, positions = pending.pop(future)
+            if checkpoint:
+                checkpoint.commit(positions, reporter)
             if progress:
-                bar()
+                bar(step=len(positions))
 
+    def wait_any():
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        collect(done)
+
+    segments = [iterable]
+    if barrier:
+        segments = (segment for _, segment
+                    in groupby(iterable, key=lambda item: barrier(item[1])))
+
+    # One pool for all segments: only the pending chunks are waited for.
     with pool(max_workers=workers) as executor:
+        for segment in segments:
+            if partition:
+                partitioned(segment, partition, workers, chunksize, submit,
+                            wait_any, pending)
+            else:
+                for chunk in chunks(segment, chunksize):
+                    if len(pending) >= workers * 2:
+                        wait_any()
+                    submit(chunk)
+            collect(list(pending))
 
-        for item in iterable:
-            if not item:
-                continue
-            chunk.append(item)
-            count += 1
-            if count % 10000 == 0:
-                loop()
-                chunk = []
-        if chunk:
-            loop()
+
+def partitioned(iterable, partition, workers, chunksize, submit, wait_any,
+                pending):
+    # Items are (position, item) tuples.
+    buffers = defaultdict(list)
+    buffered = 0
+    # Max items waiting for their partition to be free.
+    limit = chunksize * workers * 2
+
+    def dispatch(minimum):
+        nonlocal buffered
+        busy = {key for key, positions in pending.values()}
+        for key, buffer in buffers.items():
+            if buffer and key not in busy and len(buffer) >= minimum:
+                chunk = buffer[:chunksize]
+                del buffer[:chunksize]
+                buffered -= len(chunk)
+                submit(chunk, key)
+
+    for item in iterable:
+        key = zlib.crc32(str(partition(item[1])).encode()) % workers
+        buffers[key].append(item)
+        buffered += 1
+        if len(buffers[key]) >= chunksize:
+            dispatch(chunksize)
+        while buffered >= limit:
+            dispatch(1)
+            if buffered >= limit:
+                wait_any()
+    while buffered:
+        dispatch(1)
+        if buffered:
+            wait_any()
 
 
 def prompt(text, default=..., confirmation=False, coerce=None, hidden=False):
@@ -192,9 +528,11 @@ def session(func, *args, **kwargs):
 @decorator.decorator
 def nodiff(func, *args, **kwargs):
     Diff.ACTIVE = False
-    res = func(*args, **kwargs)
-    Diff.ACTIVE = True
-    return res
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # Job workers keep running after a failed import.
+        Diff.ACTIVE = True
 
 
 def file_len(f):
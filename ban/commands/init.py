@@ -1,44 +1,121 @@
 import json
+from contextlib import closing
+from datetime import timedelta
+from itertools import islice
 
 import peewee
 
 from ban.commands import command, reporter
+from ban.core import context
 from ban.core.models import (Group, HouseNumber, Municipality, Position,
                              PostCode)
 from ban.utils import compute_cia
 
-from . import helpers
+from . import bulk as bulk_loader
+from . import cache, helpers
 
 __namespace__ = 'import'
 
 
 @command
 @helpers.nodiff
-def init(*paths, limit=0, **kwargs):
+def init(*paths, limit=0, bulk=False, group_commit=0, resume=False,
+         **kwargs):
     """Initial import for real™.
 
-    paths   Paths to json files."""
-    for path in paths:
+    paths   Paths to json files.
+    bulk    Load with COPY and set-based SQL (only for resources creation).
+    group_commit    Commit rows by groups of this size (default: one by one).
+    resume  Save checkpoints, and resume from those of a previous run.
+    """
+    if bulk:
+        return bulk_loader.load(paths, process_row, limit=limit)
+    # References are loaded from the current database state.
+    with cache.shared():
+        processed = 0  # Highest level processed.
+        for path in sorted(paths, key=file_level):
+            processed = process_file(path, limit, group_commit, resume,
+                                     processed)
+
+
+# Rows of a level depend on rows of previous levels.
+LEVELS = ['municipality', 'postcode', 'group', 'housenumber', 'position']
+
+
+def level(row):
+    try:
+        return LEVELS.index(row.get('type'))
+    except ValueError:
+        return len(LEVELS)
+
+
+def file_level(path):
+    """Level of the first row of the file.
+
+    Files are processed in the order of their first level, so a file must
+    not have rows of a level lower than the ones of the previous files."""
+    rows = helpers.iter_file(path, formatter=json.loads)
+    with closing(rows):  # Close the file now, not when garbage collected.
+        return level(next(rows, {}))
+
+
+def leveled(rows, processed, levels):
+    """Collect the levels of `rows`, reporting the ones of a level lower
+    than `processed`: they may depend on rows of next files."""
+    for position, row in rows:
+        current = level(row)
+        if current < processed:
+            reporter.warning('Row of an already processed level', row)
+        levels.add(current)
+        yield position, row
+
+
+def partition(row):
+    """Rows of a same municipality go to the same worker."""
+    insee = row.get('municipality:insee') or row.get('insee')
+    if not insee:
+        reference = (row.get('group:fantoir') or row.get('fantoir')
+                     or row.get('housenumber:cia') or row.get('cia') or '')
+        insee = reference[:5]
+    return insee
+
+
+def process_file(path, limit=0, group_commit=0, resume=False, processed=0):
+    """Import the rows of `path`, and return the highest level processed."""
+    checkpoint = helpers.Checkpoint(path, durable=resume)
+    state = checkpoint.load() if resume else None
+    position = 0
+    if state:
+        context.get('reporter').restore(state['reports'])
+        if state['done']:
+            print('Already processed', path)
+            return max(processed, file_level(path))
+        position = state['position']
+        print('Resuming', path, 'after', state['rows'], 'rows')
+    else:
         print('Processing', path)
-        rows = helpers.iter_file(path, formatter=json.loads)
-        if limit:
-            print('Running with limit', limit)
-            extract = []
-            for i, row in enumerate(rows):
-                if i >= limit:
-                    break
-                extract.append(row)
-            rows = extract
-            total = limit
-        else:
-            print('Computing file size')
-            total = sum(1 for line in helpers.iter_file(path))
-            print('Done computing file size')
-        helpers.batch(process_row, rows, chunksize=100, total=total)
+    source = helpers.Source(path, formatter=json.loads, position=position)
+    levels = {processed}
+    rows = leveled(checkpoint.track(source), processed, levels)
+    if limit:
+        print('Running with limit', limit)
+        rows = islice(rows, limit)
+        progress = helpers.Bar(total=limit, throttle=timedelta(seconds=1))
+    else:
+        # Committed bytes.
+        progress = helpers.FileBar(source.size, lambda: checkpoint.position,
+                                   throttle=timedelta(seconds=1))
+    # A level must be fully processed before starting the next one.
+    helpers.batch(process_row, rows, chunksize=100, progress=progress,
+                  group_commit=group_commit, partition=partition,
+                  checkpoint=checkpoint, barrier=level)
+    checkpoint.save(context.get('reporter'), done=True)
+    return max(levels)
 
 
 @helpers.session
 def process_row(row):
+    cache.attach()
     kind = row.pop('type')
     if kind == "municipality":
         return process_municipality(row)
@@ -59,7 +136,7 @@ def process_municipality(row):
     validator = Municipality.validator(**row)
     if validator.errors:
         return reporter.error('Municipality errors', validator.errors)
-    validator.save()
+    cache.get().add(validator.save())
     reporter.notice('Imported Municipality', row['insee'])
 
 
@@ -74,6 +151,24 @@ def populate(keys, source, dest):
             dest[dest_key] = source[key]
 
 
+def find(model, identifier, value):
+    """Get instance through the references cache.
+
+    A miss is checked against the database, unless the cache sees every row
+    created by the import (see `ReferenceCache.get`). A hit is checked too,
+    as the identifier may have moved to another row since."""
+    field = getattr(model, identifier)
+    pk = cache.get().get(model, identifier, value)
+    if pk:
+        instance = model.first(model.pk == pk, field == value)
+        if instance:
+            return instance
+        instance = model.first(field == value)
+        if instance:
+            cache.get().add(instance)
+        return instance
+
+
 def process_group(row):
     data = dict(version=1)
     keys = ['name', ('group', 'kind'), 'laposte', 'ign', 'fantoir']
@@ -93,11 +188,11 @@ def process_group(row):
     fantoir = data.get('fantoir')
     laposte = data.get('laposte')
     if fantoir:
-        instance = Group.first(Group.fantoir == fantoir)
+        instance = find(Group, 'fantoir', fantoir)
     elif ign:
-        instance = Group.first(Group.ign == ign)
+        instance = find(Group, 'ign', ign)
     elif laposte:
-        instance = Group.first(Group.laposte == laposte)
+        instance = find(Group, 'laposte', laposte)
     else:
         reporter.error('Missing group unique id', row)
         return
@@ -117,10 +212,11 @@ def process_group(row):
         reporter.error('Invalid group data', (validator.errors, row))
     else:
         try:
-            validator.save()
+            group = validator.save()
         except peewee.IntegrityError:
             reporter.error('Integrity Error', fantoir)
         else:
+            cache.get().add(group)
             msg = 'Group updated' if instance else 'Group created'
             reporter.notice(msg, fantoir)
 
@@ -133,15 +229,16 @@ def process_postcode(row):
     code = row.get('postcode')
     data = dict(name=name, code=code, municipality=municipality,
                 version=1, attributes=attributes)
-    instance = PostCode.select().join(Municipality).where(
-        PostCode.code == code, Municipality.insee == insee).first()
-    if instance:
+    if cache.get().postcode(code, insee):
         return reporter.notice('PostCode already exists', code)
+    municipality_pk = cache.get().get(Municipality, 'insee', insee)
+    if municipality_pk:
+        data['municipality'] = municipality_pk
     validator = PostCode.validator(**data)
     if validator.errors:
         return reporter.error('PostCode errors', (validator.errors,
                                                   code, insee))
-    validator.save()
+    cache.get().add(validator.save())
     reporter.notice('Imported PostCode', code)
 
 
@@ -166,9 +263,7 @@ def process_housenumber(row):
     # Only override if key is present (even if value is null).
     if 'postcode:code' in row:
         code = row.get('postcode:code')
-        postcode = PostCode.select().join(Municipality).where(
-            PostCode.code == code,
-            Municipality.insee == insee).first()
+        postcode = cache.get().postcode(code, insee)
         if not postcode:
             reporter.error('HouseNumber postcode not found', (cia, code))
         else:
@@ -178,14 +273,17 @@ def process_housenumber(row):
     group_laposte = row.get('group:laposte')
     parent = None
     if fantoir:
-        parent = 'fantoir:{}'.format(fantoir)
+        parent = ('fantoir', fantoir)
     elif group_ign:
-        parent = 'ign:{}'.format(group_ign)
+        parent = ('ign', group_ign)
     elif group_laposte:
-        parent = 'laposte:{}'.format(group_laposte)
+        parent = ('laposte', group_laposte)
     if parent:
+        group = find(Group, *parent)
+        parent = '{}:{}'.format(*parent)
         try:
-            parent = Group.coerce(parent)
+            # Still use coerce on a miss, to deal with redirects.
+            parent = (group or Group.coerce(parent)).pk
         except Group.DoesNotExist:
             reporter.error('Parent given but not found', parent)
             parent = None
@@ -197,27 +295,31 @@ def process_housenumber(row):
     ign = data.get('ign')
     laposte = data.get('laposte')
     if cia:
-        instance = HouseNumber.first(HouseNumber.cia == cia)
+        instance = find(HouseNumber, 'cia', cia)
         if instance and compute_cia:
             if cia != computed_cia:
                 # Means new values are changing one of the four values of the
                 # cia (insee, fantoir, number, ordinal). Make sure we are not
                 # creating a duplicate.
-                duplicate = HouseNumber.first(HouseNumber.cia == computed_cia)
+                duplicate = find(HouseNumber, 'cia', computed_cia)
                 if duplicate:
                     msg = 'Duplicate CIA'
                     reporter.error(msg, (cia, computed_cia))
                     return
     elif ign:
-        instance = HouseNumber.first(HouseNumber.ign == ign)
+        instance = find(HouseNumber, 'ign', ign)
     elif laposte:
-        instance = HouseNumber.first(HouseNumber.laposte == laposte)
+        instance = find(HouseNumber, 'laposte', laposte)
     if parent and not instance:
-        # Data is not coerced yet, we want None for empty strings.
-        ordinal = data.get('ordinal') or None
-        instance = HouseNumber.first(HouseNumber.parent == parent,
-                                     HouseNumber.number == data['number'],
-                                     HouseNumber.ordinal == ordinal)
+        if computed_cia:
+            # Parent, number and ordinal are the cia components.
+            instance = find(HouseNumber, 'cia', computed_cia)
+        else:
+            # Data is not coerced yet, we want None for empty strings.
+            ordinal = data.get('ordinal') or None
+            instance = HouseNumber.first(HouseNumber.parent == parent,
+                                         HouseNumber.number == data['number'],
+                                         HouseNumber.ordinal == ordinal)
     if instance:
         attributes = getattr(instance, 'attributes') or {}
         if attributes.get('source') == source:
@@ -238,10 +340,11 @@ def process_housenumber(row):
         return
     with HouseNumber._meta.database.atomic():
         try:
-            validator.save()
+            housenumber = validator.save()
         except peewee.IntegrityError as e:
             reporter.warning('HouseNumber DB error', (data, str(e)))
         else:
+            cache.get().add(housenumber)
             msg = 'HouseNumber Updated' if instance else 'HouseNumber created'
             reporter.notice(msg, data)
 
@@ -256,9 +359,9 @@ def process_position(row):
     housenumber = None
     if cia:
         cia = cia.upper()
-        housenumber = HouseNumber.first(HouseNumber.cia == cia)
+        housenumber = find(HouseNumber, 'cia', cia)
     elif housenumber_ign:
-        housenumber = HouseNumber.first(HouseNumber.ign == housenumber_ign)
+        housenumber = find(HouseNumber, 'ign', housenumber_ign)
     if not housenumber:
         reporter.error('Unable to find parent housenumber', row)
         return
@@ -0,0 +1,80 @@
+import time
+from pathlib import Path
+
+from ban.commands import command, reporter
+from ban.core import context
+from ban.core.jobs import Job
+
+from .bal import bal
+
+
+@command
+def work(poll=0, **kwargs):
+    """Run pending jobs (eg. BAL uploads), oldest first.
+
+    Many workers may run at the same time, each job being run by only one of
+    them. Rows of a job are processed by the `--workers` pool.
+
+    poll    Wait for new jobs, checking every `poll` seconds.
+    """
+    while True:
+        # Jobs of crashed workers.
+        requeued = Job.requeue()
+        if requeued:
+            reporter.warning('Requeued stale jobs', requeued)
+        job = Job.claim()
+        if job:
+            run(job)
+        elif poll:
+            time.sleep(poll)
+        else:
+            break
+
+
+class Progress:
+    """Save processed rows count and current reports of `job`, each time a
+    chunk is processed."""
+
+    def __init__(self, job):
+        self.job = job
+        self.rows = 0
+
+    def __call__(self, step=1):
+        self.rows += step
+        self.job.progress(self.rows, context.get('reporter'))
+
+
+# Runners are called with the path of the uploaded file.
+RUNNERS = {
+    'bal': bal,
+}
+
+
+def run(job):
+    if not job.path or not Path(job.path).exists():
+        # Eg. UPLOAD_DIR not shared with the HTTP server: do not let the
+        # runner abort the whole worker.
+        error = 'Upload not found: {}'.format(job.path)
+        job.finish(None, error=error)
+        reporter.error('Job failed', (job.pk, error))
+        return
+    main = context.get('reporter')
+    # Rows are created on behalf of the session that posted the job, batch
+    # workers are given the one of this thread.
+    context.set('session', job.session)
+    error = None
+    try:
+        RUNNERS[job.kind](job.path, progress=Progress(job))
+    except (Exception, SystemExit) as e:
+        # Commands may `abort`, the job is failed but the worker goes on.
+        error = '{}: {}'.format(e.__class__.__name__, e)
+    finally:
+        # The job command has its own reporter.
+        job_reporter = context.get('reporter')
+        context.set('reporter', main)
+        context.set('session', None)
+    job.finish(job_reporter, error=error)
+    if error:
+        reporter.error('Job failed', (job.pk, error))
+    else:
+        reporter.notice('Job done', job.pk)
@@ -0,0 +1,12 @@
+from ban.commands import command, reporter
+from ban.core.versioning import Redirect
+
+
+@command
+def compact(depth=32, **kwargs):
+    """Point every redirect to the final target of its chain of redirects.
+
+    depth   Maximum length of a chain to follow.
+    """
+    count = Redirect.compact(max_depth=depth)
+    reporter.notice('Redirects rewritten', count)
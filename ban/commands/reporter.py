@@ -39,7 +39,7 @@ class Reporter:
                 if reports:
                     lines.append(self.LEVEL_LABEL[level].title())
                 for msg, data in reports.items():
-                    total = len(data) if self.verbosity >= level else data
+                    total = self.total(level, msg)
                     lines.append('\t- {} ({})'.format(msg, total))
                     if self.verbosity >= level:
                         for item in data:
@@ -54,7 +54,7 @@ class Reporter:
             if reports:
                 out[self.LEVEL_LABEL[level]] = []
                 for msg, data in reports.items():
-                    total = len(data) if self.verbosity else data
+                    total = self.total(level, msg)
                     current = {
                         'total': total,
                         'msg': msg
@@ -83,12 +83,61 @@ class Reporter:
                     self._reports[level].setdefault(msg, 0)
                     self._reports[level][msg] += data
 
+    def total(self, level, msg):
+        data = self._reports[level][msg]
+        if isinstance(data, int):
+            return data
+        return len(data) + self._restored[level].get(msg, 0)
+
+    def counters(self):
+        """Return the number of reports by level and message."""
+        return {level: {msg: self.total(level, msg) for msg in reports}
+                for level, reports in self._reports.items()}
+
+    def restore(self, counters):
+        """Add counters from a previous run (eg. a resumed import). Their
+        data, if any, is lost."""
+        for level, msgs in counters.items():
+            level = int(level)  # JSON keys are strings.
+            for msg, count in msgs.items():
+                if self.verbosity >= level:
+                    self._reports[level].setdefault(msg, [])
+                    restored = self._restored[level]
+                    restored[msg] = restored.get(msg, 0) + count
+                else:
+                    self._reports[level].setdefault(msg, 0)
+                    self._reports[level][msg] += count
+
+    def mark(self):
+        """Return the current size of each report, see `rewind`."""
+        return {level: {msg: data if isinstance(data, int) else len(data)
+                        for msg, data in reports.items()}
+                for level, reports in self._reports.items()}
+
+    def rewind(self, mark):
+        """Drop the reports made since `mark` was taken (eg. the ones of
+        rolled back items)."""
+        for level, reports in self._reports.items():
+            sizes = mark.get(level, {})
+            for msg in list(reports):
+                if msg not in sizes:
+                    del reports[msg]
+                elif isinstance(reports[msg], int):
+                    reports[msg] = sizes[msg]
+                else:
+                    del reports[msg][sizes[msg]:]
+
     def clear(self):
         self._reports = {
             ERROR: {},
             WARNING: {},
             NOTICE: {}
         }
+        self._restored = {
+            ERROR: {},
+            WARNING: {},
+            NOTICE: {}
+        }
 
     @property
     def has_report(self):
@@ -0,0 +1,127 @@
+import json
+from datetime import timedelta
+from pathlib import Path
+
+import peewee
+
+from ban import db
+from ban.auth.models import Session
+from ban.core.encoder import dumps
+from ban.utils import utcnow
+
+from . import config
+
+
+class Job(db.Model):
+    """A command to be run in the background (eg. a BAL upload import), by
+    the `job:work` command."""
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    kind = db.CharField(max_length=20)
+    status = db.CharField(max_length=20, default=PENDING, index=True)
+    # Uploaded file, see `upload_path`.
+    path = db.CharField(max_length=255, null=True)
+    session = db.ForeignKeyField(Session, null=True)
+    rows = db.IntegerField(default=0)
+    report = db.BinaryJSONField(null=True)
+    error = db.TextField(null=True)
+    created_at = db.DateTimeField(default=utcnow)
+    started_at = db.DateTimeField(null=True)
+    # Updated at each progress: a running job not updated for JOB_TIMEOUT
+    # seconds is considered as lost (eg. worker crash), see `requeue`.
+    updated_at = db.DateTimeField(null=True)
+    finished_at = db.DateTimeField(null=True)
+
+    def serialize(self, *args):
+        return {
+            'id': self.pk,
+            'kind': self.kind,
+            'status': self.status,
+            'rows': self.rows,
+            'report': self.report,
+            'error': self.error,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+    @staticmethod
+    def upload_path(name):
+        """Where to store an upload, in the UPLOAD_DIR setting directory.
+
+        It is mandatory, as it must be shared by the HTTP server and the
+        workers."""
+        root = Path(config.UPLOAD_DIR)
+        root.mkdir(parents=True, exist_ok=True)
+        return root / name
+
+    def is_owned_by(self, session):
+        """Whether `session` (same client or user) posted the job, or is
+        staff."""
+        if not session:
+            return False
+        if session.user and session.user.is_staff:
+            return True
+        if not self.session:
+            return False
+        return any(self.session._data.get(key) is not None and
+                   self.session._data.get(key) == session._data.get(key)
+                   for key in ('pk', 'client', 'user'))
+
+    @classmethod
+    def requeue(cls, timeout=None):
+        """Put back in the queue the running jobs not updated for `timeout`
+        seconds (JOB_TIMEOUT setting, default: one hour)."""
+        if timeout is None:
+            timeout = int(config.get('JOB_TIMEOUT') or 3600)
+        limit = utcnow() - timedelta(seconds=timeout)
+        return (cls.update(status=cls.PENDING, started_at=None,
+                           updated_at=None)
+                   .where(cls.status == cls.RUNNING,
+                          peewee.fn.COALESCE(cls.updated_at,
+                                             cls.started_at) < limit)
+                   .execute())
+
+    @classmethod
+    def claim(cls):
+        """Mark the oldest pending job as running and return it, if any.
+
+        Jobs locked by other workers are skipped, so many workers can run
+        concurrently."""
+        sql = ('UPDATE {0} SET status = %s, started_at = %s, updated_at = %s '
+               'WHERE pk = (SELECT pk FROM {0} WHERE status = %s ORDER BY pk '
+               'LIMIT 1 FOR UPDATE SKIP LOCKED) RETURNING *'
+               .format(db.table(cls)))
+        now = utcnow()
+        with cls._meta.database.atomic():
+            jobs = list(cls.raw(sql, cls.RUNNING, now, now, cls.PENDING))
+        return jobs[0] if jobs else None
+
+    @staticmethod
+    def as_json(report):
+        # Reporter data may hold instances, make sure to store plain JSON.
+        return json.loads(dumps(report))
+
+    def progress(self, rows, report):
+        self.rows = rows
+        self.report = self.as_json(report)
+        self.updated_at = utcnow()
+        self.save(only=[Job.rows, Job.report, Job.updated_at])
+
+    def finish(self, report, error=None):
+        self.status = self.FAILED if error else self.DONE
+        self.report = self.as_json(report)
+        self.error = error
+        self.finished_at = self.updated_at = utcnow()
+        if self.path:
+            # No need to keep the upload anymore.
+            try:
+                Path(self.path).unlink()
+            except FileNotFoundError:
+                pass
+            self.path = None
+        self.save()
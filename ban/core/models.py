@@ -27,6 +27,7 @@ class Model(ResourceModel, Versioned, metaclass=BaseModel):
                               'modified_at', 'modified_by']
     readonly_fields = (ResourceModel.readonly_fields + ['created_at',
                        'created_by', 'modified_at', 'modified_by'])
+    required_fields = ResourceModel.required_fields + ['version']
 
     attributes = db.HStoreField(null=True)
 
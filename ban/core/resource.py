@@ -1,5 +1,8 @@
 import uuid
+from collections import defaultdict
 from datetime import datetime
+from functools import lru_cache
+from operator import attrgetter
 
 import peewee
 from postgis import Point
@@ -7,10 +10,218 @@ from postgis import Point
 from ban import db
 from ban.utils import utcnow
 
+from . import context
 from .exceptions import (IsDeletedError, MultipleRedirectsError, RedirectError,
                          ResourceLinkedError)
 from .validators import ResourceValidator
 
+# Max number of compiled serializers, by (model, mask).
+SERIALIZERS = 1024
+
+
+def freeze(mask):
+    """Hashable version of a serialization mask, keeping its order."""
+    if not mask:
+        return ()
+    return tuple((name, freeze(sub)) for name, sub in mask.items())
+
+
+def thaw(mask):
+    return {name: thaw(sub) for name, sub in mask}
+
+
+def serialize(instance, mask):
+    """Serialize `instance` with the frozen `mask`."""
+    if isinstance(instance, ResourceModel):
+        return compile_mask(instance.__class__, mask)(instance)
+    return instance.serialize(thaw(mask))
+
+
+def convert(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Point):
+        return value.geojson
+    return value
+
+
+def expand(model, mask):
+    """Replace a '*' in the frozen `mask` by the `model` resource fields."""
+    for name, sub in mask:
+        if name == '*':
+            return tuple((k, sub) for k in model.resource_fields)
+    return mask
+
+
+def is_many(field):
+    return isinstance(field, (db.ManyToManyField,
+                              peewee.ReverseRelationDescriptor))
+
+
+def related_getter(name):
+    """Getter of a to-many relation, using prefetched values if any."""
+    def getter(instance):
+        prefetched = getattr(instance, '_prefetched', None)
+        if prefetched and name in prefetched:
+            return prefetched[name]
+        return getattr(instance, name)
+    return getter
+
+
+def converter(field, mask):
+    if is_many(field):
+        return lambda value: [serialize(v, mask) for v in value]
+    if isinstance(field, db.ForeignKeyField):
+        return lambda value: serialize(value, mask)
+    if isinstance(field, peewee.Field) and not isinstance(
+            field, (peewee.DateTimeField, db.PointField)):
+        return None
+    # Properties can return anything.
+    return convert
+
+
+@lru_cache(maxsize=SERIALIZERS)
+def compile_mask(model, mask):
+    """Return a callable serializing a `model` instance according to the
+    frozen `mask`, so the mask is only interpreted once."""
+    if not mask:
+        return attrgetter('serialized')
+    getters = []
+    for name, sub in expand(model, mask):
+        field = getattr(model, name, None)
+        if not field:
+            raise ValueError('Unknown field {}'.format(name))
+        getter = related_getter(name) if is_many(field) else attrgetter(name)
+        getters.append((name, getter, converter(field, sub)))
+
+    def serializer(instance):
+        dest = {}
+        for name, getter, convert in getters:
+            value = getter(instance)
+            if value is not None and convert is not None:
+                value = convert(value)
+            dest[name] = value
+        return dest
+
+    return serializer
+
+
+def columns(model, mask):
+    """Fields to select to serialize `model` instances with the frozen
+    `mask`, or None if all are needed."""
+    if not issubclass(model, ResourceModel):
+        return None
+    names = list(model.required_fields)
+    for name, sub in expand(model, mask):
+        if name in model.computed_fields:
+            names.extend(model.computed_fields[name])
+            continue
+        field = getattr(model, name, None)
+        if is_many(field):
+            continue  # Loaded from the pk.
+        if not isinstance(field, peewee.Field):
+            return None  # A property: anything can be needed.
+        names.append(name)
+    fields = model._meta.fields
+    return [fields[name] for name in dict.fromkeys(names)]
+
+
+def set_prefetched(instance, name, value):
+    if getattr(instance, '_prefetched', None) is None:
+        instance._prefetched = {}
+    instance._prefetched[name] = value
+
+
+def select(model, mask, *extra):
+    """Select only the `model` columns needed by the frozen `mask`, plus
+    `extra` ones."""
+    fields = columns(model, mask)
+    if fields is None:
+        fields = [f for f in model._meta.sorted_fields if not is_many(f)]
+    # Fields overload `==`, so compare names.
+    names = {f.name for f in fields}
+    fields.extend(f for f in extra
+                  if f.model_class is not model or f.name not in names)
+    return model.select(*fields)
+
+
+def prefetch_foreign_key(field, instances, mask):
+    name = field.name
+    values = {instance._data.get(name) for instance in instances}
+    values.discard(None)
+    if not values:
+        return []
+    to_field = field.to_field
+    qs = select(field.rel_model, mask, to_field)
+    qs = qs.where(to_field << list(values))
+    related = {getattr(obj, to_field.name): obj for obj in qs}
+    for instance in instances:
+        obj = related.get(instance._data.get(name))
+        if obj is not None:
+            # Where peewee caches the related instance.
+            instance._obj_cache[name] = obj
+    return list(related.values())
+
+
+def prefetch_reverse_relation(name, descriptor, instances, mask):
+    fk = descriptor.field
+    key = fk.to_field.name
+    values = [getattr(instance, key) for instance in instances]
+    qs = select(descriptor.rel_model, mask, fk).where(fk << values)
+    related = defaultdict(list)
+    for obj in qs:
+        related[obj._data[fk.name]].append(obj)
+    for instance in instances:
+        set_prefetched(instance, name, related[getattr(instance, key)])
+    return [obj for objs in related.values() for obj in objs]
+
+
+def prefetch_many_to_many(model, name, field, instances, mask):
+    through = field.get_through_model()
+    src = through._meta.rel_for_model(model)
+    dest = through._meta.rel_for_model(field.rel_model)
+    rel_model = field.rel_model
+    values = [getattr(instance, src.to_field.name) for instance in instances]
+    # Naive, to get the through source value as a plain attribute.
+    qs = (select(rel_model, mask, src.alias('_source'))
+          .join(through, on=(dest == rel_model.pk))
+          .where(src << values).naive())
+    related = defaultdict(list)
+    for obj in qs:
+        related[obj._source].append(obj)
+    for instance in instances:
+        set_prefetched(instance, name,
+                       related[getattr(instance, src.to_field.name)])
+    return [obj for objs in related.values() for obj in objs]
+
+
+def prefetch(model, instances, mask):
+    """Load the relations needed to serialize the `model` `instances` with
+    the frozen `mask`, with one query per relation, whatever the number of
+    instances."""
+    if not instances or not mask:
+        return
+    for name, sub in expand(model, mask):
+        field = getattr(model, name, None)
+        if isinstance(field, peewee.ForeignKeyField):
+            related = prefetch_foreign_key(field, instances, sub)
+        elif isinstance(field, peewee.ReverseRelationDescriptor):
+            related = prefetch_reverse_relation(name, field, instances, sub)
+        elif isinstance(field, db.ManyToManyField):
+            related = prefetch_many_to_many(model, name, field, instances,
+                                            sub)
+        else:
+            continue
+        rel_model = field.rel_model
+        if issubclass(rel_model, ResourceModel):
+            prefetch(rel_model, related, sub)
+        elif issubclass(model, ResourceModel):
+            # Not a resource (eg. a session): it serializes its own foreign
+            # keys, whatever the mask.
+            prefetch(rel_model, related, tuple(
+                (f.name, ()) for f in rel_model._meta.sorted_fields
+                if isinstance(f, peewee.ForeignKeyField)))
+
 
 class BaseResource(peewee.BaseModel):
 
@@ -48,6 +259,9 @@ class BaseResource(peewee.BaseModel):
         cls.versioned_fields = [
             n for n in cls.resource_fields
             if n not in cls.exclude_for_version]
+        cls._resource_mask = freeze({'*': {}})
+        cls._relation_mask = freeze({f: {} for f in cls.collection_fields})
+        cls._version_mask = freeze({f: {} for f in cls.versioned_fields})
         return cls
 
 
@@ -55,6 +269,10 @@ class ResourceModel(db.Model, metaclass=BaseResource):
     resource_fields = ['id', 'status']
     identifiers = []
     readonly_fields = ['id', 'pk', 'status', 'deleted_at']
+    # Always selected, even when not asked for (see `columns`).
+    required_fields = ['pk', 'id', 'deleted_at']
+    # Columns needed by the resource fields that are not model fields.
+    computed_fields = {'resource': [], 'status': ['deleted_at']}
     exclude_for_collection = ['status']
     exclude_for_version = []
 
@@ -87,47 +305,47 @@ class ResourceModel(db.Model, metaclass=BaseResource):
     def serialized(self):
         return self.id
 
+    @classmethod
+    def serializer(cls, mask=None):
+        """Compiled (and cached) serializer for `mask`."""
+        return compile_mask(cls, freeze(mask))
+
     def serialize(self, mask=None):
-        if not mask:
-            return self.serialized
-        dest = {}
-        for name, subfields in mask.items():
-            if name == '*':
-                return self.serialize({k: subfields
-                                       for k in self.resource_fields})
-            field = getattr(self.__class__, name, None)
-            if not field:
-                raise ValueError('Unknown field {}'.format(name))
-            value = getattr(self, name)
-            if value is not None:
-                if isinstance(field, (db.ManyToManyField,
-                                      peewee.ReverseRelationDescriptor)):
-                    value = [v.serialize(subfields) for v in value]
-                elif isinstance(field, db.ForeignKeyField):
-                    value = value.serialize(subfields)
-                elif isinstance(value, datetime):
-                    value = value.isoformat()
-                elif isinstance(value, Point):
-                    value = value.geojson
-            dest[name] = value
-        return dest
+        return compile_mask(self.__class__, freeze(mask))(self)
+
+    @classmethod
+    def columns(cls, mask=None):
+        """Fields to select to serialize with `mask`, or None for all."""
+        return columns(cls, freeze(mask))
+
+    @classmethod
+    def prefetch(cls, instances, mask=None):
+        """Load the relations needed to serialize `instances` with `mask`, in
+        one query per relation."""
+        prefetch(cls, instances, freeze(mask))
+        return instances
+
+    @classmethod
+    def serialize_many(cls, instances, mask=None):
+        serializer = cls.serializer(mask)
+        return [serializer(i) for i in cls.prefetch(instances, mask)]
 
     @property
     def as_resource(self):
         """Resource plus relations."""
         # All fields and all first level relations fields.
-        return self.serialize({'*': {}})
+        return compile_mask(self.__class__, self._resource_mask)(self)
 
     @property
     def as_relation(self):
         """Resources plus relation references without metadata."""
         # All fields plus relations references.
-        return self.serialize({f: {} for f in self.collection_fields})
+        return compile_mask(self.__class__, self._relation_mask)(self)
 
     @property
     def as_version(self):
         """Resources plus relations references and metadata."""
-        return self.serialize({f: {} for f in self.versioned_fields})
+        return compile_mask(self.__class__, self._version_mask)(self)
 
     @property
     def status(self):
@@ -155,6 +373,15 @@ class ResourceModel(db.Model, metaclass=BaseResource):
                 raise ResourceLinkedError(
                     'Resource still linked by `{}`'.format(name))
 
+    @classmethod
+    def lookup(cls, identifier, value):
+        """Resolve `identifier` to a pk through the references of the current
+        import, if any (eg. IdentifierMaps preloaded by the import command).
+        """
+        references = context.get('references')
+        if references is not None:
+            return references.get(cls, identifier, value)
+
     @classmethod
     def coerce(cls, id, identifier=None):
         if isinstance(id, db.Model):
@@ -171,9 +398,18 @@ class ResourceModel(db.Model, metaclass=BaseResource):
                                                                 identifier))
                 elif isinstance(id, int):
                     identifier = 'pk'
+            instance = None
+            pk = cls.lookup(identifier, id)
+            if pk:
+                # Selecting by primary key is cheaper than by identifier,
+                # which is still checked as it may have moved since.
+                instance = cls.raw_select().where(cls.pk == pk).first()
+                if instance and getattr(instance, identifier) != id:
+                    instance = None
             try:
-                instance = cls.raw_select().where(
-                    getattr(cls, identifier) == id).get()
+                if instance is None:
+                    instance = cls.raw_select().where(
+                        getattr(cls, identifier) == id).get()
             except cls.DoesNotExist:
                 # Is it an old identifier?
                 from .versioning import Redirect
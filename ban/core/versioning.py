@@ -1,13 +1,21 @@
+from collections import defaultdict
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import islice
+import os
+import re
+import threading
+import time
 
 import decorator
 import peewee
 
 from ban import db
+from ban.db import table
 from ban.auth.models import Client, Session
-from ban.utils import make_diff, utcnow
+from ban.utils import apply_delta, make_delta, make_diff, utcnow
 
-from . import context
+from . import config, context
 
 
 @decorator.decorator
@@ -64,19 +72,15 @@ class Versioned(db.Model, metaclass=BaseVersioned):
         self.prepared()
 
     def store_version(self):
-        new = Version.create(
-            model_name=self.resource,
-            model_pk=self.pk,
-            sequential=self.version,
-            data=self.as_version,
-            period=[self.modified_at, None]
-        )
-        old = None
-        if self.version > 1:
-            old = self.load_version(self.version - 1)
-            old.close_period(new.period.lower)
-        if Diff.ACTIVE:
-            Diff.create(old=old, new=new, created_at=self.modified_at)
+        pending = context.get('versions')
+        if pending is None:
+            return Version.store([self])
+        # Deferred, see `Version.deferred`.
+        key = (self.resource, self.pk)
+        if key in pending:
+            # Versions of a same instance are stored one statement each.
+            Version.store([pending.pop(key)])
+        pending[key] = PendingVersion(self)
 
     @property
     def versions(self):
@@ -145,6 +149,68 @@ class Versioned(db.Model, metaclass=BaseVersioned):
             return super().delete_instance(*args, **kwargs)
 
 
+# Insert the new versions and close the period of the previous ones in a
+# single round trip. Both CTEs see the same snapshot, so the UPDATE only
+# touches versions that existed before the statement.
+STORE_VERSIONS = """
+WITH item (i, model_name, model_pk, sequential, data, delta, period) AS (
+    VALUES {values}),
+new AS (
+    INSERT INTO {version} (model_name, model_pk, sequential, data, delta,
+                           period)
+    SELECT model_name, model_pk, sequential, data, delta, period
+    FROM item ORDER BY i
+    RETURNING pk, model_name, model_pk, sequential, period),
+old AS (
+    UPDATE {version} v
+    SET period = tstzrange(lower(v.period), lower(new.period), '[)')
+    FROM new
+    WHERE v.model_name = new.model_name AND v.model_pk = new.model_pk
+      AND v.sequential = new.sequential - 1
+    RETURNING v.pk, v.model_name, v.model_pk, v.data, v.delta, v.period)
+SELECT item.i, new.pk, new.period, old.pk, old.data, old.delta, old.period
+FROM item
+JOIN new USING (model_name, model_pk, sequential)
+LEFT JOIN old USING (model_name, model_pk)
+ORDER BY item.i
+"""
+
+# Rows needed to rebuild the given versions: from their closest keyframe
+# up to them.
+LOAD_DOCUMENTS = """
+SELECT v.model_name, v.model_pk, k.sequential, v.data, v.delta
+FROM (VALUES {values}) AS k (model_name, model_pk, sequential)
+JOIN {version} v ON v.model_name = k.model_name AND v.model_pk = k.model_pk
+WHERE v.sequential <= k.sequential AND v.sequential >= (
+    SELECT max(f.sequential) FROM {version} f
+    WHERE f.model_name = k.model_name AND f.model_pk = k.model_pk
+      AND f.sequential <= k.sequential AND f.data IS NOT NULL)
+ORDER BY v.model_name, v.model_pk, k.sequential, v.sequential
+"""
+
+
+class PendingVersion:
+    """What `Version.store` needs of a Versioned instance, taken when it is
+    saved, as it may change before the version is actually stored."""
+
+    def __init__(self, instance):
+        self.resource = instance.resource
+        self.pk = instance.pk
+        self.version = instance.version
+        self.modified_at = instance.modified_at
+        self.as_version = instance.as_version
+
+
+class VersionQuery(db.SelectQuery):
+
+    def __iter__(self):
+        # Rebuild the documents of all the versions at once, instead of one
+        # query per version stored as a delta when accessing `data`.
+        versions = list(super().__iter__())
+        Version.rebuild([v for v in versions if isinstance(v, Version)])
+        return iter(versions)
+
+
 class Version(db.Model):
 
     __openapi__ = """
@@ -161,10 +227,16 @@ class Version(db.Model):
     model_name = db.CharField(max_length=64)
     model_pk = db.IntegerField()
     sequential = db.IntegerField()
-    data = db.BinaryJSONField()
-    period = db.DateRangeField()
+    # Full document, only for keyframes, see `is_keyframe`; use `data` to
+    # get the full document of any version.
+    snapshot = db.BinaryJSONField(db_column='data', null=True)
+    # Changes from the previous version, for other versions.
+    delta = db.BinaryJSONField(null=True)
+    # Indexed for time travel queries, see `at`.
+    period = db.DateRangeField(index=True)
 
     class Meta:
+        manager = VersionQuery
         indexes = (
             (('model_name', 'model_pk', 'sequential'), True),
         )
@@ -174,11 +246,173 @@ class Version(db.Model):
                                                self.model_name, self.model_pk)
 
     def serialize(self, *args):
+        flags = getattr(self, '_flags', None)
+        if flags is None:
+            flags = self.flags.select(Flag, Client).join(Client)
         return {
             'data': self.data,
-            'flags': list(self.flags.serialize())
+            'flags': [flag.serialize() for flag in flags]
         }
 
+    @classmethod
+    def prefetch_flags(cls, versions):
+        """Load the flags of many versions, and their clients, in one
+        query."""
+        flags = defaultdict(list)
+        pks = [version.pk for version in versions]
+        if pks:
+            qs = (Flag.select(Flag, Client).join(Client)
+                      .where(Flag.version << pks).order_by(Flag.pk))
+            for flag in qs:
+                flags[flag._data['version']].append(flag)
+        for version in versions:
+            version._flags = flags[version.pk]
+        return versions
+
+    @property
+    def data(self):
+        if self.snapshot is not None:
+            return self.snapshot
+        document = getattr(self, '_document', None)
+        if document is None:
+            key = (self.model_name, self.model_pk, self.sequential)
+            document = self._document = self.documents([key]).get(key)
+        return document
+
+    @data.setter
+    def data(self, value):
+        self.snapshot = value
+        self.delta = None
+        self._document = None
+
+    @staticmethod
+    def is_keyframe(sequential):
+        """Should this version be stored in full, or as a delta?
+
+        With VERSION_KEYFRAME set to N, only one version every N is stored
+        in full."""
+        interval = int(config.get('VERSION_KEYFRAME') or 0)
+        return interval <= 1 or (sequential - 1) % interval == 0
+
+    @classmethod
+    def documents(cls, keys):
+        """Rebuild the full documents of the versions matching `keys`, as
+        (model_name, model_pk, sequential) tuples, in one query."""
+        keys = list(keys)
+        if not keys:
+            return {}
+        values = ', '.join(['(%s, %s, %s)'] * len(keys))
+        sql = LOAD_DOCUMENTS.format(values=values,
+                                    version=table(cls))
+        params = [value for key in keys for value in key]
+        cursor = cls._meta.database.execute_sql(sql, params)
+        documents = {}
+        for model_name, model_pk, sequential, data, delta in cursor:
+            key = (model_name, model_pk, sequential)
+            if data is not None:
+                documents[key] = data
+            else:
+                documents[key] = apply_delta(documents[key], delta)
+        return documents
+
+    @classmethod
+    def rebuild(cls, versions):
+        """Rebuild the full documents of many versions at once."""
+        missing = [v for v in versions if v.snapshot is None
+                   and getattr(v, '_document', None) is None]
+        documents = cls.documents((v.model_name, v.model_pk, v.sequential)
+                                  for v in missing)
+        for version in missing:
+            version._document = documents.get(
+                (version.model_name, version.model_pk, version.sequential))
+        return versions
+
+    @classmethod
+    def at(cls, model, dt):
+        """Versions of the `model` resources as they were at `dt`."""
+        return cls.select().where(cls.model_name == model.__name__.lower(),
+                                  cls.period.contains(dt))
+
+    @classmethod
+    @contextmanager
+    def deferred(cls):
+        """Store the versions of the instances saved in the block all at
+        once, when leaving it without error (eg. a group commit).
+
+        Yield the pending versions, by (resource, pk): a caller rolling back
+        a savepoint must restore them as they were before it."""
+        pending = context.get('versions')
+        if pending is not None:  # Already deferred by an outer block.
+            yield pending
+            return
+        pending = {}
+        context.set('versions', pending)
+        try:
+            yield pending
+            context.set('versions', None)
+            cls.store(pending.values())
+        finally:
+            context.set('versions', None)
+
+    @classmethod
+    def store(cls, instances):
+        """Store the current version of each Versioned instance (or
+        PendingVersion), closing the period of its previous version, in one
+        statement.
+
+        Each instance must appear only once."""
+        instances = list(instances)
+        if not instances:
+            return []
+        values = ', '.join(
+            ['(%s, %s, %s, %s, %s::jsonb, %s::jsonb, %s::tstzrange)']
+            * len(instances))
+        data = [instance.as_version for instance in instances]
+        previous = cls.documents(
+            (instance.resource, instance.pk, instance.version - 1)
+            for instance in instances
+            if not cls.is_keyframe(instance.version))
+        stored = []  # (snapshot, delta) of each new version.
+        params = []
+        for i, instance in enumerate(instances):
+            snapshot, delta = data[i], None
+            key = (instance.resource, instance.pk, instance.version - 1)
+            if key in previous:
+                snapshot, delta = None, make_delta(previous[key], data[i])
+            stored.append((snapshot, delta))
+            params.extend([i, instance.resource, instance.pk,
+                           instance.version, cls.snapshot.db_value(snapshot),
+                           cls.delta.db_value(delta),
+                           cls.period.db_value([instance.modified_at, None])])
+        sql = STORE_VERSIONS.format(values=values,
+                                    version=table(cls))
+        cursor = cls._meta.database.execute_sql(sql, params)
+        versions = []
+        diffs = []
+        for (i, pk, period, old_pk, old_snapshot, old_delta,
+             old_period) in cursor.fetchall():
+            instance = instances[i]
+            snapshot, delta = stored[i]
+            new = cls(pk=pk, model_name=instance.resource,
+                      model_pk=instance.pk, sequential=instance.version,
+                      snapshot=snapshot, delta=delta, period=period)
+            new._document = data[i]
+            old = None
+            if old_pk:
+                key = (instance.resource, instance.pk, instance.version - 1)
+                old = cls(pk=old_pk, model_name=instance.resource,
+                          model_pk=instance.pk,
+                          sequential=instance.version - 1,
+                          snapshot=old_snapshot, delta=old_delta,
+                          period=old_period)
+                old._document = previous.get(key)
+            if Diff.ACTIVE:
+                diffs.append(Diff(old=old, new=new,
+                                  created_at=instance.modified_at))
+            versions.append(new)
+        Diff.create_many(diffs)
+        return versions
+
     @property
     def model(self):
         return BaseVersioned.registry[self.model_name]
@@ -210,6 +444,89 @@ class Version(db.Model):
         self.save()
 
 
+# Value (as text) of a document field for the selected versions, read from
+# the closest version storing it: itself, or a previous one when only deltas
+# are stored (see `Version.is_keyframe`). Split where the outer version
+# columns go: model_name, model_pk and sequential.
+FIELD_AT = (
+    "(SELECT CASE WHEN f.data IS NOT NULL THEN f.data ->> '{name}' "
+    "WHEN f.delta -> 'unset' ? '{name}' THEN NULL "
+    "ELSE f.delta -> 'set' ->> '{name}' END "
+    "FROM {version} f WHERE f.model_name =",
+    "AND f.model_pk =",
+    "AND f.sequential <=",
+    "AND (f.data IS NOT NULL OR f.delta -> 'set' ? '{name}' "
+    "OR f.delta -> 'unset' ? '{name}') ORDER BY f.sequential DESC LIMIT 1)",
+)
+
+
+def field_at(name):
+    """SQL expression of the `name` document field of selected versions."""
+    if not re.match(r'^\w+$', name):
+        raise ValueError('Invalid field name {}'.format(name))
+    version = table(Version)
+    parts = [peewee.SQL(part.format(name=name, version=version))
+             for part in FIELD_AT]
+    return peewee.Clause(parts[0], Version.model_name, parts[1],
+                         Version.model_pk, parts[2], Version.sequential,
+                         parts[3])
+
+
+class History:
+    """Collection of the `model` resources as they were at `dt`, serialized
+    from their versions with `mask`.
+
+    `order_by` lists document fields, optionally followed by SQL ordering
+    keywords (eg. 'number ASC NULLS FIRST'); default is by pk."""
+
+    def __init__(self, model, dt, mask=None, order_by=None):
+        self.model = model
+        self.mask = mask or {'*': {}}
+        # The current version of resources deleted before `dt` is the
+        # deletion one.
+        status = peewee.fn.COALESCE(field_at('status'), '')
+        self.qs = Version.at(model, dt).where(status != 'deleted')
+        ordering = []
+        for term in order_by or []:
+            name, *keywords = term.split(' ', 1)
+            if name == 'pk':
+                ordering.append(Version.model_pk)
+            else:
+                ordering.append(peewee.Clause(field_at(name),
+                                              peewee.SQL(''.join(keywords))))
+        self.qs = self.qs.order_by(*ordering, Version.model_pk)
+
+    def __len__(self):
+        return self.qs.count()
+
+    def __getitem__(self, value):
+        return [self.serialize(v) for v in Version.rebuild(self.qs[value])]
+
+    def __iter__(self):
+        # Rebuild by pages, without loading the whole collection.
+        versions = self.qs.iterator()
+        while True:
+            page = list(islice(versions, 1000))
+            if not page:
+                break
+            for version in Version.rebuild(page):
+                yield self.serialize(version)
+
+    def serialize(self, version):
+        data = version.data
+        if '*' in self.mask:
+            return data
+        dest = {}
+        for name in self.mask:
+            if name == 'resource':
+                dest[name] = version.model_name
+            elif name in data:
+                dest[name] = data[name]
+            else:
+                raise ValueError('Unknown field {}'.format(name))
+        return dest
+
+
 class Diff(db.Model):
 
     __openapi__ = """
@@ -237,6 +554,16 @@ class Diff(db.Model):
 
     # Allow to skip diff at very first data import.
     ACTIVE = True
+    # New diffs are notified on this channel, when committed. With the
+    # DIFF_NOTIFY setting: 'transaction' (default) sends one notification
+    # by transaction (same empty payload, merged by PostgreSQL), 'diff' one
+    # by diff with its pk as payload, 'none' disables them.
+    CHANNEL = 'diff'
+    NOTIFY_MODES = {
+        'transaction': "pg_notify(%s, '')",
+        'diff': 'pg_notify(%s, pk::text)',
+        'none': 'NULL',
+    }
 
     # old is empty at creation.
     old = db.ForeignKeyField(Version, null=True)
@@ -249,13 +576,62 @@ class Diff(db.Model):
         validate_backrefs = False
         order_by = ('pk', )
 
-    def save(self, *args, **kwargs):
+    def compute(self):
         if not self.diff:
             old = self.old.data if self.old else {}
             new = self.new.data if self.new else {}
             self.diff = make_diff(old, new)
-        super().save(*args, **kwargs)
-        Redirect.from_diff(self)
+
+    def save(self, *args, **kwargs):
+        if self.pk:
+            return super().save(*args, **kwargs)
+        self.create_many([self])
+
+    @classmethod
+    def create_many(cls, diffs):
+        """Insert and notify many diffs in one statement, then add their
+        redirects at once."""
+        if not diffs:
+            return diffs
+        mode = config.get('DIFF_NOTIFY') or 'transaction'
+        if mode not in cls.NOTIFY_MODES:
+            raise ValueError('Invalid DIFF_NOTIFY: {}'.format(mode))
+        params = []
+        for diff in diffs:
+            diff.compute()
+            params.extend([diff._data.get('old'), diff._data.get('new'),
+                           cls.diff.db_value(diff.diff),
+                           cls.created_at.db_value(diff.created_at)])
+        if mode != 'none':
+            params.append(cls.CHANNEL)
+        values = ', '.join(['(%s, %s, %s::jsonb, %s)'] * len(diffs))
+        sql = INSERT_DIFFS.format(diff=table(cls), values=values,
+                                  notify=cls.NOTIFY_MODES[mode])
+        cursor = cls._meta.database.execute_sql(sql, params)
+        pks = {(old, new): pk for pk, old, new, _ in cursor.fetchall()}
+        for diff in diffs:
+            diff.pk = pks[(diff._data.get('old'), diff._data.get('new'))]
+        Redirect.add_many(redirect for diff in diffs
+                          for redirect in Redirect.from_diff_redirects(diff))
+        return diffs
+
+    @classmethod
+    def prefetch(cls, diffs):
+        """Load the old and new versions of many diffs, with their full
+        documents, in a constant number of queries."""
+        names = ('old', 'new')
+        pks = {diff._data.get(name) for diff in diffs for name in names}
+        pks.discard(None)
+        versions = {}
+        if pks:
+            qs = Version.select().where(Version.pk << list(pks))
+            versions = {v.pk: v for v in Version.rebuild(list(qs))}
+        for diff in diffs:
+            for name in names:
+                pk = diff._data.get(name)
+                if pk is not None:
+                    setattr(diff, name, versions[pk])
+        return diffs
 
     def serialize(self, *args):
         version = self.new or self.old
@@ -270,6 +646,148 @@ class Diff(db.Model):
         }
 
 
+# Diffs are matched back by versions: a version has only one diff. They are
+# notified by the same statement, see `Diff.NOTIFY_MODES`.
+INSERT_DIFFS = """
+WITH new AS (
+    INSERT INTO {diff} (old_id, new_id, diff, created_at)
+    VALUES {values}
+    RETURNING pk, old_id, new_id)
+SELECT pk, old_id, new_id, {notify} FROM new
+"""
+
+
+# Existing redirects are skipped (values are distinct already).
+INSERT_REDIRECTS = """
+INSERT INTO {redirect} (model_name, identifier, value, model_id)
+SELECT v.model_name, v.identifier, v.value, v.model_id
+FROM (VALUES {values}) AS v (model_name, identifier, value, model_id)
+WHERE NOT EXISTS (
+    SELECT 1 FROM {redirect} r
+    WHERE r.model_name = v.model_name AND r.identifier = v.identifier
+      AND r.value = v.value AND r.model_id = v.model_id)
+"""
+
+# Redirects pointing to a resource matching one of the new redirects'
+# identifier and value now point to their target.
+PROPAGATE_REDIRECTS = """
+UPDATE {redirect} r SET model_id = v.model_id
+FROM (VALUES {values}) AS v (value, model_id)
+JOIN {model} m ON m."{column}"::text = v.value AND m.deleted_at IS NULL
+WHERE r.model_name = %s AND r.model_id = m.id AND m.id <> v.model_id
+"""
+
+# Follow chains of redirects by id, in one recursive pass, to find the final
+# target of each redirect. Ambiguous redirects (many targets for the same
+# id) stop the chain.
+RESOLVE_REDIRECTS = """
+CREATE TEMPORARY TABLE redirect_target ON COMMIT DROP AS
+WITH RECURSIVE chain (model_name, identifier, value, model_id, target,
+                      depth) AS (
+    SELECT model_name, identifier, value, model_id, model_id, 0
+    FROM {redirect}
+  UNION ALL
+    SELECT c.model_name, c.identifier, c.value, c.model_id, r.model_id,
+           c.depth + 1
+    FROM chain c
+    JOIN {redirect} r ON r.model_name = c.model_name
+        AND r.identifier = 'id' AND r.value = c.target
+    WHERE c.depth < %s AND NOT EXISTS (
+        SELECT 1 FROM {redirect} o
+        WHERE o.model_name = r.model_name AND o.identifier = 'id'
+          AND o.value = r.value AND o.model_id <> r.model_id)
+)
+SELECT DISTINCT ON (model_name, identifier, value, model_id)
+    model_name, identifier, value, model_id, target
+FROM chain
+ORDER BY model_name, identifier, value, model_id, depth DESC
+"""
+
+DELETE_RESOLVED_REDIRECTS = """
+DELETE FROM {redirect} r USING redirect_target t
+WHERE r.model_name = t.model_name AND r.identifier = t.identifier
+  AND r.value = t.value AND r.model_id = t.model_id
+  AND t.target <> t.model_id
+"""
+
+# Chains looping back to their own value are dropped, as well as the
+# redirects already there (many may resolve to the same one).
+INSERT_RESOLVED_REDIRECTS = """
+INSERT INTO {redirect} (model_name, identifier, value, model_id)
+SELECT DISTINCT t.model_name, t.identifier, t.value, t.target
+FROM redirect_target t
+WHERE t.target <> t.model_id
+  AND NOT (t.identifier = 'id' AND t.value = t.target)
+  AND NOT EXISTS (
+    SELECT 1 FROM {redirect} r
+    WHERE r.model_name = t.model_name AND r.identifier = t.identifier
+      AND r.value = t.value AND r.model_id = t.target)
+"""
+
+
+class RedirectCache:
+    """In-process cache of `Redirect.follow` results, including the lookups
+    that found no redirect.
+
+    It is cleared each time this process changes redirects, and each time
+    diffs are notified (see `Diff.CHANNEL`), to catch the changes made by
+    other processes. Redirects changed without a diff notification (eg.
+    imports without diff, DIFF_NOTIFY=none or `redirect:compact`) are seen
+    at worst once the cache expires: every REDIRECT_CACHE_TTL seconds
+    (default: 60, 0 disables the cache)."""
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.lock = threading.Lock()
+        self.listener = None
+        self.pid = None
+        self.clear()
+
+    def clear(self):
+        self.targets = {}
+        self.missing = set()
+        ttl = config.get('REDIRECT_CACHE_TTL')
+        ttl = int(ttl if ttl is not None else 60)
+        self.expires = time.monotonic() + ttl
+
+    def notified(self):
+        """Whether diffs have been notified since the last call."""
+        if config.get('DIFF_NOTIFY') == 'none':
+            return False
+        if not self.lock.acquire(blocking=False):
+            return False  # Another thread is polling.
+        try:
+            if self.pid != os.getpid():
+                # Not the listener of a parent process (eg. a batch worker):
+                # its connection must not be shared.
+                self.listener = Diff._meta.database.listen(Diff.CHANNEL,
+                                                           timeout=0)
+                self.notifications = iter(self.listener)
+                self.pid = os.getpid()
+                # Changes made before listening are unknown.
+                return True
+            return bool(next(self.notifications))
+        finally:
+            self.lock.release()
+
+    def get(self, key):
+        """Return the cached targets of `key`, or None if unknown."""
+        if time.monotonic() >= self.expires or self.notified():
+            self.clear()
+            return None
+        if key in self.missing:
+            return []
+        return self.targets.get(key)
+
+    def set(self, key, targets):
+        if len(self.targets) + len(self.missing) >= self.size:
+            self.clear()
+        if targets:
+            self.targets[key] = targets
+        else:
+            self.missing.add(key)
+
+
 class Redirect(db.Model):
 
     model_name = db.CharField(max_length=64)
@@ -281,23 +799,50 @@ class Redirect(db.Model):
         primary_key = peewee.CompositeKey('model_name', 'identifier', 'value',
                                           'model_id')
 
+    cache = RedirectCache()
+
     @classmethod
     def add(cls, instance, identifier, value):
+        cls.add_many([(instance, identifier, value)])
+
+    @classmethod
+    def target(cls, instance, identifier, value):
+        """Return the (model_name, model_id) target of a redirect from
+        `identifier`:`value` to `instance`."""
         if isinstance(instance, tuple):
             # Optim so we don't need to request db when creating a redirect
             # from a diff.
-            model_name, model_id = instance
-        else:
-            model_name = instance.resource
-            model_id = instance.id
-            if identifier not in instance.__class__.identifiers + ['id', 'pk']:
-                raise ValueError('Invalid identifier: {}'.format(identifier))
-            if getattr(instance, identifier) == value:
-                raise ValueError('Redirect cannot point to itself')
-        cls.get_or_create(model_name=model_name,
-                          identifier=identifier,
-                          value=str(value), model_id=model_id)
-        cls.propagate(model_name, identifier, value, model_id)
+            return instance
+        if identifier not in instance.__class__.identifiers + ['id', 'pk']:
+            raise ValueError('Invalid identifier: {}'.format(identifier))
+        if getattr(instance, identifier) == value:
+            raise ValueError('Redirect cannot point to itself')
+        return instance.resource, instance.id
+
+    @classmethod
+    def add_many(cls, redirects):
+        """Add redirects, given as (instance, identifier, value), set-based:
+        one INSERT, then one UPDATE by model and identifier to propagate
+        them."""
+        rows = set()
+        for instance, identifier, value in redirects:
+            model_name, model_id = cls.target(instance, identifier, value)
+            rows.add((model_name, identifier, str(value), model_id))
+        if not rows:
+            return
+        rows = sorted(rows)
+        database = cls._meta.database
+        with database.atomic():
+            database.execute_sql(INSERT_REDIRECTS.format(
+                redirect=table(cls),
+                values=', '.join(['(%s, %s, %s, %s)'] * len(rows))),
+                [v for row in rows for v in row])
+            groups = defaultdict(list)
+            for model_name, identifier, value, model_id in rows:
+                groups[(model_name, identifier)].extend([value, model_id])
+            for (model_name, identifier), params in groups.items():
+                cls.propagate_many(model_name, identifier, params)
+        cls.cache.clear()
 
     @classmethod
     def remove(cls, instance, identifier, value):
@@ -305,45 +850,84 @@ class Redirect(db.Model):
                            cls.identifier == identifier,
                            cls.value == str(value),
                            cls.model_id == instance.id).execute()
+        cls.cache.clear()
 
     @classmethod
     def clear(cls, instance):
         cls.delete().where(cls.model_name == instance.resource,
                            cls.model_id == instance.id).execute()
+        cls.cache.clear()
 
     @classmethod
     def from_diff(cls, diff):
+        cls.add_many(cls.from_diff_redirects(diff))
+
+    @classmethod
+    def from_diff_redirects(cls, diff):
+        """Redirects to add for `diff`, as (target, identifier, value)."""
         if not diff.new or not diff.old:
             # Only update makes sense for us, not creation nor deletion.
-            return
+            return []
         model = diff.new.model
         identifiers = [i for i in model.identifiers if i in diff.diff]
+        redirects = []
         for identifier in identifiers:
             old = diff.diff[identifier]['old']
             new = diff.diff[identifier]['new']
             if not old or not new:
                 continue
-            cls.add((model.__name__.lower(), diff.new.data['id']),
-                    identifier, old)
+            redirects.append(((model.__name__.lower(), diff.new.data['id']),
+                              identifier, old))
+        return redirects
 
     @classmethod
     def follow(cls, model_name, identifier, value):
-        rows = cls.select(cls.model_id).where(
-            cls.model_name == model_name.lower(),
-            cls.identifier == identifier,
-            cls.value == str(value))
-        return [row.model_id for row in rows]
+        key = (model_name.lower(), identifier, str(value))
+        targets = cls.cache.get(key)
+        if targets is None:
+            rows = cls.select(cls.model_id).where(
+                cls.model_name == model_name.lower(),
+                cls.identifier == identifier,
+                cls.value == str(value))
+            targets = [row.model_id for row in rows]
+            cls.cache.set(key, targets)
+        return list(targets)
+
+    @classmethod
+    def compact(cls, max_depth=32):
+        """Point every redirect to the final target of its chain of
+        redirects by id. Return the number of redirects rewritten."""
+        database = cls._meta.database
+        with database.atomic():
+            database.execute_sql('DROP TABLE IF EXISTS redirect_target')
+            database.execute_sql(
+                RESOLVE_REDIRECTS.format(redirect=table(cls)), [max_depth])
+            cursor = database.execute_sql(
+                DELETE_RESOLVED_REDIRECTS.format(redirect=table(cls)))
+            count = cursor.rowcount
+            database.execute_sql(
+                INSERT_RESOLVED_REDIRECTS.format(redirect=table(cls)))
+        cls.cache.clear()
+        return count
 
     @classmethod
     def propagate(cls, model_name, identifier, value, model_id):
         """An identifier was a target and it becomes itself a redirect."""
-        model = BaseVersioned.registry.get(model_name)
-        if model:
-            old = model.first(getattr(model, identifier) == value)
-            if old:
-                cls.update(model_id=model_id).where(
-                    cls.model_id == old.id,
-                    cls.model_name == model_name).execute()
+        cls.propagate_many(model_name, identifier, [str(value), model_id])
+        cls.cache.clear()
+
+    @classmethod
+    def propagate_many(cls, model_name, identifier, params):
+        """Propagate many redirects of the same model and identifier, with
+        `params` as flat value, model_id pairs."""
+        model = BaseVersioned.registry.get(model_name.lower())
+        if not model:
+            return
+        sql = PROPAGATE_REDIRECTS.format(
+            redirect=table(cls), model=table(model),
+            column=getattr(model, identifier).db_column,
+            values=', '.join(['(%s, %s)'] * (len(params) // 2)))
+        cls._meta.database.execute_sql(sql, params + [model_name.lower()])
 
     def serialize(self, *args):
         return '{}:{}'.format(self.identifier, self.value)
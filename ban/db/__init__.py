@@ -1,3 +1,4 @@
 from .fields import *  # noqa
-from .model import Model, SelectQuery  # noqa
+from .model import Model, SelectQuery, table  # noqa
 from .connections import default, test  # noqa
+from .idmap import IdentifierMap  # noqa
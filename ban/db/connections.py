@@ -1,3 +1,5 @@
+import select
+
 from playhouse.postgres_ext import PostgresqlExtDatabase
 from ban.core import config
 import postgis
@@ -12,6 +14,10 @@ class DB(PostgresqlExtDatabase):
         super().__init__(self.prefix + config.DB_NAME, autorollback=True)
 
     def connect(self):
+        self.configure()
+        super().connect()
+
+    def configure(self):
         # Deal with connection kwargs at connect time only, because we want
         # to be able to instantiate the db object bedore patching the
         # connection kwargs: peewee instanciate it at python parse time, while
@@ -23,7 +29,11 @@ class DB(PostgresqlExtDatabase):
             host=config.get('DB_HOST'),
             port=config.get('DB_PORT')
         )
-        super().connect()
+
+    def listen(self, channel, timeout=None):
+        self.configure()
+        return Listener(self._connect(self.database, **self.connect_kwargs),
+                        channel, timeout)
 
     def initialize_connection(self, conn):
         if not self.postgis_registered:
@@ -31,6 +41,37 @@ class DB(PostgresqlExtDatabase):
             self.postgis_registered = True
 
 
+class Listener:
+    """Wait for NOTIFY on `channel`, on its own connection.
+
+    Iterating yields the list of payloads received at each wake up, or an
+    empty list after `timeout` seconds without notification."""
+
+    def __init__(self, conn, channel, timeout=None):
+        self.conn = conn
+        self.timeout = timeout
+        self.conn.autocommit = True
+        with self.conn.cursor() as cursor:
+            cursor.execute('LISTEN "{}"'.format(channel))
+
+    def __iter__(self):
+        while True:
+            if select.select([self.conn], [], [], self.timeout)[0]:
+                self.conn.poll()
+            payloads = [n.payload for n in self.conn.notifies]
+            del self.conn.notifies[:]
+            yield payloads
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
 class TestDB(DB):
     prefix = 'test_'
 
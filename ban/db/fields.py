@@ -80,11 +80,12 @@ postgres_ext.PostgresqlExtDatabase.register_fields({'point':
                                                     'geometry(Point)'})
 
 
-class DateRangeField(peewee.Field):
+class DateRangeField(peewee.Field, postgres_ext.IndexedFieldMixin):
     db_field = 'tstzrange'
     __data_type__ = datetime
     __schema_type__ = 'string'
     __schema_format__ = 'date-time'
+    index_type = 'GiST'
 
     def db_value(self, value):
         return self.coerce(value)
@@ -0,0 +1,184 @@
+import mmap
+import struct
+import threading
+from array import array
+from heapq import merge
+
+import peewee
+from playhouse.postgres_ext import ServerSide
+
+__all__ = ['IdentifierMap']
+
+
+class IdentifierMap:
+    """Memory compact `identifier value → pk` mapping.
+
+    Keys are stored sorted, as utf-8 bytes in one contiguous buffer, with
+    their offsets and pks in `array('q')`, and looked up with a binary
+    search. This costs a few tens of bytes per key, where a dict costs a few
+    hundreds.
+    Keys added after the build go to an overlay dict of at most OVERLAY
+    keys. When full, it is turned into a compact sorted run; runs of close
+    sizes are merged, so an import creating millions of keys holds a few
+    runs (looked up newest first), not a dict of millions of keys.
+    The map can be dumped to a file, and loaded back with mmap, so processes
+    loading the same file share the same memory pages.
+    """
+
+    MAGIC = b'BANIDMAP'
+    HEADER = struct.Struct('=8sqq')  # magic, count, keys size.
+    # Max number of keys in the overlay dict.
+    OVERLAY = 65536
+
+    def __init__(self, keys=b'', offsets=None, pks=None, base=0):
+        self.keys = keys
+        self.base = base  # Where keys start in the `keys` buffer.
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.pks = pks if pks is not None else array('q')
+        self.extra = {}
+        self.runs = []  # Sorted runs of added keys, oldest first.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        # A key added again after the build is counted once by layer.
+        return (len(self.pks) + sum(len(run) for run in self.runs)
+                + len(self.extra))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        pk = self.get(key)
+        if pk is None:
+            raise KeyError(key)
+        return pk
+
+    def __setitem__(self, key, pk):
+        with self.lock:
+            self.extra[key] = pk
+            if len(self.extra) >= self.OVERLAY:
+                self.flush()
+
+    def flush(self):
+        """Turn the overlay into a sorted run, merging the last runs while
+        the previous one is not more than twice as big."""
+        runs = self.runs + [self.build(sorted(self.extra.items()))]
+        while len(runs) > 1 and len(runs[-2]) <= 2 * len(runs[-1]):
+            newer, older = runs.pop(), runs.pop()
+            runs.append(self.build(merged([newer.items(), older.items()])))
+        # Readers may see a key in both, never in none.
+        self.runs = runs
+        self.extra = {}
+
+    def key(self, index):
+        start = self.base + self.offsets[index]
+        end = self.base + self.offsets[index + 1]
+        return bytes(self.keys[start:end])
+
+    def get(self, key, default=None):
+        extra = self.extra
+        if key in extra:
+            return extra[key]
+        for run in reversed(self.runs):
+            pk = run.get(key)
+            if pk is not None:
+                return pk
+        needle = str(key).encode()
+        low, high = 0, len(self.pks)
+        while low < high:
+            middle = (low + high) // 2
+            current = self.key(middle)
+            if current < needle:
+                low = middle + 1
+            elif current > needle:
+                high = middle
+            else:
+                return self.pks[middle]
+        return default
+
+    def items(self):
+        """Iterate over (key, pk), sorted by key."""
+        base = ((self.key(i).decode(), self.pks[i])
+                for i in range(len(self.pks)))
+        layers = [sorted(self.extra.items())]
+        layers.extend(run.items() for run in reversed(self.runs))
+        return merged(layers + [base])
+
+    @classmethod
+    def build(cls, pairs):
+        """Build from an iterable of (key, pk), sorted by key.
+
+        Python str ordering is the same as utf-8 bytes ordering, so either
+        sort in python or in SQL with `COLLATE "C"`."""
+        keys = bytearray()
+        offsets = array('q', [0])
+        pks = array('q')
+        previous = None
+        for key, pk in pairs:
+            key = str(key).encode()
+            if previous is not None and key <= previous:
+                raise ValueError('Keys must be sorted and unique, got `{}` '
+                                 'after `{}`'.format(key, previous))
+            keys.extend(key)
+            offsets.append(len(keys))
+            pks.append(pk)
+            previous = key
+        return cls(bytes(keys), offsets, pks)
+
+    @classmethod
+    def from_field(cls, field, *expressions):
+        """Build from the values of `field` (of the rows matching
+        `expressions`, if any), streaming them from a server-side cursor."""
+        model = field.model_class
+        order = peewee.SQL('"{}" COLLATE "C"'.format(field.db_column))
+        qs = (model.select(field, model.pk)
+                   .where(field.is_null(False), field != '', *expressions)
+                   .order_by(order).tuples())
+        return cls.build(ServerSide(qs))
+
+    def dump(self, path):
+        if self.extra or self.runs:
+            idmap = self.build(self.items())
+        else:
+            idmap = self
+        count = len(idmap.pks)
+        size = idmap.offsets[-1]
+        with open(str(path), 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, count, size))
+            f.write(idmap.offsets.tobytes())
+            f.write(idmap.pks.tobytes())
+            f.write(idmap.key_bytes())
+
+    def key_bytes(self):
+        return bytes(self.keys[self.base:self.base + self.offsets[-1]])
+
+    @classmethod
+    def load(cls, path):
+        """Load a dumped map, memory-mapping the file read-only."""
+        with open(str(path), 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count, size = cls.HEADER.unpack_from(buffer)
+        if magic != cls.MAGIC:
+            raise ValueError('Invalid identifier map file {}'.format(path))
+        view = memoryview(buffer)
+        start = cls.HEADER.size
+        offsets = view[start:start + (count + 1) * 8].cast('q')
+        start += (count + 1) * 8
+        pks = view[start:start + count * 8].cast('q')
+        start += count * 8
+        return cls(buffer, offsets, pks, base=start)
+
+
+def merged(layers):
+    """Merge iterables of (key, pk) sorted by key, the first layers winning
+    for keys found in many."""
+    def tag(rank, layer):
+        for key, pk in layer:
+            yield key, rank, pk
+
+    tagged = [tag(rank, layer) for rank, layer in enumerate(layers)]
+    previous = None
+    for key, rank, pk in merge(*tagged):
+        if key != previous:
+            yield key, pk
+            previous = key
@@ -1,8 +1,27 @@
+from itertools import islice
+
 import peewee
 
 from .connections import default
 
 
+class ServerSideCursor:
+    """Let peewee result wrappers read a named cursor, which fetches its rows
+    from the server by `itersize` when iterated (but one by one with
+    `fetchone`)."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rows = iter(cursor)
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+
 class SerializerQueryResultWrapper(peewee.ModelQueryResultWrapper):
 
     def process_row(self, row):
@@ -22,9 +41,33 @@ class SelectQuery(peewee.SelectQuery):
 
     @peewee.returns_clone
     def serialize(self, mask=None):
-        self._serializer = lambda inst: inst.serialize(mask)
+        serializer = getattr(self.model_class, 'serializer', None)
+        if serializer:
+            # Compile the mask once for the whole query.
+            self._serializer = serializer(mask)
+        else:
+            self._serializer = lambda inst: inst.serialize(mask)
         self._result_wrapper = SerializerQueryResultWrapper
 
+    def stream(self, size=100):
+        """Iterate over the instances by lists of `size`, through a server
+        side cursor, so the whole result is never loaded in memory."""
+        sql, params = self.sql()
+        # Named cursors only live in a transaction.
+        with self.database.atomic():
+            cursor = self.database.get_conn().cursor(
+                name='stream_{}'.format(id(self)))
+            cursor.itersize = size
+            try:
+                cursor.execute(sql, params)
+                wrapper = self._get_result_wrapper()(
+                    self.model_class, ServerSideCursor(cursor),
+                    self.get_query_meta())
+                rows = iter(wrapper)
+                yield from iter(lambda: list(islice(rows, size)), [])
+            finally:
+                cursor.close()
+
     def _get_result_wrapper(self):
         wrapper = getattr(self, '_result_wrapper', None)
         if wrapper:
@@ -34,6 +77,15 @@ class SelectQuery(peewee.SelectQuery):
     def __len__(self):
         return self.count()
 
+    def estimate(self):
+        """Number of rows the planner expects, without running the query.
+        Based on the table statistics, so it may be far from exact."""
+        sql, params = self.sql()
+        cursor = self.database.execute_sql('EXPLAIN (FORMAT JSON) ' + sql,
+                                           params)
+        plan = cursor.fetchone()[0]
+        return plan[0]['Plan']['Plan Rows']
+
     def __getitem__(self, value):
         if isinstance(value, slice):
             # When doing a slice, Peewee execute the whole query and do a slice
@@ -44,6 +96,11 @@ class SelectQuery(peewee.SelectQuery):
         return super().__getitem__(value)
 
 
+def table(model):
+    """Quoted table name of `model`, for raw SQL."""
+    return '"{}"'.format(model._meta.db_table)
+
+
 class Model(peewee.Model):
 
     # id is reserved for BAN external id, but lets be consistent and use the
@@ -1,27 +1,43 @@
-from io import StringIO
+import uuid
+from functools import partial
+from itertools import chain, islice
 from urllib.parse import urlencode
 
 import peewee
-from flask import request, url_for
+from flask import Response, request, stream_with_context, url_for
 
 from ban.auth import models as amodels
-from ban.commands.bal import bal
-from ban.core import context, models, versioning
+from ban.core import config, context, models, versioning
 from ban.core.encoder import dumps
 from ban.core.exceptions import (IsDeletedError, MultipleRedirectsError,
                                  RedirectError, ResourceLinkedError)
+from ban.core.jobs import Job
 from ban.http.auth import auth
 from ban.http.wsgi import app
-from ban.utils import parse_mask
+from ban.utils import parse_datetime, parse_mask
 
 from .utils import abort, get_bbox, link
 
+# Seconds between two keep-alive comments of an idle diff stream.
+KEEP_ALIVE = 15
+# Increments are taken when diffs are created, so a transaction committed
+# after another one may bring lower increments: a diff stream reads again
+# this many increments behind the last one sent (DIFF_STREAM_WINDOW setting).
+STREAM_WINDOW = 1000
+
 
 class CollectionEndpoint:
 
     filters = []
     DEFAULT_LIMIT = 20
     MAX_LIMIT = 1000
+    # Pages of at least this size are streamed (COLLECTION_STREAM setting, 0
+    # disables streaming).
+    STREAM_THRESHOLD = 100
+    STREAM_CHUNK = 100
+    # How to compute the total (`total` arg or COLLECTION_TOTAL setting):
+    # count, planner estimate or no total at all.
+    TOTAL_STRATEGIES = ('exact', 'estimated', 'none')
 
     def get_limit(self):
         return min(int(request.args.get('limit', self.DEFAULT_LIMIT)),
@@ -33,18 +49,51 @@ class CollectionEndpoint:
         except (ValueError, TypeError):
             return 0
 
-    def collection(self, queryset):
+    def get_total_strategy(self, queryset, default=None):
+        strategy = (request.args.get('total') or default or
+                    config.get('COLLECTION_TOTAL') or 'exact')
+        if strategy not in self.TOTAL_STRATEGIES:
+            abort(400, error='Invalid value for total')
+        if strategy == 'estimated' and not hasattr(queryset, 'estimate'):
+            # Lists are cheap to count.
+            strategy = 'exact'
+        return strategy
+
+    def collection(self, queryset, serialize=None):
+        """Paginate `queryset`. `serialize`, if given, is called with the
+        instances of the page, eg. to serialize them in bulk."""
         limit = self.get_limit()
         offset = self.get_offset()
         end = offset + limit
-        count = len(queryset)
-        data = {
-            'collection': list(queryset[offset:end]),
-            'total': count,
-        }
+        strategy = self.get_total_strategy(queryset)
+        data = {}
+        if strategy == 'exact':
+            data['total'] = len(queryset)
+            more = data['total'] > end
+        elif strategy == 'estimated':
+            data['total'] = queryset.estimate()
+        data['total_strategy'] = strategy
+        page = None
+        if self.should_stream(queryset, serialize, limit):
+            # Fail early on invalid mask, before starting the response.
+            serialize([])
+            page = queryset.limit(limit).offset(offset)
+            if strategy != 'exact':
+                more = bool(list(queryset.limit(1).offset(end)))
+        else:
+            if strategy == 'exact':
+                items = list(queryset[offset:end])
+            else:
+                # One more row tells if there is a next page.
+                items = list(queryset[offset:end + 1])
+                more = len(items) > limit
+                items = items[:limit]
+            if serialize:
+                items = serialize(items)
+            data = dict(collection=items, **data)
         headers = {}
         url = request.base_url
-        if count > end:
+        if more:
             query_string = request.args.copy()
             query_string['offset'] = end
             uri = '{}?{}'.format(url, urlencode(sorted(query_string.items())))
@@ -56,8 +105,29 @@ class CollectionEndpoint:
             uri = '{}?{}'.format(url, urlencode(sorted(query_string.items())))
             data['previous'] = uri
             link(headers, uri, 'previous')
+        if page is not None:
+            return self.stream(page, serialize, data), 200, headers
         return data, 200, headers
 
+    def should_stream(self, queryset, serialize, limit):
+        threshold = config.get('COLLECTION_STREAM')
+        if threshold is None:
+            threshold = self.STREAM_THRESHOLD
+        threshold = int(threshold)
+        return (serialize is not None and hasattr(queryset, 'stream')
+                and 0 < threshold <= limit)
+
+    def stream(self, queryset, serialize, data):
+        """Yield the same JSON document than `collection`, encoding the
+        items as they are read, by chunks."""
+        yield '{"collection": ['
+        sep = ''
+        for instances in queryset.stream(self.STREAM_CHUNK):
+            for item in serialize(instances):
+                yield sep + dumps(item)
+                sep = ', '
+        yield '], ' + dumps(data)[1:]
+
 
 class ModelEndpoint(CollectionEndpoint):
     endpoints = {}
@@ -98,6 +168,10 @@ class ModelEndpoint(CollectionEndpoint):
             abort(409, error=str(e))
         return instance
 
+    def get_at(self):
+        # Only versioned resources can be requested at a past datetime.
+        return None
+
     def get_queryset(self):
         qs = self.model.select()
         for key in self.filters:
@@ -118,6 +192,16 @@ class ModelEndpoint(CollectionEndpoint):
                 qs = qs.where(field << values)
         return qs
 
+    def get_history_order(self):
+        """`order_by` as document fields, to sort versions the same way."""
+        terms = []
+        for item in self.order_by or []:
+            if isinstance(item, peewee.SQL):
+                terms.append(item.value)
+            else:
+                terms.append(item.name)
+        return terms
+
     def get_mask(self):
         fields = request.args.get('fields', '*')
         return parse_mask(fields)
@@ -134,6 +218,18 @@ class ModelEndpoint(CollectionEndpoint):
     def get_collection(self):
         """Get {resource} collection.
 
+        parameters:
+        - name: at
+          in: query
+          description: Get the resources as they were at this datetime
+          type: string
+          format: date-time
+          required: false
+        - name: total
+          in: query
+          description: How to compute the total (exact, estimated or none)
+          type: string
+          required: false
         responses:
             200:
                 description: Get {resource} collection.
@@ -149,16 +245,37 @@ class ModelEndpoint(CollectionEndpoint):
                         name: total
                         type: integer
                         description: total resources available
+                      total_strategy:
+                        name: total_strategy
+                        type: string
+                        description: how the total has been computed
         """
-        qs = self.get_queryset()
-        if qs is None:
-            return self.collection([])
-        if not isinstance(qs, list):
-            order_by = (self.order_by if self.order_by is not None
-                        else [self.model.pk])
-            qs = qs.order_by(*order_by).serialize(self.get_collection_mask())
+        serialize = None
+        at = self.get_at()
+        if at:
+            # Filters would match the current values, not those at `at`.
+            if (any(request.args.getlist(key) for key in self.filters)
+                    or get_bbox(request.args)):
+                abort(400, error='Filters not available with `at`')
+            qs = versioning.History(self.model, at,
+                                    self.get_collection_mask(),
+                                    order_by=self.get_history_order())
+        else:
+            qs = self.get_queryset()
+            if qs is None:
+                return self.collection([])
+            if not isinstance(qs, list):
+                order_by = (self.order_by if self.order_by is not None
+                            else [self.model.pk])
+                mask = self.get_collection_mask()
+                qs = qs.order_by(*order_by)
+                columns = self.model.columns(mask)
+                if columns:
+                    qs = qs.select(*columns)
+                # Relations of the page are loaded in bulk, given the mask.
+                serialize = partial(self.model.serialize_many, mask=mask)
         try:
-            return self.collection(qs)
+            return self.collection(qs, serialize)
         except ValueError as e:
             abort(400, error=str(e))
 
@@ -342,6 +459,16 @@ class ModelEndpoint(CollectionEndpoint):
 
 
 class VersionedModelEnpoint(ModelEndpoint):
+
+    def get_at(self):
+        at = request.args.get('at')
+        if not at:
+            return None
+        try:
+            return parse_datetime(at)
+        except ValueError:
+            abort(400, error='Invalid value for at')
+
     @auth.require_oauth()
     @app.jsonify
     @app.endpoint('/<identifier>/versions', methods=['GET'])
@@ -359,7 +486,14 @@ class VersionedModelEnpoint(ModelEndpoint):
                         $ref: '#/definitions/Version'
         """
         instance = self.get_object(identifier)
-        return self.collection(instance.versions.serialize())
+        return self.collection(instance.versions,
+                               serialize=self.serialize_versions)
+
+    @staticmethod
+    def serialize_versions(versions):
+        versions = versioning.Version.prefetch_flags(versions)
+        versioning.Version.rebuild(versions)
+        return [version.serialize() for version in versions]
 
     @auth.require_oauth()
     @app.jsonify
@@ -515,8 +649,8 @@ class HouseNumber(VersionedModelEnpoint):
             # `serialize`), and CompoundSelect is hardcoded in peewee
             # SelectQuery, and we'd need to copy-paste code to be able to use
             # a custom CompoundQuery class instead.
-            mask = self.get_collection_mask()
-            qs = [h.serialize(mask) for h in qs.order_by(*self.order_by)]
+            qs = self.model.serialize_many(list(qs.order_by(*self.order_by)),
+                                           self.get_collection_mask())
         return qs
 
     filter_ancestors = filter_group = filter_ancestors_and_group
@@ -554,18 +688,46 @@ class User(ModelEndpoint):
 
 @app.route('/import/bal', methods=['POST'])
 @auth.require_oauth()
+@app.jsonify
 def bal_post():
-    """Import file at BAL format."""
+    """Queue the import of a file at BAL format, run by `ban job:work`."""
     data = request.files['data']
-    bal(StringIO(data.read().decode('utf-8-sig')))
-    reporter = context.get('reporter')
-    return dumps({'report': reporter})
+    # Streamed to disk, not to load the whole file in memory.
+    path = Job.upload_path('{}.csv'.format(uuid.uuid4().hex))
+    data.save(str(path))
+    job = Job.create(kind='bal', path=str(path),
+                     session=context.get('session'))
+    location = url_for('import_get', job=job.pk)
+    return job.serialize(), 202, {'Location': location}
+
+
+@app.route('/import/<int:job>', methods=['GET'])
+@auth.require_oauth()
+@app.jsonify
+def import_get(job):
+    """Get the status, progress and report of an import job."""
+    try:
+        instance = Job.get(Job.pk == job)
+    except Job.DoesNotExist:
+        instance = None
+    # Do not tell others' jobs exist.
+    if not instance or not instance.is_owned_by(context.get('session')):
+        abort(404, error='Job `{}` not found'.format(job))
+    return instance.serialize()
 
 
 @app.resource
 class DiffEndpoint(CollectionEndpoint):
     endpoint = '/diff'
     model = versioning.Diff
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 10000
+
+    def get_limit(self):
+        # Page size may be tuned for the mirrors (DIFF_PAGE_SIZE setting).
+        default = int(config.get('DIFF_PAGE_SIZE') or self.DEFAULT_LIMIT)
+        limit = int(request.args.get('limit', default))
+        return max(1, min(limit, self.MAX_LIMIT))
 
     @auth.require_oauth()
     @app.jsonify
@@ -573,12 +735,25 @@ class DiffEndpoint(CollectionEndpoint):
     def get_collection(self):
         """Get database diffs.
 
+        Diffs are paginated by increment: the `next` link carries the last
+        increment of the page, so pages cost the same whatever their depth.
+
         parameters:
         - name: increment
           in: query
-          description: The minimal increment value to retrieve
+          description: Retrieve diffs after this increment
+          type: integer
+          required: false
+        - name: limit
+          in: query
+          description: Number of diffs per page
           type: integer
           required: false
+        - name: total
+          in: query
+          description: How to compute the total (exact, estimated or none)
+          type: string
+          required: false
         responses:
           200:
             description: A list of diff objects
@@ -594,7 +769,86 @@ class DiffEndpoint(CollectionEndpoint):
             pass
         else:
             qs = qs.where(versioning.Diff.pk > increment)
-        return self.collection(qs.serialize())
+        try:
+            limit = self.get_limit()
+        except ValueError:
+            abort(400, error='Invalid value for limit')
+        # One more row tells if there is a next page, without counting.
+        diffs = list(qs.order_by(versioning.Diff.pk).limit(limit + 1))
+        page = versioning.Diff.prefetch(diffs[:limit])
+        data = {'collection': [diff.serialize() for diff in page]}
+        headers = {}
+        # Counting is slow on a large history: not done unless asked for.
+        strategy = self.get_total_strategy(qs, default='none')
+        if strategy == 'exact':
+            data['total'] = qs.count()
+        elif strategy == 'estimated':
+            data['total'] = qs.estimate()
+        if len(diffs) > limit:
+            query_string = request.args.copy()
+            query_string['increment'] = diffs[limit - 1].pk
+            uri = '{}?{}'.format(request.base_url,
+                                 urlencode(sorted(query_string.items())))
+            data['next'] = uri
+            link(headers, uri, 'next')
+        return data, 200, headers
+
+
+@app.route('/diff/stream', methods=['GET'])
+@auth.require_oauth()
+def diff_stream():
+    """Stream diffs as Server-Sent Events, as soon as they are committed.
+
+    Starts after the `Last-Event-ID` header (or `increment` arg) if any, else
+    with the next diff. Diffs committed late are still sent, out of order, if
+    their increment is within STREAM_WINDOW of the last one sent; the event
+    id is always the highest increment sent. Each request holds a worker and
+    a database connection while streaming, so it needs an async server."""
+    Diff = versioning.Diff
+    last = request.headers.get('Last-Event-ID', request.args.get('increment'))
+    try:
+        last = int(last) if last else (Diff.select(peewee.fn.MAX(Diff.pk))
+                                           .order_by().scalar())
+    except ValueError:
+        abort(400, error='Invalid value for Last-Event-ID')
+    last = last or 0
+    window = int(config.get('DIFF_STREAM_WINDOW') or STREAM_WINDOW)
+    # Not to send again the diffs the client already has.
+    floor = last
+
+    def stream():
+        nonlocal last
+        # Increments sent within the window.
+        sent = set()
+        # Opened by the generator: a response never iterated holds no
+        # connection. Listen before catching up, not to miss diffs committed
+        # in between.
+        listener = Diff._meta.database.listen(Diff.CHANNEL,
+                                              timeout=KEEP_ALIVE)
+        with listener:
+            # Catch up first, then each time diffs are notified.
+            for payloads in chain([None], listener):
+                if payloads == []:
+                    # Keep the connection open through proxies.
+                    yield ': keep-alive\n\n'
+                    continue
+                pks = (Diff.select(Diff.pk)
+                           .where(Diff.pk > max(floor, last - window))
+                           .order_by(Diff.pk).tuples().iterator())
+                new = (pk for pk, in pks if pk not in sent)
+                for page in iter(lambda: list(islice(new, 100)), []):
+                    diffs = list(Diff.select().where(Diff.pk << page)
+                                     .order_by(Diff.pk))
+                    for diff in Diff.prefetch(diffs):
+                        sent.add(diff.pk)
+                        last = max(last, diff.pk)
+                        yield 'id: {}\nevent: diff\ndata: {}\n\n'.format(
+                            last, dumps(diff.serialize()))
+                    sent = {pk for pk in sent if pk > last - window}
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(stream()), headers=headers,
+                    mimetype='text/event-stream')
 
 
 @app.route('/openapi', methods=['GET'])
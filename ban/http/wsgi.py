@@ -1,14 +1,14 @@
 import re
-from datetime import timezone
 from functools import wraps
+from types import GeneratorType
 
-from dateutil.parser import parse as parse_date
-from flask import Flask, make_response
+from flask import Flask, Response, make_response, stream_with_context
 from flask_cors import CORS
 from werkzeug.routing import BaseConverter, ValidationError
 
 from ban.core import context
 from ban.core.encoder import dumps
+from ban.utils import parse_datetime
 
 from .schema import Schema
 
@@ -24,7 +24,11 @@ class App(Flask):
                 rv = [rv]
             else:
                 rv = list(rv)
-            rv[0] = dumps(rv[0])
+            if isinstance(rv[0], GeneratorType):
+                # Already encoded JSON chunks.
+                rv[0] = Response(stream_with_context(rv[0]))
+            else:
+                rv[0] = dumps(rv[0])
             resp = make_response(tuple(rv))
             resp.mimetype = 'application/json'
             return resp
@@ -65,14 +69,9 @@ class DateTimeConverter(BaseConverter):
 
     def to_python(self, value):
         try:
-            value = parse_date(value)
+            return parse_datetime(value)
         except ValueError:
             raise ValidationError
-        # Be smart, imply that naive dt are in the same tz the API
-        # exposes, which is UTC.
-        if not value.tzinfo:
-            value = value.replace(tzinfo=timezone.utc)
-        return value
 
 
 app = application = App(__name__)
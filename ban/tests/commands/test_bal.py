@@ -2,6 +2,7 @@ import codecs
 from io import StringIO
 from pathlib import Path
 
+from ban.commands import helpers
 from ban.commands.bal import bal
 from ban.core import models
 from ban.tests import factories
@@ -261,3 +262,36 @@ def test_bal_should_create_position_if_kind_does_not_exist(staff):
     assert position.center == (-1.52808691540987, 48.1396656060165)
     position.housenumber == housenumber
     old_position.housenumber == housenumber
+
+
+def test_bal_should_accept_limit(staff):
+    factories.MunicipalityFactory(name="Acigné", insee="35001")
+    content = """cle_interop,uid_adresse,voie_nom,numero,suffixe,commune_nom,position,x,y,long,lat,source,date_der_maj
+35001_0005_99999,,Mail Anita Conti,99999,,Acigné,,,,,,Rennes Métropole,2016-02-22
+35001_0006_99999,,Rue Autre,99999,,Acigné,,,,,,Rennes Métropole,2016-02-22
+"""
+    bal(StringIO(content), limit=1)
+    assert models.Group.select().count() == 1
+    assert models.Group.select().first().fantoir == "350010005"
+
+
+def test_bal_progress_is_in_bytes_of_the_file(staff, tmpdir, monkeypatch):
+    factories.MunicipalityFactory(name="Acigné", insee="35001")
+    path = tmpdir.join('bal.csv')
+    path.write("""cle_interop,uid_adresse,voie_nom,numero,suffixe,commune_nom,position,x,y,long,lat,source,date_der_maj
+35001_0005_99999,,Mail Anita Conti,99999,,Acigné,,,,,,Rennes Métropole,2016-02-22
+""")
+    progresses = []
+    batch = helpers.batch
+
+    def spy(func, rows, **kwargs):
+        progresses.append(kwargs['progress'])
+        return batch(func, rows, **kwargs)
+
+    monkeypatch.setattr(helpers, 'batch', spy)
+    bal(str(path))
+    assert models.Group.select().count() == 1
+    progress, = progresses
+    assert isinstance(progress, helpers.FileBar)
+    assert progress.total == path.size()
+    assert progress.position() == path.size()
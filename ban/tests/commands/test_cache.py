@@ -0,0 +1,54 @@
+from ban.commands import cache
+from ban.core import models
+from ban.tests import factories
+
+
+def test_cache_preloads_references():
+    housenumber = factories.HouseNumberFactory(ign='ADRNIVX_0000000259416737')
+    postcode = factories.PostCodeFactory(code='90400',
+                                         municipality__insee='90001')
+    references = cache.get()
+    group = housenumber.parent
+    municipality = postcode.municipality
+    assert references.get(models.Municipality, 'insee',
+                          '90001') == municipality.pk
+    assert references.postcode('90400', '90001') == postcode.pk
+    assert references.get(models.Group, 'fantoir', group.fantoir) == group.pk
+    assert references.get(models.HouseNumber, 'cia',
+                          housenumber.cia) == housenumber.pk
+    assert references.get(models.HouseNumber, 'ign',
+                          'ADRNIVX_0000000259416737') == housenumber.pk
+    assert references.get(models.HouseNumber, 'laposte', 'xxx') is None
+
+
+def test_cache_is_updated_on_add():
+    references = cache.get()
+    group = factories.GroupFactory(fantoir='900010016')
+    assert references.get(models.Group, 'fantoir', '900010016') is None
+    references.add(group)
+    assert references.get(models.Group, 'fantoir', '900010016') == group.pk
+
+
+def test_cache_is_built_once():
+    assert cache.get() is cache.get()
+    first = cache.get()
+    cache.reset()
+    assert cache.get() is not first
+
+
+def test_shared_cache_in_process_mode_is_loaded_from_files(config):
+    config.BATCH_EXECUTOR = 'process'
+    municipality = factories.MunicipalityFactory(insee='90001')
+    postcode = factories.PostCodeFactory(code='90400',
+                                         municipality=municipality)
+    with cache.shared() as references:
+        assert config.REFERENCES_PATH
+        assert not references.complete
+        assert references.get(models.Municipality, 'insee',
+                              '90001') == municipality.pk
+        assert references.postcode('90400', '90001') == postcode.pk
+        # Created by another worker: must be looked up in the database.
+        group = factories.GroupFactory(fantoir='900010016')
+        assert references.get(models.Group, 'fantoir',
+                              '900010016') == group.pk
+    assert config.get('REFERENCES_PATH') is None
@@ -1,15 +1,23 @@
+import gzip
 import json
+from datetime import date, datetime, timezone
 from unittest.mock import Mock
 from pathlib import Path
 
+import pytest
+
 from ban.auth import models as amodels
 from ban.commands.auth import (createclient, createuser, dummytoken,
                                listclients, listusers)
-from ban.commands.db import truncate
+from ban import db
+from ban.commands.db import (add_months, archive, compact, migrate,
+                             partition, partitions, truncate)
 from ban.commands.export import resources
 from ban.core import models
+from ban.core.versioning import Diff
 from ban.core.encoder import dumps
 from ban.tests import factories
+from ban.utils import utcnow
 
 
 def test_create_user_is_not_staff_by_default(monkeypatch):
@@ -79,6 +87,113 @@ def test_listclients(capsys):
     assert client.client_secret in out
 
 
+def test_compact_should_store_versions_as_deltas(config):
+    group = factories.GroupFactory(name='Rue 1')
+    for name in ['Rue 2', 'Rue 3']:
+        group.name = name
+        group.increment_version()
+        group.save()
+    documents = [v.data for v in group.versions]
+    config.VERSION_KEYFRAME = 2
+    compact()
+    versions = list(group.versions)
+    assert [v.snapshot is not None for v in versions] == [True, False, True]
+    assert [v.data for v in versions] == documents
+    # Back to full documents.
+    config.VERSION_KEYFRAME = 0
+    compact()
+    versions = list(group.versions)
+    assert [v.snapshot for v in versions] == documents
+    assert [v.delta for v in versions] == [None, None, None]
+
+
+def test_migrate_should_add_delta_column(rollback):
+    group = factories.GroupFactory(name='Rue 1')
+    db.test.execute_sql('ALTER TABLE version DROP COLUMN delta')
+    migrate()
+    migrate()  # Idempotent.
+    assert [v.data['name'] for v in group.versions] == ['Rue 1']
+    assert [v.delta for v in group.versions] == [None]
+
+
+def test_migrate_should_add_period_index(rollback):
+    db.test.execute_sql('DROP INDEX IF EXISTS version_period')
+    migrate()
+    migrate()  # Idempotent.
+    assert db.test.execute_sql(
+        "SELECT to_regclass('version_period') IS NOT NULL").fetchone()[0]
+
+
+def test_add_months_should_roll_over_years():
+    assert add_months(date(2016, 11, 23), 1) == date(2016, 12, 1)
+    assert add_months(date(2016, 11, 23), 2) == date(2017, 1, 1)
+    assert add_months(date(2016, 1, 1), -1) == date(2015, 12, 1)
+
+
+@pytest.fixture
+def rollback():
+    # Partitioning can't be undone: keep it in a transaction rolled back
+    # after the test.
+    with db.test.atomic() as transaction:
+        yield
+        transaction.rollback()
+
+
+def count(table):
+    sql = 'SELECT count(*) FROM "{}"'.format(table)
+    return db.test.execute_sql(sql).fetchone()[0]
+
+
+def test_partition_should_refuse_to_drop_constraints_silently(rollback):
+    with pytest.raises(SystemExit):
+        partition()
+    assert not partitions(db.test, 'diff')
+
+
+def test_partition_should_keep_data_and_accept_writes(rollback):
+    municipality = factories.MunicipalityFactory(name='Moret-sur-Loing')
+    partition(drop_constraints=True)
+    today = utcnow()
+    assert '{:diff_%Y_%m}'.format(today) in partitions(db.test, 'diff')
+    assert 'version_municipality' in partitions(db.test, 'version')
+    assert Diff.select().count() == 1
+    municipality.name = 'Orvanne'
+    municipality.increment_version()
+    municipality.save()
+    assert Diff.select().count() == 2
+    assert count('{:diff_%Y_%m}'.format(today)) == 2
+    assert [v.data['name'] for v in municipality.versions] == [
+        'Moret-sur-Loing', 'Orvanne']
+
+
+def test_partition_should_move_rows_out_of_default_partition(rollback):
+    factories.MunicipalityFactory()
+    partition(drop_constraints=True, ahead=1)
+    later = add_months(utcnow().date(), 3)
+    Diff.update(created_at=datetime(later.year, later.month, 2,
+                                    tzinfo=timezone.utc)).execute()
+    assert count('diff_default') == 1
+    partition(ahead=3)
+    assert count('diff_default') == 0
+    assert count('{:diff_%Y_%m}'.format(later)) == 1
+
+
+def test_archive_should_export_and_detach_old_partitions(rollback, tmpdir):
+    factories.MunicipalityFactory(name='Moret-sur-Loing')
+    Diff.update(created_at=datetime(2015, 1, 15,
+                                    tzinfo=timezone.utc)).execute()
+    partition(drop_constraints=True)
+    assert Diff.select().count() == 1
+    archive(before='2016-01', path=str(tmpdir))
+    assert not Diff.select().count()
+    assert 'diff_2015_01' not in partitions(db.test, 'diff')
+    assert count('diff_2015_01') == 1  # Detached, not dropped.
+    with gzip.open(str(tmpdir.join('diff_2015_01.ndjson.gz')), 'rt') as f:
+        rows = [json.loads(line) for line in f]
+    assert len(rows) == 1
+    assert rows[0]['diff']['name']['new'] == 'Moret-sur-Loing'
+
+
 def test_truncate_should_truncate_all_tables_by_default(monkeypatch):
     factories.MunicipalityFactory()
     factories.GroupFactory()
@@ -124,6 +239,26 @@ def test_export_resources():
     path.unlink()
 
 
+def test_export_resources_at_a_past_datetime():
+    mun = factories.MunicipalityFactory(name='Moret-sur-Loing')
+    at = utcnow()
+    mun.name = 'Orvanne'
+    mun.increment_version()
+    mun.save()
+    factories.MunicipalityFactory()  # Created after `at`.
+    path = Path(__file__).parent / 'data/export.sjson'
+    resources(path, at=at.isoformat())
+
+    with path.open() as f:
+        lines = f.readlines()
+        assert len(lines) == 1
+        data = json.loads(lines[0])
+        assert data['id'] == mun.id
+        assert data['name'] == 'Moret-sur-Loing'
+        assert data['version'] == 1
+    path.unlink()
+
+
 def test_dummytoken():
     factories.UserFactory(is_staff=True)
     token = 'tokenname'
@@ -0,0 +1,163 @@
+import threading
+from collections import Counter
+
+import peewee
+
+from ban.commands import helpers, reporter as report
+from ban.core import models
+from ban.core.versioning import Version
+from ban.tests import factories
+
+
+def test_batch_dispatches_chunks(config, reporter, monkeypatch):
+    config.WORKERS = 2
+    config.VERBOSE = 2
+    sizes = []
+    collect_report = helpers.collect_report
+
+    def collect(func, chunk, *args):
+        sizes.append(len(chunk))
+        return collect_report(func, chunk, *args)
+
+    monkeypatch.setattr('ban.commands.helpers.collect_report', collect)
+
+    def func(item):
+        report.warning('Seen', item)
+
+    helpers.batch(func, [1, 2, None, 3, 4, 5], chunksize=2, progress=False)
+    assert sorted(sizes) == [1, 2, 2]
+    seen = reporter._reports[report.WARNING]['Seen']
+    assert sorted(seen) == [1, 2, 3, 4, 5]
+
+
+def test_commit_rolls_back_only_failing_item(reporter):
+    def func(insee):
+        factories.MunicipalityFactory(insee=insee)
+        if insee == '90002':
+            raise peewee.IntegrityError('Duplicate')
+
+    helpers.commit(func, ['90001', '90002', '90003'])
+    assert [m.insee for m in models.Municipality.select().order_by(
+        models.Municipality.insee)] == ['90001', '90003']
+    errors = reporter._reports[report.ERROR]['Integrity Error']
+    assert errors == [('Duplicate', '90002')]
+
+
+def test_commit_reports_any_error_of_an_item(reporter):
+    def func(insee):
+        factories.MunicipalityFactory(insee=insee)
+        if insee == '90002':
+            models.Municipality._meta.database.execute_sql('SELECT 1/0')
+        if insee == '90003':
+            raise ValueError('Invalid')
+
+    helpers.commit(func, ['90001', '90002', '90003', '90004'])
+    assert [m.insee for m in models.Municipality.select().order_by(
+        models.Municipality.insee)] == ['90001', '90004']
+    errors = reporter._reports[report.ERROR]
+    assert errors['Database Error'][0][1] == '90002'
+    assert errors['Error'] == [('Invalid', '90003')]
+
+
+def test_commit_stores_versions_at_once(monkeypatch, reporter):
+    stored = []
+    store = Version.store
+
+    def spy(instances):
+        instances = list(instances)
+        stored.append(sorted(i.version for i in instances))
+        return store(instances)
+
+    monkeypatch.setattr(Version, 'store', staticmethod(spy))
+
+    def func(insee):
+        municipality = factories.MunicipalityFactory(insee=insee)
+        if insee == '90002':
+            raise peewee.IntegrityError('Duplicate')
+        if insee == '90003':
+            municipality.name = 'Renamed'
+            municipality.increment_version()
+            municipality.save()
+
+    helpers.commit(func, ['90001', '90002', '90003'])
+    # Version 1 of 90003 is stored before its version 2.
+    assert stored == [[1], [1, 2]]
+    versions = Version.select().order_by(Version.model_pk, Version.sequential)
+    assert [(v.data['insee'], v.sequential) for v in versions] == [
+        ('90001', 1), ('90003', 1), ('90003', 2)]
+    assert versions[1].period.upper == versions[2].period.lower
+
+
+def test_commit_replays_items_one_by_one_if_versions_fail(monkeypatch,
+                                                          reporter):
+    store = Version.store
+
+    def failing(instances):
+        instances = list(instances)
+        if any(i.as_version['insee'] == '90002' for i in instances):
+            raise peewee.IntegrityError('Invalid version')
+        return store(instances)
+
+    monkeypatch.setattr(Version, 'store', staticmethod(failing))
+
+    def func(insee):
+        factories.MunicipalityFactory(insee=insee)
+        report.notice('Created', insee)
+
+    helpers.commit(func, ['90001', '90002', '90003'])
+    assert [m.insee for m in models.Municipality.select().order_by(
+        models.Municipality.insee)] == ['90001', '90003']
+    assert Version.select().count() == 2
+    # Notices of the rolled back group are not counted twice.
+    assert reporter._reports[report.NOTICE]['Created'] == 2
+    errors = reporter._reports[report.ERROR]['Integrity Error']
+    assert errors == [('Invalid version', '90002')]
+
+
+def test_batch_does_not_run_same_partition_concurrently(config, reporter):
+    config.WORKERS = 4
+    config.VERBOSE = 2
+    lock = threading.Lock()
+    hold = threading.Event()  # Never set: only used to block a while.
+    running = Counter()
+    concurrent = []
+    overlaps = []
+
+    def func(item):
+        key = item % 3
+        with lock:
+            if running[key]:
+                overlaps.append(item)
+            running[key] += 1
+            concurrent.append(len(+running))
+        # Keep the partition busy, so items of the same partition would
+        # overlap if run concurrently.
+        hold.wait(0.005)
+        with lock:
+            running[key] -= 1
+        report.warning('Seen', item)
+
+    helpers.batch(func, range(1, 301), chunksize=5, progress=False,
+                  partition=lambda item: item % 3)
+    assert max(concurrent) > 1
+    assert not overlaps
+    assert len(reporter._reports[report.WARNING]['Seen']) == 300
+
+
+def test_batch_processes_items_after_barrier_once_previous_are_done(
+        config, reporter):
+    config.WORKERS = 4
+    hold = threading.Event()
+    done = []
+    early = []
+
+    def func(item):
+        if item > 100 and len([i for i in done if i <= 100]) < 100:
+            early.append(item)
+        hold.wait(0.001)
+        done.append(item)
+
+    helpers.batch(func, range(1, 201), chunksize=5, progress=False,
+                  barrier=lambda item: item > 100)
+    assert not early
+    assert len(done) == 200
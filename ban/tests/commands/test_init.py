@@ -1,7 +1,10 @@
 import json
+import os
+import uuid
 
-from ban.commands.init import process_row, init
-from ban.core import models
+from ban.commands import cache
+from ban.commands.init import find, process_row, init
+from ban.core import context, models
 from ban.tests import factories
 
 
@@ -454,3 +457,259 @@ def test_import_group_from_bano_dgfip(session):
     assert group.name == 'Lotissement Bellevue'
     assert group.addressing == 'classical'
     assert group.version == 2
+
+
+def test_init_bulk_should_create_resources_and_versions(tmpdir, session):
+    f = tmpdir.join("f1.sjson")
+    rows = [
+        {"type": "municipality", "source": "INSEE/COG (2015)",
+         "insee": "90001", "name": "Angeot"},
+        {"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+         "group": "way", "municipality:insee": "90001",
+         "fantoir": "900010016", "name": "GRANDE RUE"},
+        {"type": "housenumber", "source": "DGFiP/BANO (2016-04)",
+         "group:fantoir": "900010016", "numero": "15", "ordinal": "bis"},
+        {"type": "position", "kind": "entrance",
+         "source": "DGFiP/BANO (2016-04)",
+         "housenumber:cia": "90001_0016_15_bis",
+         "geometry": {"type": "Point", "coordinates": [6.871166, 47.602953]}},
+    ]
+    f.write('\n'.join(json.dumps(row) for row in rows))
+    init(str(f), bulk=True)
+    municipality = models.Municipality.first()
+    assert municipality.insee == "90001"
+    assert municipality.attributes['source'] == "INSEE/COG (2015)"
+    group = models.Group.first()
+    assert group.municipality == municipality
+    assert group.kind == models.Group.WAY
+    housenumber = models.HouseNumber.first()
+    assert housenumber.parent == group
+    assert housenumber.cia == "90001_0016_15_BIS"
+    assert housenumber.ordinal == "bis"
+    position = models.Position.first()
+    assert position.housenumber == housenumber
+    assert position.kind == models.Position.ENTRANCE
+    assert position.center.coords == (6.871166, 47.602953)
+    for instance in (municipality, group, housenumber):
+        assert instance.load_version().data == instance.as_version
+    version = position.load_version()
+    assert version.data['housenumber'] == housenumber.id
+    assert version.data['center']['coordinates'] == [6.871166, 47.602953]
+    for instance in (municipality, group, housenumber, position):
+        prefix, name, value = instance.id.split('-')
+        assert (prefix, name) == ('ban', instance.resource)
+        assert uuid.UUID(value).version == 4
+
+
+def test_init_bulk_should_replay_existing_rows(tmpdir, session):
+    group = factories.GroupFactory(municipality__insee="90001",
+                                   fantoir="900010016", name="Old name",
+                                   attributes={"source": "old"})
+    f = tmpdir.join("f1.sjson")
+    f.write(json.dumps({"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+                        "group": "way", "municipality:insee": "90001",
+                        "fantoir": "900010016", "name": "GRANDE RUE"}))
+    init(str(f), bulk=True)
+    assert models.Group.select().count() == 1
+    group = models.Group.first()
+    assert group.name == "GRANDE RUE"
+    assert group.version == 2
+
+
+def test_init_with_group_commit(tmpdir, session):
+    f = tmpdir.join("f1.sjson")
+    rows = [{"type": "municipality", "source": "INSEE/COG (2015)",
+             "insee": insee, "name": "Le Fœil"}
+            for insee in ['22059', '22058', '22057']]
+    f.write('\n'.join(json.dumps(row) for row in rows))
+    init(str(f), group_commit=2)
+    assert models.Municipality.select().count() == 3
+
+
+def test_init_processes_files_by_dependency_level(tmpdir, session):
+    groups = tmpdir.join("groups.sjson")
+    groups.write(json.dumps({
+        "type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+        "group": "way", "municipality:insee": "90008",
+        "fantoir": "900080203", "name": "GRANDE RUE F. MITTERRAND"}))
+    municipalities = tmpdir.join("municipalities.sjson")
+    municipalities.write(json.dumps({
+        "type": "municipality", "source": "INSEE/COG (2015)",
+        "insee": "90008", "name": "Ville"}))
+    init(str(groups), str(municipalities))
+    group = models.Group.first()
+    assert group.municipality.insee == '90008'
+
+
+def test_init_group_version_references_its_municipality(tmpdir, session):
+    f = tmpdir.join("f1.sjson")
+    rows = [
+        {"type": "municipality", "source": "INSEE/COG (2015)",
+         "insee": "90001", "name": "Angeot"},
+        {"type": "group", "source": "DGFIP/FANTOIR (2015-07)",
+         "group": "way", "municipality:insee": "90001",
+         "fantoir": "900010016", "name": "GRANDE RUE"},
+    ]
+    f.write('\n'.join(json.dumps(row) for row in rows))
+    init(str(f))
+    municipality = models.Municipality.first()
+    group = models.Group.first()
+    assert group.load_version().data['municipality'] == municipality.id
+
+
+def test_init_saves_checkpoint(tmpdir, session):
+    f = tmpdir.join("f1.sjson")
+    f.write(json.dumps({"type": "municipality", "source": "INSEE/COG (2015)",
+                        "insee": "22059", "name": "Le Fœil"}))
+    init(str(f), resume=True)
+    checkpoint = json.loads(tmpdir.join("f1.sjson.checkpoint").read())
+    assert checkpoint['done']
+    assert checkpoint['rows'] == 1
+    assert checkpoint['position'] == len(f.read_binary())
+    assert checkpoint['size'] == len(f.read_binary())
+
+
+def test_init_does_not_save_checkpoint_unless_asked(tmpdir, session):
+    f = tmpdir.join("f1.sjson")
+    f.write(json.dumps({"type": "municipality", "source": "INSEE/COG (2015)",
+                        "insee": "22059", "name": "Le Fœil"}))
+    init(str(f))
+    assert models.Municipality.select().count() == 1
+    assert tmpdir.listdir() == [f]
+
+
+def test_init_saves_checkpoint_in_checkpoint_dir(tmpdir, session, config):
+    source = tmpdir.mkdir('source')
+    checkpoints = tmpdir.join('checkpoints')
+    config.CHECKPOINT_DIR = str(checkpoints)
+    f = source.join("f1.sjson")
+    f.write(json.dumps({"type": "municipality", "source": "INSEE/COG (2015)",
+                        "insee": "22059", "name": "Le Fœil"}))
+    init(str(f))
+    assert source.listdir() == [f]
+    saved = checkpoints.listdir()
+    assert len(saved) == 1
+    assert saved[0].basename.startswith('f1.sjson-')
+    assert json.loads(saved[0].read())['done']
+
+
+def write_checkpoint(f, **state):
+    stat = os.stat(str(f))
+    state.update({'path': str(f), 'size': stat.st_size,
+                  'mtime': stat.st_mtime})
+    f.dirpath().join(f.basename + '.checkpoint').write(json.dumps(state))
+
+
+def test_init_can_resume_from_checkpoint(tmpdir, session):
+    f = tmpdir.join("f1.sjson")
+    first = json.dumps({"type": "municipality", "source": "INSEE/COG (2015)",
+                        "insee": "22059", "name": "Le Fœil"}) + '\n'
+    second = json.dumps({"type": "municipality", "source": "INSEE/COG (2015)",
+                         "insee": "22058", "name": "Le Feu"})
+    f.write(first + second)
+    write_checkpoint(f, position=len(first.encode()), rows=1, done=False,
+                     reports={'3': {'Imported Municipality': 1}})
+    init(str(f), resume=True)
+    assert models.Municipality.select().count() == 1
+    assert models.Municipality.first().insee == '22058'
+
+
+def test_init_resume_restores_reports_of_each_file_once(tmpdir, session):
+    done = tmpdir.join("f1.sjson")
+    done.write(json.dumps({"type": "municipality", "source": "INSEE/COG",
+                           "insee": "22059", "name": "Le Fœil"}))
+    write_checkpoint(done, position=len(done.read_binary()), rows=1,
+                     done=True, reports={'3': {'Imported Municipality': 1}})
+    partial = tmpdir.join("f2.sjson")
+    first = json.dumps({"type": "municipality", "source": "INSEE/COG",
+                        "insee": "22058", "name": "Le Feu"}) + '\n'
+    second = json.dumps({"type": "municipality", "source": "INSEE/COG",
+                         "insee": "22057", "name": "Le Fer"})
+    partial.write(first + second)
+    write_checkpoint(partial, position=len(first.encode()), rows=1,
+                     done=False, reports={'3': {'Imported Municipality': 1}})
+    init(str(done), str(partial), resume=True)
+    reporter = context.get('reporter')
+    assert reporter.total(3, 'Imported Municipality') == 3
+    saved = json.loads(tmpdir.join("f2.sjson.checkpoint").read())
+    assert saved['reports'] == {'3': {'Imported Municipality': 2}}
+
+
+def test_init_does_not_skip_changed_file(tmpdir, session):
+    f = tmpdir.join("f1.sjson")
+    f.write(json.dumps({"type": "municipality", "source": "INSEE/COG (2015)",
+                        "insee": "22059", "name": "Le Fœil"}))
+    write_checkpoint(f, position=0, rows=1, done=True, reports={})
+    f.write(json.dumps({"type": "municipality", "source": "INSEE/COG (2015)",
+                        "insee": "22058", "name": "Le Feu"}), mode='a')
+    init(str(f), resume=True)
+    assert models.Municipality.select().count() == 2
+
+
+def test_cache_miss_is_checked_in_database_in_process_mode(config, session):
+    config.BATCH_EXECUTOR = 'process'
+    cache.reset()
+    try:
+        assert not cache.get().complete
+        # Eg. created by another worker process.
+        group = factories.GroupFactory(municipality__insee="90001",
+                                       fantoir="900010016")
+        assert find(models.Group, 'fantoir', '900010016') == group
+        housenumber = factories.HouseNumberFactory(parent=group, number="15",
+                                                   ordinal="bis")
+        process_row({"type": "position", "kind": "entrance",
+                     "source": "DGFiP/BANO (2016-04)",
+                     "housenumber:cia": "90001_0016_15_bis",
+                     "geometry": {"type": "Point",
+                                  "coordinates": [6.871, 47.602]}})
+        position = models.Position.first()
+        assert position.housenumber == housenumber
+    finally:
+        cache.reset()
+
+
+def test_find_does_not_trust_stale_cache_hit():
+    cache.reset()
+    try:
+        old = factories.GroupFactory(fantoir='900010123')
+        cache.get()
+        models.Group.update(fantoir='900010124').where(
+            models.Group.pk == old.pk).execute()
+        new = factories.GroupFactory(fantoir='900010123')
+        assert find(models.Group, 'fantoir', '900010123') == new
+    finally:
+        cache.reset()
+
+
+def test_housenumber_parent_does_not_trust_stale_cache_hit(session):
+    cache.reset()
+    try:
+        old = factories.GroupFactory(ign='IGNVOIE1')
+        cache.get()
+        models.Group.update(ign='IGNVOIE2').where(
+            models.Group.pk == old.pk).execute()
+        new = factories.GroupFactory(ign='IGNVOIE1',
+                                     municipality=old.municipality)
+        process_row({"type": "housenumber", "source": "IGN (2016-04)",
+                     "group:ign": "IGNVOIE1", "numero": "15"})
+        assert models.HouseNumber.first().parent == new
+    finally:
+        cache.reset()
+
+
+def test_position_housenumber_does_not_trust_stale_cache_hit(session):
+    cache.reset()
+    try:
+        old = factories.HouseNumberFactory(ign='IGNADR1')
+        cache.get()
+        models.HouseNumber.update(ign='IGNADR2').where(
+            models.HouseNumber.pk == old.pk).execute()
+        new = factories.HouseNumberFactory(ign='IGNADR1', parent=old.parent,
+                                           number='16')
+        process_row({"type": "position", "kind": "entrance",
+                     "source": "IGN (2016-04)", "housenumber:ign": "IGNADR1",
+                     "geometry": {"type": "Point",
+                                  "coordinates": [6.871, 47.602]}})
+        assert models.Position.first().housenumber == new
+    finally:
+        cache.reset()
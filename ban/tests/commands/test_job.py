@@ -0,0 +1,110 @@
+from datetime import timedelta
+from pathlib import Path
+
+import pytest
+
+from ban.commands.job import work
+from ban.core import models
+from ban.core.jobs import Job
+from ban.tests import factories
+from ban.utils import utcnow
+
+
+BAL = """cle_interop,uid_adresse,voie_nom,numero,suffixe,commune_nom,position,x,y,long,lat,source,date_der_maj
+35001_0005_99999,,Mail Anita Conti,99999,,Acigné,,,,,,Rennes Métropole,2016-02-22
+"""  # noqa
+
+
+def upload(tmpdir, content, name='upload.csv'):
+    path = tmpdir.join(name)
+    path.write_text(content, encoding='utf-8')
+    return str(path)
+
+
+def test_work_runs_pending_jobs_in_order(staff, tmpdir):
+    factories.MunicipalityFactory(name="Acigné", insee="35001")
+    first = Job.create(kind='bal', path=upload(tmpdir, BAL, 'first.csv'))
+    second = Job.create(kind='bal', path=upload(
+        tmpdir, BAL.replace('0005', '0006'), 'second.csv'))
+    work()
+    first = Job.get(Job.pk == first.pk)
+    second = Job.get(Job.pk == second.pk)
+    assert first.status == Job.DONE
+    assert second.status == Job.DONE
+    assert first.started_at <= second.started_at
+    assert first.finished_at
+    assert first.path is None
+    assert not Path(str(tmpdir.join('first.csv'))).exists()
+    assert models.Group.select().count() == 2
+
+
+def test_work_marks_job_as_failed_on_error(staff, tmpdir):
+    job = Job.create(kind='bal', path=upload(
+        tmpdir, 'voie_nom\nMissing cle_interop\n'))
+    work()
+    job = Job.get(Job.pk == job.pk)
+    assert job.status == Job.FAILED
+    assert job.error
+
+
+def test_work_marks_job_as_failed_on_missing_upload(staff, tmpdir):
+    job = Job.create(kind='bal', path=str(tmpdir.join('missing.csv')))
+    other = Job.create(kind='bal', path=upload(tmpdir, BAL))
+    factories.MunicipalityFactory(name="Acigné", insee="35001")
+    work()
+    job = Job.get(Job.pk == job.pk)
+    assert job.status == Job.FAILED
+    assert 'missing.csv' in job.error
+    # The worker went on with the next job.
+    assert Job.get(Job.pk == other.pk).status == Job.DONE
+
+
+def test_work_marks_job_as_failed_on_abort(staff, tmpdir, monkeypatch):
+    from ban.commands import job as module
+
+    def abort(path, **kwargs):
+        raise SystemExit(1)
+
+    monkeypatch.setitem(module.RUNNERS, 'bal', abort)
+    job = Job.create(kind='bal', path=upload(tmpdir, BAL))
+    work()
+    job = Job.get(Job.pk == job.pk)
+    assert job.status == Job.FAILED
+    assert job.error == 'SystemExit: 1'
+
+
+def test_work_creates_rows_on_behalf_of_the_job_session(staff, tmpdir):
+    factories.MunicipalityFactory(name="Acigné", insee="35001")
+    session = factories.SessionFactory()
+    Job.create(kind='bal', path=upload(tmpdir, BAL), session=session)
+    work()
+    group = models.Group.select().first()
+    assert group.created_by.pk == session.pk
+    assert group.modified_by.pk == session.pk
+
+
+def test_upload_path_requires_upload_dir(config, tmpdir):
+    with pytest.raises(AttributeError):
+        Job.upload_path('upload.csv')
+    config.UPLOAD_DIR = str(tmpdir.join('uploads'))
+    assert Job.upload_path('upload.csv') == Path(
+        str(tmpdir.join('uploads', 'upload.csv')))
+
+
+def test_claim_skips_non_pending_jobs():
+    Job.create(kind='bal', status=Job.DONE)
+    pending = Job.create(kind='bal')
+    job = Job.claim()
+    assert job.pk == pending.pk
+    assert job.status == Job.RUNNING
+    assert Job.claim() is None
+
+
+def test_requeue_stale_running_jobs():
+    lost = Job.create(kind='bal', status=Job.RUNNING,
+                      updated_at=utcnow() - timedelta(hours=2))
+    alive = Job.create(kind='bal', status=Job.RUNNING, updated_at=utcnow())
+    assert Job.requeue(timeout=3600) == 1
+    assert Job.get(Job.pk == lost.pk).status == Job.PENDING
+    assert Job.get(Job.pk == alive.pk).status == Job.RUNNING
+    assert Job.claim().pk == lost.pk
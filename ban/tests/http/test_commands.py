@@ -1,13 +1,16 @@
 from io import BytesIO
 
+from ban.commands.job import work
 from ban.core import models
+from ban.core.jobs import Job
 from ban.tests import factories
 
 from .utils import authorize
 
 
 @authorize
-def test_bal_import_from_data_file(staff, client):
+def test_bal_import_from_data_file(staff, client, config, tmpdir):
+    config.UPLOAD_DIR = str(tmpdir)
     factories.MunicipalityFactory(name="Acigné", insee="35001")
     content = """cle_interop,uid_adresse,voie_nom,numero,suffixe,commune_nom,position,x,y,long,lat,source,date_der_maj\n
 35001_0005_99999,,Mail Anita Conti,99999,,Acigné,,,,,,Rennes Métropole,2016-02-22
@@ -15,15 +18,43 @@ def test_bal_import_from_data_file(staff, client):
     resp = client.post('/import/bal',
                        data={'data': (BytesIO(content.encode()), 'test.csv')},
                        content_type='multipart/form-data')
-    assert resp.status_code == 200
+    assert resp.status_code == 202
+    assert resp.json['status'] == Job.PENDING
+    assert resp.headers['Location'].endswith(
+        '/import/{}'.format(resp.json['id']))
+    # Nothing imported until a worker runs the job.
+    assert models.Group.select().count() == 0
+    work()
     assert models.Group.select().count() == 1
     group = models.Group.select().first()
     assert group.name == "Mail Anita Conti"
     assert group.fantoir == "350010005"
-    assert 'report' in resp.json
+    resp = client.get('/import/{}'.format(resp.json['id']))
+    assert resp.status_code == 200
+    assert resp.json['status'] == Job.DONE
+    assert resp.json['rows'] == 1
     assert 'notice' in resp.json['report']
 
 
+@authorize
+def test_get_unknown_import_job(client):
+    resp = client.get('/import/1234')
+    assert resp.status_code == 404
+
+
+@authorize
+def test_cannot_get_import_job_of_another_client(client):
+    job = Job.create(kind='bal', session=factories.SessionFactory())
+    resp = client.get('/import/{}'.format(job.pk))
+    assert resp.status_code == 404
+
+
+def test_cannot_get_import_job_without_auth(client):
+    job = Job.create(kind='bal')
+    resp = client.get('/import/{}'.format(job.pk))
+    assert resp.status_code == 401
+
+
 def test_cannot_use_bal_import_without_auth(staff, client):
     factories.MunicipalityFactory(name="Acigné", insee="35001")
     resp = client.post('/import/bal', data={'data': (b'xxxx', 'test.csv')},
@@ -1,7 +1,19 @@
+import json
+
+from ban import db
+from ban.core.versioning import Diff
+
 from ..factories import PositionFactory
 from .utils import authorize
 
 
+def read_event(events):
+    event = next(events)
+    if isinstance(event, bytes):
+        event = event.decode()
+    return event
+
+
 @authorize
 def test_diff_endpoint(client):
     position = PositionFactory()
@@ -54,6 +66,108 @@ def test_diff_endpoint_accept_increment_parameter(client):
     assert resp.json['collection'][0]['increment'] == increment + 1
 
 
+@authorize
+def test_diff_endpoint_is_paginated_by_increment(client):
+    PositionFactory()  # Creates 4 diffs.
+    resp = client.get('/diff?limit=3')
+    assert len(resp.json['collection']) == 3
+    assert 'total' not in resp.json
+    last = resp.json['collection'][-1]['increment']
+    assert resp.json['next'].endswith('increment={}&limit=3'.format(last))
+    assert 'rel=next' in resp.headers['Link']
+    resp = client.get(resp.json['next'])
+    assert len(resp.json['collection']) == 1
+    assert resp.json['collection'][0]['increment'] == last + 1
+    assert 'next' not in resp.json
+
+
+@authorize
+def test_diff_endpoint_can_count_total(client):
+    PositionFactory()
+    resp = client.get('/diff?limit=3&total=exact')
+    assert resp.json['total'] == 4
+
+
+@authorize
+def test_diff_endpoint_does_not_count_total_with_total_none(client, config):
+    config.COLLECTION_TOTAL = 'exact'
+    PositionFactory()
+    resp = client.get('/diff?limit=3&total=none')
+    assert resp.status_code == 200
+    assert 'total' not in resp.json
+    resp = client.get('/diff?limit=3')
+    assert 'total' not in resp.json
+
+
+@authorize
+def test_diff_endpoint_rejects_invalid_total(client):
+    resp = client.get('/diff?total=1')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_diff_endpoint_page_size_can_be_configured(client, config):
+    config.DIFF_PAGE_SIZE = 2
+    PositionFactory()
+    resp = client.get('/diff')
+    assert len(resp.json['collection']) == 2
+    assert 'next' in resp.json
+
+
 def test_diff_endpoint_is_protected(client):
     resp = client.get('/diff')
     assert resp.status_code == 401
+
+
+@authorize
+def test_diff_stream_resumes_from_last_event_id(client):
+    PositionFactory()  # Creates 4 diffs.
+    resp = client.get('/diff')
+    first = resp.json['collection'][0]['increment']
+    resp = client.get('/diff/stream', headers={'Last-Event-ID': str(first)})
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/event-stream'
+    events = resp.response
+    for increment in range(first + 1, first + 4):
+        event = next(events)
+        if isinstance(event, bytes):
+            event = event.decode()
+        assert event.startswith('id: {}\nevent: diff\ndata: '.format(
+            increment))
+    resp.close()
+
+
+@authorize
+def test_diff_stream_sends_diffs_committed_late(client):
+    PositionFactory()  # Creates 4 diffs.
+    first, late, *others = [d.pk for d in Diff.select().order_by(Diff.pk)]
+    # Two concurrent transactions: the one which took the `late` increment
+    # commits after the one of the others.
+    row = Diff.select().where(Diff.pk == late).dicts().get()
+    Diff.delete().where(Diff.pk == late).execute()
+    resp = client.get('/diff/stream', headers={'Last-Event-ID': str(first)})
+    events = resp.response
+    for increment in others:
+        assert read_event(events).startswith(
+            'id: {}\nevent: diff\n'.format(increment))
+    Diff.insert(**row).execute()
+    with db.test.listen('other') as other:
+        with other.conn.cursor() as cursor:
+            cursor.execute('NOTIFY "{}"'.format(Diff.CHANNEL))
+    event = read_event(events)
+    # Id is still the highest increment sent, for resuming.
+    assert event.startswith('id: {}\nevent: diff\n'.format(others[-1]))
+    data = json.loads(event.split('data: ', 1)[1])
+    assert data['increment'] == late
+    resp.close()
+
+
+@authorize
+def test_diff_stream_rejects_invalid_last_event_id(client):
+    resp = client.get('/diff/stream', headers={'Last-Event-ID': 'abc'})
+    assert resp.status_code == 400
+
+
+def test_diff_stream_is_protected(client):
+    resp = client.get('/diff/stream')
+    assert resp.status_code == 401
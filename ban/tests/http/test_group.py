@@ -1,7 +1,9 @@
 import json
+from urllib.parse import quote
 
 from ban.core import models
 from ban.core.encoder import dumps
+from ban.utils import utcnow
 
 from ..factories import HouseNumberFactory, MunicipalityFactory, GroupFactory
 from .utils import authorize
@@ -203,6 +205,68 @@ def test_get_group_versions(get):
     assert resp.json['collection'][1]['data']['name'] == 'Rue de la Guerre'
 
 
+@authorize
+def test_get_group_collection_at_a_past_datetime(get):
+    municipality = MunicipalityFactory()
+    street = GroupFactory(name="Rue de la Paix", municipality=municipality)
+    deleted = GroupFactory(name="Rue de la Guerre", municipality=municipality)
+    at = quote(utcnow().isoformat())
+    street.name = "Rue de la Poix"
+    street.increment_version()
+    street.save()
+    deleted.mark_deleted()
+    GroupFactory(name="Rue des Poires", municipality=municipality)
+    resp = get('/group?at={}&fields=name,version'.format(at))
+    assert resp.status_code == 200
+    assert resp.json['total'] == 2
+    assert resp.json['collection'] == [
+        {'name': 'Rue de la Paix', 'version': 1},
+        {'name': 'Rue de la Guerre', 'version': 1},
+    ]
+
+
+@authorize
+def test_get_group_collection_at_excludes_resources_deleted_before(get):
+    GroupFactory(name="Rue de la Paix")
+    deleted = GroupFactory(name="Rue de la Guerre")
+    deleted.mark_deleted()
+    at = quote(utcnow().isoformat())
+    resp = get('/group?at={}&fields=name'.format(at))
+    assert resp.json['total'] == 1
+    assert resp.json['collection'] == [{'name': 'Rue de la Paix'}]
+
+
+@authorize
+def test_get_group_collection_at_rejects_filters(get):
+    municipality = MunicipalityFactory()
+    at = quote(utcnow().isoformat())
+    resp = get('/group?municipality={}&at={}'.format(municipality.id, at))
+    assert resp.status_code == 400
+
+
+@authorize
+def test_get_housenumber_collection_at_follows_endpoint_order(get, config):
+    config.VERSION_KEYFRAME = 2
+    second = HouseNumberFactory(number='2')
+    first = HouseNumberFactory(number='1')
+    # Stored as a delta, still ordered by its number at `at`.
+    second.number = '3'
+    second.increment_version()
+    second.save()
+    at = quote(utcnow().isoformat())
+    first.number = '4'
+    first.increment_version()
+    first.save()
+    resp = get('/housenumber?at={}&fields=number'.format(at))
+    assert resp.json['collection'] == [{'number': '1'}, {'number': '3'}]
+
+
+@authorize
+def test_get_group_collection_with_invalid_at(get):
+    resp = get('/group?at=invalid')
+    assert resp.status_code == 400
+
+
 @authorize
 def test_get_group_version(get):
     street = GroupFactory(name="Rue de la Paix")
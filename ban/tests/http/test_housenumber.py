@@ -141,6 +141,70 @@ def test_get_housenumber_collection(get):
         assert json.loads(dumps(obj.as_relation)) in resp.json['collection']
 
 
+@authorize
+def test_get_housenumber_collection_can_be_streamed(get, config):
+    objs = HouseNumberFactory.create_batch(5)
+    config.COLLECTION_STREAM = 0
+    expected = get('/housenumber?limit=3').json
+    config.COLLECTION_STREAM = 2
+    resp = get('/housenumber?limit=3')
+    assert 'Content-Length' not in resp.headers
+    assert resp.json == expected
+    assert resp.json['total'] == 5
+    assert len(resp.json['collection']) == 3
+    assert 'next' in resp.json
+    resp = get('/housenumber?limit=3&offset=3')
+    assert len(resp.json['collection']) == 2
+    assert json.loads(dumps(objs[4].as_relation)) in resp.json['collection']
+
+
+@authorize
+def test_get_housenumber_collection_reports_total_strategy(get):
+    HouseNumberFactory.create_batch(3)
+    resp = get('/housenumber?limit=2')
+    assert resp.json['total'] == 3
+    assert resp.json['total_strategy'] == 'exact'
+
+
+@authorize
+def test_get_housenumber_collection_without_total(get, config):
+    HouseNumberFactory.create_batch(3)
+    config.COLLECTION_TOTAL = 'none'
+    resp = get('/housenumber?limit=2')
+    assert 'total' not in resp.json
+    assert resp.json['total_strategy'] == 'none'
+    assert len(resp.json['collection']) == 2
+    assert 'next' in resp.json
+    resp = get('/housenumber?limit=2&offset=2')
+    assert len(resp.json['collection']) == 1
+    assert 'next' not in resp.json
+
+
+@authorize
+def test_get_housenumber_collection_with_estimated_total(get):
+    HouseNumberFactory.create_batch(3)
+    resp = get('/housenumber?limit=2&total=estimated')
+    assert resp.json['total_strategy'] == 'estimated'
+    assert isinstance(resp.json['total'], int)
+    assert 'next' in resp.json
+
+
+@authorize
+def test_get_housenumber_collection_with_invalid_total(get):
+    resp = get('/housenumber?total=maybe')
+    assert resp.status_code == 400
+
+
+@authorize
+def test_get_housenumber_collection_with_all_fields(get):
+    position = PositionFactory()
+    housenumber = position.housenumber
+    resp = get('/housenumber?fields=*')
+    assert resp.json['total'] == 1
+    assert resp.json['collection'] == [json.loads(dumps(
+        housenumber.serialize({'*': {}})))]
+
+
 @authorize
 def test_get_housenumber_collection_can_be_filtered_by_bbox(get):
     position = PositionFactory(center=(1, 1))
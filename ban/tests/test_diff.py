@@ -1,3 +1,5 @@
+from ban.core.versioning import Diff, Redirect, Version
+
 from .factories import MunicipalityFactory
 
 
@@ -43,3 +45,69 @@ def test_delete_should_create_a_diff():
     assert len(diff.diff) == 1  # name, siren
     assert diff.diff['status']['old'] == 'active'
     assert diff.diff['status']['new'] == 'deleted'
+
+
+def test_diff_is_notified_on_commit():
+    with Diff._meta.database.listen(Diff.CHANNEL, timeout=1) as listener:
+        MunicipalityFactory()
+        payloads = next(iter(listener))
+    assert payloads == ['']
+
+
+def test_diffs_are_notified_once_by_transaction():
+    with Diff._meta.database.listen(Diff.CHANNEL, timeout=1) as listener:
+        with Diff._meta.database.atomic():
+            MunicipalityFactory()
+            MunicipalityFactory()
+        payloads = next(iter(listener))
+    assert payloads == ['']
+
+
+def test_diff_pk_is_notified_with_diff_mode(config):
+    config.DIFF_NOTIFY = 'diff'
+    with Diff._meta.database.listen(Diff.CHANNEL, timeout=1) as listener:
+        municipality = MunicipalityFactory()
+        payloads = next(iter(listener))
+    assert payloads == [str(municipality.versions[0].diff.pk)]
+
+
+def test_diff_is_not_notified_with_none_mode(config):
+    config.DIFF_NOTIFY = 'none'
+    with Diff._meta.database.listen(Diff.CHANNEL, timeout=0.1) as listener:
+        MunicipalityFactory()
+        payloads = next(iter(listener))
+    assert payloads == []
+
+
+def test_prefetched_diffs_are_serialized_without_queries(monkeypatch):
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    municipality.name = 'Orvanne'
+    municipality.increment_version()
+    municipality.save()
+    diffs = Diff.prefetch(list(Diff.select().order_by(Diff.pk)))
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Unexpected query')
+
+    monkeypatch.setattr(Diff._meta.database, 'execute_sql', fail)
+    created, updated = [diff.serialize() for diff in diffs]
+    assert created['old'] is None
+    assert created['new']['name'] == 'Moret-sur-Loing'
+    assert updated['old']['name'] == 'Moret-sur-Loing'
+    assert updated['new']['name'] == 'Orvanne'
+
+
+def test_stored_versions_diffs_are_inserted_at_once():
+    moret = MunicipalityFactory(name='Moret-sur-Loing', insee='77316')
+    lille = MunicipalityFactory(name='Lille', insee='59350')
+    moret.insee = '77319'
+    lille.name = 'Rijsel'
+    for instance in (moret, lille):
+        instance.increment_version()
+        instance.update_meta()
+    Version.store([moret, lille])
+    moret_diff, lille_diff = list(Diff.select().order_by(Diff.pk))[2:]
+    assert moret_diff.diff['insee'] == {'old': '77316', 'new': '77319'}
+    assert moret_diff.new.sequential == 2
+    assert lille_diff.diff['name'] == {'old': 'Lille', 'new': 'Rijsel'}
+    assert Redirect.follow('municipality', 'insee', '77316') == [moret.id]
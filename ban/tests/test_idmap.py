@@ -0,0 +1,133 @@
+import pytest
+
+from ban.commands import cache
+from ban.core import context, models
+from ban.core.exceptions import IsDeletedError
+from ban.db import IdentifierMap
+from ban.tests import factories
+
+
+def test_idmap_get():
+    idmap = IdentifierMap.build([('90001', 1), ('90002', 2), ('90010', 3)])
+    assert len(idmap) == 3
+    assert idmap.get('90001') == 1
+    assert idmap['90010'] == 3
+    assert '90002' in idmap
+    assert idmap.get('90003') is None
+    assert '9000' not in idmap
+    with pytest.raises(KeyError):
+        idmap['90003']
+
+
+def test_idmap_handles_non_ascii_keys():
+    idmap = IdentifierMap.build(sorted([('rue', 1), ('rué', 2), ('ruf', 3)]))
+    assert idmap.get('rué') == 2
+    assert idmap.get('ruf') == 3
+
+
+def test_idmap_build_requires_sorted_keys():
+    with pytest.raises(ValueError):
+        IdentifierMap.build([('90002', 2), ('90001', 1)])
+
+
+def test_idmap_added_keys_go_to_overlay():
+    idmap = IdentifierMap.build([('90001', 1)])
+    idmap['90002'] = 2
+    idmap['90001'] = 3
+    assert idmap.get('90002') == 2
+    assert idmap.get('90001') == 3
+    assert len(idmap.extra) == 2
+    assert list(idmap.items()) == [('90001', 3), ('90002', 2)]
+
+
+def test_idmap_overlay_is_bounded():
+    idmap = IdentifierMap.build([('a', 0)])
+    idmap.OVERLAY = 4
+    keys = ['{:03}'.format(i) for i in range(50)]
+    for pk, key in enumerate(keys, 1):
+        idmap[key] = pk
+    idmap['010'] = 100  # Replaced key, now in the overlay.
+    assert len(idmap.extra) < 4
+    assert len(idmap.runs) < 6
+    assert all(len(run.extra) == 0 for run in idmap.runs)
+    assert idmap.get('a') == 0
+    assert idmap.get('000') == 1
+    assert idmap.get('049') == 50
+    assert idmap.get('010') == 100
+    assert list(idmap.items()) == sorted(
+        [('a', 0), ('010', 100)]
+        + [(key, pk) for pk, key in enumerate(keys, 1) if key != '010'])
+
+
+def test_idmap_dump_and_load(tmpdir):
+    path = tmpdir.join('map')
+    idmap = IdentifierMap.build([('90001', 1), ('90010', 3)])
+    idmap['90002'] = 2
+    idmap.dump(path)
+    loaded = IdentifierMap.load(path)
+    assert len(loaded) == 3
+    assert loaded.get('90001') == 1
+    assert loaded.get('90002') == 2
+    assert loaded.get('90010') == 3
+    assert loaded.get('90003') is None
+
+
+def test_idmap_from_field():
+    factories.MunicipalityFactory(insee='90002')
+    municipality = factories.MunicipalityFactory(insee='90001')
+    idmap = IdentifierMap.from_field(models.Municipality.insee)
+    assert len(idmap) == 2
+    assert idmap.get('90001') == municipality.pk
+
+
+def test_coerce_uses_import_references(session):
+    municipality = factories.MunicipalityFactory(insee='90001')
+    deleted = factories.MunicipalityFactory(insee='90002')
+    deleted.mark_deleted()
+    references = cache.ReferenceCache().preload()
+    context.set('references', references)
+    try:
+        coerced = models.Municipality.coerce('insee:90001')
+        assert coerced.pk == municipality.pk
+        # A real instance, not a bare pk.
+        assert coerced.id == municipality.id
+        assert coerced.insee == '90001'
+        # Deleted resources are not in the references.
+        with pytest.raises(IsDeletedError):
+            models.Municipality.coerce('insee:90002')
+    finally:
+        context.set('references', None)
+
+
+def test_coerce_checks_import_references_identifier():
+    municipality = factories.MunicipalityFactory(insee='90001')
+    references = cache.ReferenceCache()
+    references.maps[(models.Municipality, 'insee')] = IdentifierMap.build(
+        [('90002', municipality.pk)])
+    context.set('references', references)
+    try:
+        with pytest.raises(models.Municipality.DoesNotExist):
+            models.Municipality.coerce('insee:90002')
+    finally:
+        context.set('references', None)
+
+
+def test_coerce_references_are_scoped_to_import_context(monkeypatch):
+    factories.MunicipalityFactory(insee='90001')
+    references = cache.ReferenceCache().preload()
+    lookups = []
+    get = references.get
+
+    def spy(*args):
+        lookups.append(args)
+        return get(*args)
+
+    monkeypatch.setattr(references, 'get', spy)
+    context.set('references', references)
+    try:
+        models.Municipality.coerce('insee:90001')
+    finally:
+        context.set('references', None)
+    assert len(lookups) == 1
+    models.Municipality.coerce('insee:90001')
+    assert len(lookups) == 1
@@ -1,7 +1,7 @@
 import peewee
 import pytest
 
-from ban.core.versioning import Redirect
+from ban.core.versioning import Diff, Redirect, RedirectCache
 
 from . import factories
 
@@ -136,3 +136,94 @@ def test_should_not_be_deleted_if_instance_remove_fails():
     with pytest.raises(peewee.IntegrityError):
         housenumber.delete_instance()
     assert Redirect.select().count() == 1
+
+
+def test_follow_caches_missing_redirects(monkeypatch):
+    municipality = factories.MunicipalityFactory(insee="12345")
+    assert Redirect.follow('Municipality', 'insee', '54321') == []
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Unexpected query')
+
+    monkeypatch.setattr(Redirect._meta.database, 'execute_sql', fail)
+    assert Redirect.follow('Municipality', 'insee', '54321') == []
+    monkeypatch.undo()
+    Redirect.add(municipality, 'insee', '54321')
+    assert Redirect.follow('Municipality', 'insee', '54321') == [
+        municipality.id]
+
+
+def test_follow_cache_can_be_disabled(config):
+    config.REDIRECT_CACHE_TTL = 0
+    Redirect.cache.clear()
+    municipality = factories.MunicipalityFactory(insee="12345")
+    assert Redirect.follow('Municipality', 'insee', '54321') == []
+    # Created by another process.
+    Redirect.create(model_name='municipality', identifier='insee',
+                    value='54321', model_id=municipality.id)
+    assert Redirect.follow('Municipality', 'insee', '54321') == [
+        municipality.id]
+
+
+def test_redirect_cache_is_cleared_by_diff_notifications():
+    cache = RedirectCache()
+    key = ('municipality', 'insee', '54321')
+    try:
+        assert cache.get(key) is None
+        cache.set(key, [])
+        assert cache.get(key) == []
+        # Eg. diffs committed by another process.
+        with cache.listener.conn.cursor() as cursor:
+            cursor.execute('NOTIFY "{}"'.format(Diff.CHANNEL))
+        assert cache.get(key) is None
+    finally:
+        cache.listener.close()
+
+
+def test_add_many_redirects():
+    municipality = factories.MunicipalityFactory(insee='12345')
+    position = factories.PositionFactory()
+    Redirect.add_many([(municipality, 'insee', '54321'),
+                       (municipality, 'insee', '54321'),
+                       (position, 'pk', '939')])
+    assert Redirect.select().count() == 2
+    assert Redirect.follow('municipality', 'insee', '54321') == [
+        municipality.id]
+    assert Redirect.follow('position', 'pk', '939') == [position.id]
+
+
+def test_add_many_propagates_redirects():
+    municipality = factories.MunicipalityFactory(insee='12345')
+    Redirect.add(municipality, 'insee', '11111')
+    other = factories.MunicipalityFactory(insee='12321')
+    Redirect.add_many([(other, 'insee', '12345')])
+    assert Redirect.follow('municipality', 'insee', '11111') == [other.id]
+
+
+def test_compact_collapses_redirect_chains():
+    position = factories.PositionFactory()
+    Redirect.create(model_name='position', identifier='ign', value='X',
+                    model_id='ban-position-old')
+    Redirect.create(model_name='position', identifier='id',
+                    value='ban-position-old', model_id='ban-position-mid')
+    Redirect.create(model_name='position', identifier='id',
+                    value='ban-position-mid', model_id=position.id)
+    assert Redirect.compact() == 2
+    assert Redirect.select().count() == 3
+    assert Redirect.follow('position', 'ign', 'X') == [position.id]
+    assert Redirect.follow('position', 'id', 'ban-position-old') == [
+        position.id]
+    assert Redirect.follow('position', 'id', 'ban-position-mid') == [
+        position.id]
+    assert Redirect.compact() == 0
+
+
+def test_compact_does_not_follow_ambiguous_redirects():
+    Redirect.create(model_name='position', identifier='ign', value='X',
+                    model_id='ban-position-old')
+    Redirect.create(model_name='position', identifier='id',
+                    value='ban-position-old', model_id='ban-position-a')
+    Redirect.create(model_name='position', identifier='id',
+                    value='ban-position-old', model_id='ban-position-b')
+    assert Redirect.compact() == 0
+    assert Redirect.follow('position', 'ign', 'X') == ['ban-position-old']
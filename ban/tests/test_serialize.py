@@ -1,4 +1,9 @@
-from .factories import GroupFactory, HouseNumberFactory
+import pytest
+
+from ban.core import models
+from ban.core.resource import compile_mask
+
+from .factories import GroupFactory, HouseNumberFactory, PositionFactory
 
 
 def test_simple_serialize():
@@ -162,3 +167,73 @@ def test_serialize_manytomany():
             'id': group.id,
         }]
     }
+
+
+def test_serializer_is_compiled_once_per_mask():
+    compile_mask.cache_clear()
+    group = GroupFactory(name='Rue de la Banatouille')
+    serializer = models.Group.serializer({'name': {}, 'municipality': {}})
+    assert models.Group.serializer({'name': {}, 'municipality': {}}) is \
+        serializer
+    assert serializer(group) == group.serialize({'name': {},
+                                                 'municipality': {}})
+    # Group and its municipality.
+    assert compile_mask.cache_info().currsize == 2
+
+
+def test_serialize_unknown_field_should_raise():
+    group = GroupFactory()
+    with pytest.raises(ValueError):
+        group.serialize({'unknown': {}})
+
+
+def test_serialize_query_should_use_compiled_serializer():
+    group = GroupFactory(name='Rue de la Banatouille')
+    rows = list(models.Group.select().serialize({'name': {}, 'id': {}}))
+    assert rows == [{'name': 'Rue de la Banatouille', 'id': group.id}]
+
+
+def test_serialize_many_should_prefetch_relations(monkeypatch):
+    group = GroupFactory(name='Rue de la Banatouille')
+    for number in ['1', '2', '3']:
+        housenumber = HouseNumberFactory(number=number, ancestors=[group])
+        PositionFactory(housenumber=housenumber)
+    mask = {'number': {}, 'parent': {'municipality': {}},
+            'ancestors': {'name': {}}, 'positions': {'center': {}},
+            'created_by': {}}
+    expected = [h.serialize(mask) for h in
+                models.HouseNumber.select().order_by(models.HouseNumber.pk)]
+    housenumbers = list(models.HouseNumber.select()
+                        .order_by(models.HouseNumber.pk))
+    models.HouseNumber.prefetch(housenumbers, mask)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('Unexpected query')
+
+    monkeypatch.setattr(models.HouseNumber._meta.database, 'execute_sql',
+                        fail)
+    serializer = models.HouseNumber.serializer(mask)
+    assert [serializer(h) for h in housenumbers] == expected
+
+
+def test_columns_should_follow_mask():
+    HouseNumber = models.HouseNumber
+    columns = HouseNumber.columns({'number': {}, 'parent': {'name': {}},
+                                   'ancestors': {}})
+    assert [f.name for f in columns] == ['pk', 'id', 'deleted_at', 'version',
+                                         'number', 'parent']
+
+
+def test_columns_should_select_all_when_mask_has_a_property():
+    assert models.Group.columns({'housenumbers': {}}) is None
+
+
+def test_serialize_from_projected_query():
+    housenumber = HouseNumberFactory(number='12')
+    mask = {'id': {}, 'number': {}, 'parent': {}}
+    qs = models.HouseNumber.select(*models.HouseNumber.columns(mask))
+    assert models.HouseNumber.serialize_many(list(qs), mask) == [{
+        'id': housenumber.id,
+        'number': '12',
+        'parent': housenumber.parent.id,
+    }]
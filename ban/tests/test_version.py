@@ -2,7 +2,7 @@ import peewee
 import pytest
 
 from ban.core import models
-from ban.core.versioning import Version
+from ban.core.versioning import Diff, Version
 
 from .factories import (GroupFactory, HouseNumberFactory, MunicipalityFactory,
                         PositionFactory, PostCodeFactory)
@@ -68,6 +68,73 @@ def test_save_should_be_rollbacked_if_version_save_fails():
     models.Municipality.select().count() == 1
 
 
+def test_store_versions_in_batch():
+    municipality = MunicipalityFactory(name='Moret-sur-Loing')
+    group = GroupFactory(name='Rue des Pommes')
+    new = GroupFactory(name='Rue des Poires')
+    municipality.name = 'Orvanne'
+    group.name = 'Rue des Pêches'
+    for instance in (municipality, group):
+        instance.increment_version()
+        instance.update_meta()
+    diffs = Diff.select().count()
+    versions = Version.store([municipality, group])
+    assert [v.sequential for v in versions] == [2, 2]
+    assert versions[0].data['name'] == 'Orvanne'
+    old, current = municipality.versions
+    assert old.period.upper == current.period.lower
+    assert current.period.upper is None
+    old, current = group.versions
+    assert old.period.upper == current.period.lower
+    assert current.data['name'] == 'Rue des Pêches'
+    # Other resources are left untouched.
+    assert new.versions[0].period.upper is None
+    assert Diff.select().count() == diffs + 2
+    diff = Diff.select().order_by(Diff.pk.desc()).first()
+    assert diff.diff['name'] == {'old': 'Rue des Pommes',
+                                 'new': 'Rue des Pêches'}
+
+
+def test_versions_are_stored_as_deltas_between_keyframes(config):
+    config.VERSION_KEYFRAME = 3
+    group = GroupFactory(name='Rue 1')
+    for name in ['Rue 2', 'Rue 3', 'Rue 4', 'Rue 5']:
+        group.name = name
+        group.increment_version()
+        group.save()
+    versions = list(group.versions)
+    assert [v.snapshot is not None for v in versions] == [True, False, False,
+                                                          True, False]
+    assert versions[1].delta['set']['name'] == 'Rue 2'
+    assert [v.data['name'] for v in versions] == ['Rue 1', 'Rue 2', 'Rue 3',
+                                                  'Rue 4', 'Rue 5']
+    assert group.load_version(3).data == versions[2].data
+    assert group.load_version(3).data['version'] == 3
+    assert group.load_version().load().name == 'Rue 5'
+    diff = Diff.select().order_by(Diff.pk.desc()).first()
+    assert diff.diff['name'] == {'old': 'Rue 4', 'new': 'Rue 5'}
+
+
+def test_listed_versions_documents_are_loaded_at_once(config, monkeypatch):
+    config.VERSION_KEYFRAME = 10
+    group = GroupFactory(name='Rue 1')
+    for name in ['Rue 2', 'Rue 3', 'Rue 4']:
+        group.name = name
+        group.increment_version()
+        group.save()
+    calls = []
+    documents = Version.documents
+
+    def spy(keys):
+        calls.append(keys)
+        return documents(keys)
+
+    monkeypatch.setattr(Version, 'documents', spy)
+    assert [v.data['name'] for v in group.versions] == ['Rue 1', 'Rue 2',
+                                                        'Rue 3', 'Rue 4']
+    assert len(calls) == 1
+
+
 def test_group_is_versioned():
     initial_name = "Rue des Pommes"
     street = GroupFactory(name=initial_name)
@@ -1,6 +1,8 @@
 from datetime import datetime, timezone
 from uuid import UUID
 
+from dateutil.parser import parse as parse_date
+
 
 def is_uuid4(uuid_string):
     """
@@ -44,10 +46,37 @@ def make_diff(old, new, update=False):
     return diff
 
 
+def make_delta(old, new):
+    """Create the delta to rebuild `new` from `old`, including meta keys, to
+    be applied with `apply_delta`."""
+    return {
+        'set': {k: v for k, v in new.items() if k not in old or old[k] != v},
+        'unset': [k for k in old if k not in new],
+    }
+
+
+def apply_delta(data, delta):
+    """Return a copy of `data`, with `delta` applied."""
+    data = dict(data)
+    data.update(delta['set'])
+    for key in delta['unset']:
+        data.pop(key, None)
+    return data
+
+
 def utcnow():
     return datetime.now(timezone.utc)
 
 
+def parse_datetime(value):
+    """Parse a datetime string, implying that naive ones are UTC, as the API
+    exposes datetimes in UTC. Raise ValueError for invalid values."""
+    value = parse_date(value)
+    if not value.tzinfo:
+        value = value.replace(tzinfo=timezone.utc)
+    return value
+
+
 def parse_mask(source):
     dest = {}
     for fields in source.split(','):
@@ -5,11 +5,13 @@ from flask import url_for
 from flask.testing import FlaskClient
 
 from ban import db
+from ban.commands import cache
 from ban.commands.db import create as createdb
 from ban.commands.db import truncate as truncatedb
 from ban.commands.db import models
 from ban.commands.reporter import Reporter
 from ban.core import context
+from ban.core.versioning import Redirect
 from ban.http.api import app as application
 from ban.tests.factories import SessionFactory, TokenFactory, UserFactory
 
@@ -34,6 +36,8 @@ def pytest_unconfigure(config):
 def pytest_runtest_setup(item):
     truncatedb(force=True)
     context.set('session', None)
+    cache.reset()
+    Redirect.cache.clear()
 
 
 @pytest.fixture()